@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Memory benchmark of a DEM going through load -> dataset -> save
+(read_img, read_img_from_array and save_tif).
+
+A synthetic float32 GeoTIFF tile is generated, then the peak RSS of
+a separate process doing the round trip is reported, along with the
+tile size, so that the overhead in number of tile copies is visible.
+GDAL_CACHEMAX is pinned to 64 MB in the measured processes so that
+the GDAL block cache does not hide demcompare own allocations.
+Run it on two revisions to compare them:
+
+    python benchmarks/bench_dataset_memory.py --size 20000
+"""
+
+# Standard imports
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+# Third party imports
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+ROUND_TRIP = """
+import resource, sys
+from demcompare.img_tools import read_img, read_img_from_array, save_tif
+dem = read_img(sys.argv[1], no_data=-32768)
+dem = read_img_from_array(dem["im"].data, from_dataset=dem, no_data=-32768)
+save_tif(dem, sys.argv[2])
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def generate_tile(path: str, size: int):
+    """
+    Write a size x size float32 synthetic DEM, by blocks of rows
+
+    :param path: output GeoTIFF path
+    :type path: str
+    :param size: tile width and height in pixels
+    :type size: int
+    """
+    rows_step = 1024
+    with rasterio.open(
+        path,
+        mode="w",
+        driver="GTiff",
+        width=size,
+        height=size,
+        count=1,
+        dtype=np.float32,
+        crs="EPSG:32630",
+        transform=from_origin(600000, 5000000, 1, 1),
+        nodata=-32768,
+    ) as tile_ds:
+        cols = np.arange(size, dtype=np.float32)
+        for row in range(0, size, rows_step):
+            height = min(rows_step, size - row)
+            rows = np.arange(row, row + height, dtype=np.float32)[:, None]
+            tile_ds.write(
+                100 + 10 * np.sin(rows / 500.0) * np.cos(cols / 700.0),
+                1,
+                window=rasterio.windows.Window(0, row, size, height),
+            )
+
+
+def main():
+    """
+    Run the memory benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size", type=int, default=20000, help="tile size")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_path = os.path.join(tmp_dir, "tile.tif")
+        out_path = os.path.join(tmp_dir, "tile_out.tif")
+        generate_tile(in_path, args.size)
+        env = dict(os.environ, GDAL_CACHEMAX="64")
+
+        baseline = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import resource; import demcompare;"
+                "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)",
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+            env=env,
+        )
+        round_trip = subprocess.run(
+            [sys.executable, "-c", ROUND_TRIP, in_path, out_path],
+            check=True,
+            capture_output=True,
+            text=True,
+            env=env,
+        )
+
+    # ru_maxrss is in kilobytes on Linux
+    import_rss = int(baseline.stdout.split()[-1]) / 1024
+    peak_rss = int(round_trip.stdout.split()[-1]) / 1024
+    tile_mb = args.size * args.size * 4 / 1024**2
+    print("tile size: {0}x{0} float32 ({1:.0f} MB)".format(args.size, tile_mb))
+    print("peak RSS: {:.0f} MB".format(peak_rss))
+    print(
+        "peak RSS above imports: {:.0f} MB ({:.2f} tiles)".format(
+            peak_rss - import_rss, (peak_rss - import_rss) / tile_mb
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
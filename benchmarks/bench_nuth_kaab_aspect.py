@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmark of the Nuth & Kaab aspect slicing: the former loop doing
+a full pass over the targets for each of the 72 aspect slices,
+against the single sort by slice of slice_by_aspect.
+
+Both are run on the targets of a synthetic DEM,
+their slices medians and filtered targets are checked to be identical:
+
+    python benchmarks/bench_nuth_kaab_aspect.py --size 10000
+"""
+
+# Standard imports
+import argparse
+import time
+
+# Third party imports
+import numpy as np
+
+# DEMcompare imports
+from demcompare.nuth_kaab_universal_coregistration import (
+    grad2d,
+    slice_by_aspect,
+)
+
+SIGMA_FILTER = 3
+
+
+def loop_slices(target: np.ndarray, aspect: np.ndarray):
+    """
+    Former aspect slicing, one full pass per slice
+
+    :param target: dh / tan(slope) values
+    :type target: np.ndarray
+    :param aspect: aspect values
+    :type aspect: np.ndarray
+    :return: slices filtered medians and filtered target
+    :rtype: List[float], np.ndarray
+    """
+    aspect_bounds = np.arange(0, 2 * np.pi, np.pi / 36)
+    target_filt = np.full(target.shape, np.nan)
+    slice_filt_median = []
+    for bounds in aspect_bounds:
+        slice_idxes = np.where(
+            (bounds < aspect) & (aspect < bounds + np.pi / 36)
+        )
+        if len(slice_idxes[0]) == 0:
+            slice_filt_median.append(np.nan)
+            continue
+        target_slice = target[slice_idxes]
+        slice_mean = np.nanmean(target_slice)
+        slice_sigma = np.std(target_slice[np.isfinite(target_slice)])
+        inv_idx = np.logical_or(
+            (target_slice < (slice_mean - SIGMA_FILTER * slice_sigma)),
+            (target_slice > (slice_mean + SIGMA_FILTER * slice_sigma)),
+        )
+        target_slice[inv_idx] = np.nan
+        target_filt[slice_idxes] = target_slice
+        slice_filt_median.append(np.nanmedian(target_slice))
+    return slice_filt_median, target_filt
+
+
+def sorted_slices(target: np.ndarray, aspect: np.ndarray):
+    """
+    Aspect slicing of nuth_kaab_single_iter, a single sort by slice
+
+    :param target: dh / tan(slope) values
+    :type target: np.ndarray
+    :param aspect: aspect values
+    :type aspect: np.ndarray
+    :return: slices filtered medians and filtered target
+    :rtype: List[float], np.ndarray
+    """
+    aspect_step = np.pi / 36
+    aspect_bounds = np.arange(0, 2 * np.pi, aspect_step)
+    target_idxes, slice_starts, slice_stops = slice_by_aspect(
+        aspect, aspect_bounds, aspect_step
+    )
+    sorted_target = target[target_idxes]
+    target_filt = np.full(target.shape, np.nan)
+    slice_filt_median = []
+    for slice_start, slice_stop in zip(slice_starts, slice_stops):
+        if slice_stop == slice_start:
+            slice_filt_median.append(np.nan)
+            continue
+        target_slice = sorted_target[slice_start:slice_stop]
+        slice_mean = np.nanmean(target_slice)
+        slice_sigma = np.std(target_slice[np.isfinite(target_slice)])
+        inv_idx = np.logical_or(
+            (target_slice < (slice_mean - SIGMA_FILTER * slice_sigma)),
+            (target_slice > (slice_mean + SIGMA_FILTER * slice_sigma)),
+        )
+        target_slice[inv_idx] = np.nan
+        target_filt[target_idxes[slice_start:slice_stop]] = target_slice
+        slice_filt_median.append(np.nanmedian(target_slice))
+    return slice_filt_median, target_filt
+
+
+def synthetic_targets(size: int):
+    """
+    Targets and aspects of a synthetic float32 DEM and elevation differences
+
+    :param size: DEM width and height in pixels
+    :type size: int
+    :return: target, aspect
+    :rtype: np.ndarray, np.ndarray
+    """
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:size, 0:size].astype(np.float32)
+    dem = 50 * np.sin(cols / 40) * np.cos(rows / 55)
+    dem += rng.normal(0, 0.5, (size, size)).astype(np.float32)
+    del rows, cols
+    slope, aspect = grad2d(dem)
+    del dem
+    slope[slope < 0.001] = np.nan
+    dh = rng.normal(0.3, 2, (size, size)).astype(np.float32)
+    dh[rng.random((size, size)) < 0.05] = np.nan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        target = dh / slope
+    valid = np.isfinite(dh)
+    return target[valid], aspect[valid]
+
+
+def main():
+    """
+    Run the aspect slicing benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size", type=int, default=10000, help="DEM size")
+    args = parser.parse_args()
+
+    target, aspect = synthetic_targets(args.size)
+    print("{} targets".format(target.size))
+
+    results = []
+    for name, slicing in (("loop", loop_slices), ("sorted", sorted_slices)):
+        start = time.perf_counter()
+        results.append(slicing(target.copy(), aspect))
+        print("{}: {:.2f} s".format(name, time.perf_counter() - start))
+
+    (loop_median, loop_filt), (sorted_median, sorted_filt) = results
+    assert np.array_equal(loop_median, sorted_median, equal_nan=True)
+    assert np.array_equal(loop_filt, sorted_filt, equal_nan=True)
+    print("identical results")
+
+
+if __name__ == "__main__":
+    main()
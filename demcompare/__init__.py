@@ -31,17 +31,31 @@ import logging.config
 import os
 import sys
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from typing import Dict, List
 
 # Third party imports
 import matplotlib as mpl
+import matplotlib.pyplot as pl
 import numpy as np
 import xarray as xr
 
 # DEMcompare imports
 from . import coregistration, initialization, report, stats
-from .img_tools import load_dems, read_img, read_img_from_array, save_tif
+from .coregistration_cache import start_run
+from .img_tools import (
+    close_rasters,
+    load_dems,
+    mask_outside_bounds,
+    read_img_from_array,
+    read_intermediate_img,
+    save_intermediate_img,
+    save_tif,
+    set_output_profile,
+)
 from .output_tree_design import get_otd_dirs, get_out_dir, get_out_file_path
+from .output_writer import flush_outputs, set_writer_threads
 
 # ** VERSION **
 # pylint: disable=import-error,no-name-in-module
@@ -152,6 +166,29 @@ def compute_stats(
     :return:
     """
     print("\n[Stats]")
+    if "tile_core" in cfg:
+        # Only the tile core is counted, not its halo
+        tile_core = cfg["tile_core"]
+        if "plani_results" in cfg:
+            # final_dh georef-grid is the DSM one translated by the
+            # coregistration offsets (see coregistration.translate calls):
+            # the core bounds are translated alike to keep the same pixels
+            trans = final_dh["trans"].data
+            x_shift = (
+                cfg["plani_results"]["dx"]["nuth_offset"]
+                + cfg["plani_opts"]["disp_init"]["x"]
+            ) * trans[1]
+            y_shift = (
+                -cfg["plani_results"]["dy"]["nuth_offset"]
+                + cfg["plani_opts"]["disp_init"]["y"]
+            ) * trans[5]
+            tile_core = {
+                "left": tile_core["left"] + x_shift,
+                "bottom": tile_core["bottom"] + y_shift,
+                "right": tile_core["right"] + x_shift,
+                "top": tile_core["top"] + y_shift,
+            }
+        final_dh = mask_outside_bounds(final_dh, tile_core)
     cfg["stats_results"] = {}
     cfg["stats_results"]["images"] = {}
     cfg["stats_results"]["images"]["list"] = []
@@ -236,7 +273,12 @@ def compute_coregistration(
 
             cfg["plani_results"] = final_cfg["plani_results"]
             cfg["alti_results"] = final_cfg["alti_results"]
-            coreg_dem = read_img(
+            # Initial disparity estimated by the previous run
+            if cfg["plani_opts"]["disp_init"] == "auto":
+                cfg["plani_opts"]["disp_init"] = final_cfg["plani_opts"][
+                    "disp_init"
+                ]
+            coreg_dem = read_intermediate_img(
                 str(cfg["alti_results"]["rectifiedDSM"]["path"]),
                 no_data=(
                     cfg["alti_results"]["rectifiedDSM"]["nodata"]
@@ -244,7 +286,7 @@ def compute_coregistration(
                     else None
                 ),
             )
-            coreg_ref = read_img(
+            coreg_ref = read_intermediate_img(
                 str(cfg["alti_results"]["rectifiedRef"]["path"]),
                 no_data=(
                     cfg["alti_results"]["rectifiedRef"]["nodata"]
@@ -252,7 +294,7 @@ def compute_coregistration(
                     else None
                 ),
             )
-            final_dh = read_img(
+            final_dh = read_intermediate_img(
                 str(cfg["alti_results"]["dzMap"]["path"]),
                 no_data=cfg["alti_results"]["dzMap"]["nodata"],
             )
@@ -272,23 +314,26 @@ def compute_coregistration(
             cfg["alti_results"]["rectifiedDSM"] = copy.deepcopy(cfg["inputDSM"])
             cfg["alti_results"]["rectifiedRef"] = copy.deepcopy(cfg["inputRef"])
 
-            coreg_dem = save_tif(
+            coreg_dem = save_intermediate_img(
                 coreg_dem,
                 os.path.join(
                     cfg["outputDir"], get_out_file_path("coreg_DEM.tif")
                 ),
+                intermediate_format=cfg["plani_opts"]["intermediate_format"],
             )
-            coreg_ref = save_tif(
+            coreg_ref = save_intermediate_img(
                 coreg_ref,
                 os.path.join(
                     cfg["outputDir"], get_out_file_path("coreg_REF.tif")
                 ),
+                intermediate_format=cfg["plani_opts"]["intermediate_format"],
             )
-            final_dh = save_tif(
+            final_dh = save_intermediate_img(
                 final_dh,
                 os.path.join(
                     cfg["outputDir"], get_out_file_path("final_dh.tif")
                 ),
+                intermediate_format=cfg["plani_opts"]["intermediate_format"],
             )
             cfg["alti_results"]["rectifiedDSM"]["path"] = coreg_dem.attrs[
                 "input_img"
@@ -355,6 +400,7 @@ def compute_initialization(config_json: str) -> Dict:
     initialization.initialization_plani_opts(cfg)
     initialization.initialization_alti_opts(cfg)
     initialization.initialization_stats_opts(cfg)
+    initialization.initialization_output_opts(cfg)
 
     return cfg
 
@@ -379,6 +425,8 @@ def run_tile(json_file: str, steps: List[str] = None, display=False):
     # Initialization
     #
     cfg = compute_initialization(json_file)
+    set_output_profile(cfg["output_opts"])
+    set_writer_threads(cfg["output_opts"]["writer_threads"])
 
     print("*** DEMcompare ***")
     print("Working directory: {}".format(cfg["outputDir"]))
@@ -440,7 +488,14 @@ def run_tile(json_file: str, steps: List[str] = None, display=False):
         load_data=(
             cfg["inputDSM"]["roi"] if "roi" in cfg["inputDSM"] else True
         ),
+        lazy=cfg["lazy"],
     )
+    if cfg["lazy"]:
+        # Only the inputs reading, conversion and reprojection are done
+        # by chunks: the coregistration, the differences and the stats
+        # are computed on the loaded arrays
+        ref = ref.compute()
+        dem = dem.compute()
     print("\n# Input Elevation Models:")
     print("Tested DEM (DEM): {}".format(dem.input_img))
     print("Reference DEM (REF): {}".format(ref.input_img))
@@ -449,7 +504,10 @@ def run_tile(json_file: str, steps: List[str] = None, display=False):
     # Compute initial dh, save it
     #
     initial_dh = read_img_from_array(
-        ref["im"].data - dem["im"].data, from_dataset=dem, no_data=-32768
+        ref["im"].data - dem["im"].data,
+        from_dataset=dem,
+        no_data=-32768,
+        copy_array=False,
     )
     initial_dh = save_tif(
         initial_dh,
@@ -545,6 +603,10 @@ def run_tile(json_file: str, steps: List[str] = None, display=False):
         final_json_file=final_json_file,
     )
 
+    # Wait for the outputs written in the background,
+    # outputs are written synchronously out of a tile run
+    set_writer_threads(0)
+
     #
     # Compute reports
     #
@@ -558,15 +620,62 @@ def run_tile(json_file: str, steps: List[str] = None, display=False):
     )
 
 
+def init_tile_worker(loglevel=logging.WARNING, run_start: float = None):
+    """
+    Initialization of a tiles pool worker process:
+    logging, non interactive matplotlib backend
+    and coregistration cache run start
+
+    :param loglevel: Choose Loglevel (default: WARNING)
+    :type loglevel: logging.WARNING
+    :param run_start: start time of the run
+    :type run_start: float or None
+    """
+    setup_logging(default_level=loglevel)
+    mpl.use("Agg")
+    start_run(run_start)
+
+
+def run_tile_job(tile: Dict, steps: List[str], display=False) -> bool:
+    """
+    Run a tile, capturing its failure
+
+    :param tile: Tile, with its Json configuration file ("json")
+    :type tile: Dict
+    :param steps: Steps to execute
+    :type steps: List[str]
+    :param display: Choose Plot show or plot save (default).
+    :type display: bool
+    :return: True if the tile succeeded
+    :rtype: bool
+    """
+    try:
+        run_tile(tile["json"], steps, display=display)
+    except Exception as error:
+        traceback.print_exc()
+        print("Error encountered for tile: {} -> {}".format(tile, error))
+        # Wait for the failed tile outputs before the next tile
+        flush_outputs(raise_errors=False)
+        return False
+    finally:
+        # The figures of a tile are never drawn on by the next ones
+        if display is False:
+            pl.close("all")
+        sys.stdout.flush()
+    return True
+
+
 def run(
     json_file: str,
     steps: List[str] = None,
     display: bool = False,
     loglevel=logging.WARNING,
+    jobs: int = None,
 ):
     """
     DEMcompare main execution for all tiles.
-    Call run_tile() function for each tile.
+    Call run_tile() function for each tile,
+    in a pool of jobs processes if jobs > 1.
 
     :param json_file: Input Json configuration file (mandatory)
     :type json_file: str
@@ -576,6 +685,9 @@ def run(
     :type display: bool
     :param loglevel: Choose Loglevel (default: WARNING)
     :type loglevel: logging.WARNING
+    :param jobs: Number of tiles processed in parallel
+        (default: configuration "jobs", else 1)
+    :type jobs: int or None
     """
 
     # Set steps to default if None
@@ -590,6 +702,11 @@ def run(
     if display is False:
         # if display is False we have to tell matplotlib to cancel it
         mpl.use("Agg")
+    if jobs is None:
+        jobs = cfg.get("jobs", 1)
+    initialization.check_jobs(jobs, display)
+    # coregistration cache entries used from now on are kept
+    run_start = start_run()
 
     #
     # Get back tiles
@@ -603,13 +720,47 @@ def run(
     # Run classic steps by tiles
     # (there can be just one tile which could be the whole image)
     #
-    for tile in tiles:
-        try:
-            run_tile(
-                tile["json"],
-                steps,
-                display=display,
+    try:
+        if jobs == 1 or len(tiles) == 1:
+            succeeded = [
+                run_tile_job(tile, steps, display=display) for tile in tiles
+            ]
+        else:
+            # spawned workers: each one has its own matplotlib state,
+            # outputs writer and rasters cache
+            with ProcessPoolExecutor(
+                max_workers=min(jobs, len(tiles)),
+                mp_context=get_context("spawn"),
+                initializer=init_tile_worker,
+                initargs=(loglevel, run_start),
+            ) as executor:
+                futures = [
+                    executor.submit(run_tile_job, tile, steps) for tile in tiles
+                ]
+                succeeded = []
+                for tile, future in zip(tiles, futures):
+                    try:
+                        succeeded.append(future.result())
+                    except Exception as error:
+                        # the tile worker process died (killed, out of memory)
+                        print(
+                            "Error encountered for tile: {} -> {}".format(
+                                tile, error
+                            )
+                        )
+                        succeeded.append(False)
+    finally:
+        # Close the rasters opened during the run
+        flush_outputs(raise_errors=False)
+        set_writer_threads(0)
+        close_rasters()
+
+    if len(tiles) > 1:
+        print(
+            "Tiles: {} succeeded, {} failed".format(
+                succeeded.count(True), succeeded.count(False)
             )
-        except Exception as error:
-            traceback.print_exc()
-            print("Error encountered for tile: {} -> {}".format(tile, error))
+        )
+        for tile, tile_succeeded in zip(tiles, succeeded):
+            if not tile_succeeded:
+                print("Failed tile: {}".format(tile["json"]))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains the processing of arrays by row blocks
+in a threads pool (numpy releases the GIL in its array operations),
+so that the Nuth & Kaab iterations run on several cores.
+"""
+
+# Standard imports
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Tuple
+
+# Third party imports
+import numpy as np
+
+# DEMcompare imports
+from .robust_stats import NMAD_FACTOR, RobustStats, select_median
+
+# Number of row blocks per thread, for the threads load balancing
+BLOCKS_PER_THREAD = 4
+# Number of histogram bins used to locate the median in block_median
+MEDIAN_BINS = 4096
+
+
+class BlockPool:
+    """
+    Threads pool running a function on the row blocks of arrays.
+
+    With a single thread, there is a single block (the whole arrays)
+    and functions are run in the calling thread.
+    """
+
+    def __init__(self, nb_threads: int = 1):
+        """
+        Initialization of a block pool
+
+        :param nb_threads: number of threads
+        :type nb_threads: int
+        """
+        self.nb_threads = nb_threads
+        self._executor = None
+        if nb_threads > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=nb_threads, thread_name_prefix="demcompare_block"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Shut the threads down
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def parallel(self) -> bool:
+        """
+        True if functions are run in several threads
+        """
+        return self._executor is not None
+
+    def row_blocks(self, nb_rows: int) -> List[slice]:
+        """
+        Split nb_rows rows into blocks
+
+        :param nb_rows: number of rows
+        :type nb_rows: int
+        :return: row blocks slices
+        :rtype: List[slice]
+        """
+        if not self.parallel:
+            return [slice(None)]
+        nb_blocks = max(1, min(nb_rows, self.nb_threads * BLOCKS_PER_THREAD))
+        bounds = np.linspace(0, nb_rows, nb_blocks + 1).astype(int)
+        return [
+            slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def map(self, func: Callable, iterable: Iterable) -> list:
+        """
+        Run func on each item of iterable
+
+        :param func: function
+        :type func: Callable
+        :param iterable: function arguments
+        :type iterable: Iterable
+        :return: func results, in the iterable order
+        :rtype: list
+        """
+        if not self.parallel:
+            return list(map(func, iterable))
+        return list(self._executor.map(func, iterable))
+
+    def map_blocks(self, func: Callable, nb_rows: int) -> list:
+        """
+        Run func on each row block of nb_rows rows
+
+        :param func: function of a row block slice
+        :type func: Callable
+        :param nb_rows: number of rows
+        :type nb_rows: int
+        :return: func results, in the row blocks order
+        :rtype: list
+        """
+        return self.map(func, self.row_blocks(nb_rows))
+
+
+def concatenate_blocks(results: List[np.ndarray]) -> np.ndarray:
+    """
+    Concatenate row blocks results (a single result is not copied)
+
+    :param results: row blocks results
+    :type results: List[np.ndarray]
+    :return: concatenated results
+    :rtype: np.ndarray
+    """
+    if len(results) == 1:
+        return results[0]
+    return np.concatenate(results)
+
+
+def block_median(
+    data: np.ndarray, pool: BlockPool = None, center: float = None
+) -> float:
+    """
+    Median of the finite values of data, or of their absolute deviation
+    to center if set, equal to numpy median.
+
+    In parallel, the median is selected in three passes on the row blocks:
+    values count and range, histogram of the values, then selection
+    of the values of the median histogram bins.
+
+    :param data: data
+    :type data: np.ndarray
+    :param pool: row blocks pool (None for a single block)
+    :type pool: BlockPool or None
+    :param center: if set, median of abs(data - center)
+    :type center: float or None
+    :return: median
+    :rtype: float
+    """
+
+    def finite_values(block: slice) -> np.ndarray:
+        """finite values of a row block"""
+        values = data[block]
+        if center is not None:
+            values = np.abs(values - center)
+        return values[np.isfinite(values)]
+
+    if pool is None or not pool.parallel:
+        return select_median(finite_values(slice(None)))
+
+    def values_range(block: slice):
+        """values count, min and max of a row block"""
+        values = finite_values(block)
+        if values.size == 0:
+            return 0, np.inf, -np.inf
+        return values.size, values.min(), values.max()
+
+    # values count and range
+    ranges = pool.map_blocks(values_range, data.shape[0])
+    nb_values = sum(block_range[0] for block_range in ranges)
+    if nb_values == 0:
+        return np.float64(np.nan)
+    min_value = min(block_range[1] for block_range in ranges)
+    max_value = max(block_range[2] for block_range in ranges)
+    if min_value == max_value:
+        return min_value
+    # bins are monotonic in the values: a bin values are all
+    # below the next bins ones
+    scale = MEDIAN_BINS / (float(max_value) - float(min_value))
+
+    def bin_ids(values: np.ndarray) -> np.ndarray:
+        """values histogram bins"""
+        return np.minimum(
+            ((values - min_value) * scale).astype(np.intp), MEDIAN_BINS - 1
+        )
+
+    # histogram of the values
+    counts = sum(
+        pool.map_blocks(
+            lambda block: np.bincount(
+                bin_ids(finite_values(block)), minlength=MEDIAN_BINS
+            ),
+            data.shape[0],
+        )
+    )
+    cum_counts = np.cumsum(counts)
+    # ranks of the middle values, as numpy median
+    ranks = sorted({(nb_values - 1) // 2, nb_values // 2})
+    bins = [np.searchsorted(cum_counts, rank, side="right") for rank in ranks]
+
+    # selection in the median bins
+    def bins_values(block: slice) -> List[np.ndarray]:
+        """values of a row block in the median bins"""
+        values = finite_values(block)
+        values_bins = bin_ids(values)
+        return [values[values_bins == median_bin] for median_bin in bins]
+
+    blocks_bins_values = pool.map_blocks(bins_values, data.shape[0])
+    middle_values = []
+    for idx, (rank, median_bin) in enumerate(zip(ranks, bins)):
+        bin_values = np.concatenate(
+            [block_bins_values[idx] for block_bins_values in blocks_bins_values]
+        )
+        bin_rank = rank - (cum_counts[median_bin - 1] if median_bin else 0)
+        middle_values.append(np.partition(bin_values, bin_rank)[bin_rank])
+
+    return np.mean(np.array(middle_values, dtype=middle_values[0].dtype))
+
+
+def block_median_nmad(
+    data: np.ndarray, pool: BlockPool = None, robust_stats: RobustStats = None
+) -> Tuple[float, float]:
+    """
+    Median and NMAD of the finite values of data, equal to numpy ones:
+    by selection in the robust_stats scratch buffer with a single thread,
+    by block_median selections in parallel
+
+    :param data: data
+    :type data: np.ndarray
+    :param pool: row blocks pool (None for a single block)
+    :type pool: BlockPool or None
+    :param robust_stats: robust statistics scratch buffer
+    :type robust_stats: RobustStats or None
+    :return: median, nmad
+    :rtype: float, float
+    """
+    if pool is None or not pool.parallel:
+        if robust_stats is None:
+            robust_stats = RobustStats()
+        return robust_stats.median_nmad(data, valid=np.isfinite(data))
+    median = block_median(data, pool)
+    return median, NMAD_FACTOR * block_median(data, pool, center=median)
+
+
+def block_subtract(
+    left: np.ndarray, right, pool: BlockPool = None
+) -> np.ndarray:
+    """
+    left - right, computed by row blocks
+
+    :param left: left operand
+    :type left: np.ndarray
+    :param right: right operand, array of left shape or scalar
+    :type right: np.ndarray or float
+    :param pool: row blocks pool (None for a single block)
+    :type pool: BlockPool or None
+    :return: difference
+    :rtype: np.ndarray
+    """
+    if pool is None or not pool.parallel:
+        return left - right
+    out = np.empty(left.shape, dtype=np.result_type(left, right))
+
+    def subtract_block(block: slice):
+        """difference of a row block"""
+        np.subtract(
+            left[block],
+            right[block] if np.ndim(right) else right,
+            out=out[block],
+        )
+
+    pool.map_blocks(subtract_block, left.shape[0])
+    return out
@@ -24,22 +24,63 @@ Coregistration part of dsm_compare
 # Standard imports
 import copy
 import os
-from typing import Dict
+from typing import Callable, Dict, Tuple
 
 # Third party imports
 import numpy as np
 import xarray as xr
 
 # DEMcompare imports
+from .block_processing import BlockPool
+from .coregistration_cache import CoregistrationCache
 from .img_tools import (
     compute_offset_bounds,
-    save_tif,
+    read_img_from_array,
+    read_intermediate_img,
+    save_intermediate_img,
     translate,
     translate_to_coregistered_geometry,
 )
-from .nuth_kaab_universal_coregistration import nuth_kaab_lib
+from .least_squares_coregistration import least_squares_lib
+from .nuth_kaab_universal_coregistration import (
+    ShiftInterpolator,
+    nuth_kaab_lib,
+    resample_to_shift,
+)
 from .output_tree_design import get_out_dir, get_out_file_path
 
+# Minimum size (pixels) of the pyramid coarse levels DEMs
+PYRAMID_MIN_SIZE = 32
+# Maximum size (pixels) of the DEMs downsampled for the
+# initial disparity phase correlation
+PHASE_CORRELATION_MAX_SIZE = 512
+
+# Coregistration methods, by plani_opts coregistration_method name
+COREGISTRATION_METHODS: Dict[str, Callable] = {}
+
+
+def coregistration_method(name: str) -> Callable:
+    """
+    Register a coregistration method under a plani_opts
+    coregistration_method name.
+
+    The registered function is called as func(cfg, dem, ref, nb_iters)
+    and returns the x and y offsets (pixels, y north oriented),
+    the z offset, coreg_dem, coreg_ref, final_dh and the number
+    of iterations performed, as coregister_with_nuth_and_kaab
+
+    :param name: coregistration_method name
+    :type name: str
+    :return: registering decorator
+    :rtype: Callable
+    """
+
+    def register(func: Callable) -> Callable:
+        COREGISTRATION_METHODS[name] = func
+        return func
+
+    return register
+
 
 def coregister_with_nuth_and_kaab(
     dem: xr.Dataset,
@@ -48,6 +89,14 @@ def coregister_with_nuth_and_kaab(
     init_disp_y: int = 0,
     tmp_dir: str = ".",
     nb_iters: int = 6,
+    min_shift_increment: float = None,
+    min_nmad_gain: float = None,
+    sampling_max_points: int = None,
+    sampling_ratio: float = None,
+    sampling_seed: int = 0,
+    resampling: str = "bilinear",
+    plot: str = "full",
+    nb_threads: int = 1,
 ):
     """
     Compute x and y offsets between two DEMs
@@ -66,9 +115,33 @@ def coregister_with_nuth_and_kaab(
     :type init_disp_y: int
     :param tmp_dir: directory path to temporary results (as Nuth & Kaab plots)
     :type tmp_dir: str
-    :param nb_iters: Nuth and Kaab number of iterations (default 6)
+    :param nb_iters: Nuth and Kaab maximum number of iterations (default 6)
     :type nb_iters: int
-    :return: mean shifts (x and y), and coregistered DEMs
+    :param min_shift_increment: Nuth and Kaab stops when an iteration
+            shift is below it, in pixels (None to disable)
+    :type min_shift_increment: float or None
+    :param min_nmad_gain: Nuth and Kaab stops when an iteration decreases
+            the differences NMAD by less than it, in percent (None to disable)
+    :type min_nmad_gain: float or None
+    :param sampling_max_points: Nuth and Kaab estimates the shifts
+            on a random sample of at most this number of valid pixels
+            (None to disable)
+    :type sampling_max_points: int or None
+    :param sampling_ratio: Nuth and Kaab estimates the shifts
+            on a random sample of at most this ratio of the valid pixels
+            (None to disable)
+    :type sampling_ratio: float or None
+    :param sampling_seed: Nuth and Kaab random sample seed
+    :type sampling_seed: int
+    :param resampling: Nuth and Kaab slave DEM resampling,
+            'bilinear' or 'spline'
+    :type resampling: str
+    :param plot: Nuth and Kaab plots level, 'none', 'summary' or 'full'
+    :type plot: str
+    :param nb_threads: Nuth and Kaab iterations threads number
+    :type nb_threads: int
+    :return: mean shifts (x and y), coregistered DEMs
+            and number of iterations performed
     """
 
     # Resample images to pre-coregistered geometry according to the initial disp
@@ -80,25 +153,485 @@ def coregister_with_nuth_and_kaab(
 
     # Compute nuth and kaab coregistration
     # TODO : check init_dh coherence in demcompare code (saved in __init__.py)
+    with BlockPool(nb_threads) as pool:
+        (
+            x_off,
+            y_off,
+            z_off,
+            coreg_dem,
+            coreg_ref,
+            _,
+            final_dh,
+            nb_iters_done,
+        ) = nuth_kaab_lib(
+            dem,
+            ref,
+            outdir_plot=tmp_dir,
+            nb_iters=nb_iters,
+            min_shift_increment=min_shift_increment,
+            min_nmad_gain=min_nmad_gain,
+            sampling_max_points=sampling_max_points,
+            sampling_ratio=sampling_ratio,
+            sampling_seed=sampling_seed,
+            resampling=resampling,
+            plot=plot,
+            pool=pool,
+        )
+
+    # Change the georef-origin of nk_a3d_libAPI's coreg DEMs
+    # Translate the georef-origin of coreg DEMs based on x_off and y_off values
+    #   -> this makes both dems be on the same intermediate georef origin
+    #
+    coreg_dem = translate(coreg_dem, x_off, -y_off)
+    coreg_ref = translate(coreg_ref, x_off, -y_off)
+    final_dh = translate(final_dh, x_off, -y_off)
+
+    # Eventually we return nuth and kaab results :
+    return (
+        x_off,
+        y_off,
+        z_off,
+        coreg_dem,
+        coreg_ref,
+        final_dh,
+        nb_iters_done,
+    )
+
+
+def block_mean(data: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Downsample an array by the mean of its factor x factor blocks,
+    ignoring nan values (blocks without valid value are nan).
+    The last rows and columns not filling a block are dropped.
+
+    :param data: array to downsample
+    :type data: np.ndarray
+    :param factor: downsampling factor
+    :type factor: int
+    :return: downsampled array
+    :rtype: np.ndarray
+    """
+    nb_rows, nb_cols = data.shape[0] // factor, data.shape[1] // factor
+    blocks = data[: nb_rows * factor, : nb_cols * factor].reshape(
+        nb_rows, factor, nb_cols, factor
+    )
+    valid = np.isfinite(blocks)
+    nb_valid = np.count_nonzero(valid, axis=(1, 3))
+    block_sum = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (block_sum / nb_valid).astype(np.float32)
+
+
+def resample_coregistered(
+    dem: xr.Dataset,
+    ref: xr.Dataset,
+    init_disp_x: int,
+    init_disp_y: int,
+    x_off: float,
+    y_off: float,
+    resampling: str = "bilinear",
+) -> Tuple[xr.Dataset, xr.Dataset, xr.Dataset]:
+    """
+    Coregistered DEMs and final differences of known offsets,
+    without estimating them (as the coregistration outputs)
+
+    :param dem: master dem
+    :type dem: xr.Dataset
+    :param ref: slave dem
+    :type ref: xr.Dataset
+    :param init_disp_x: initial x disparity in pixel
+    :type init_disp_x: int
+    :param init_disp_y: initial y disparity in pixel
+    :type init_disp_y: int
+    :param x_off: x offset from the initial disparity in pixel
+    :type x_off: float
+    :param y_off: y offset from the initial disparity in pixel,
+            north oriented
+    :type y_off: float
+    :param resampling: slave DEM resampling, 'bilinear' or 'spline'
+    :type resampling: str
+    :return: coreg_dem, coreg_ref and final_dh
+    :rtype: xr.Dataset, xr.Dataset, xr.Dataset
+    """
+    if init_disp_x != 0 or init_disp_y != 0:
+        dem, ref = translate_to_coregistered_geometry(
+            dem, ref, init_disp_x, init_disp_y
+        )
+    coreg_ref, coreg_dem = resample_to_shift(
+        ShiftInterpolator(ref["im"].data, resampling=resampling),
+        dem["im"].data,
+        x_off,
+        y_off,
+    )
+    coreg_dem = read_img_from_array(coreg_dem, from_dataset=dem, no_data=-32768)
+    final_dh = read_img_from_array(
+        coreg_ref - coreg_dem["im"].data,
+        from_dataset=dem,
+        no_data=-32768,
+        copy_array=False,
+    )
+    coreg_ref = read_img_from_array(coreg_ref, from_dataset=dem, no_data=-32768)
+
+    return (
+        translate(coreg_dem, x_off, -y_off),
+        translate(coreg_ref, x_off, -y_off),
+        translate(final_dh, x_off, -y_off),
+    )
+
+
+def slope_image(data: np.ndarray) -> np.ndarray:
+    """
+    Zero mean slope of a DEM, 0 where it is unknown,
+    as phase correlation input (insensitive to elevation biases)
+
+    :param data: DEM
+    :type data: np.ndarray
+    :return: slope image
+    :rtype: np.ndarray
+    """
+    grad_rows, grad_cols = np.gradient(data.astype(np.float64))
+    slope = np.hypot(grad_rows, grad_cols)
+    valid = np.isfinite(slope)
+    if not np.any(valid):
+        return np.zeros(slope.shape)
+    return np.where(valid, slope - np.mean(slope[valid]), 0)
+
+
+def phase_correlation(
+    dem_data: np.ndarray, ref_data: np.ndarray
+) -> Tuple[float, float]:
+    """
+    Shift d such that ref_data(p) = dem_data(p - d), by FFT phase
+    correlation of their slopes, with a parabolic subpixel refinement
+
+    :param dem_data: master DEM
+    :type dem_data: np.ndarray
+    :param ref_data: slave DEM, of dem_data shape
+    :type ref_data: np.ndarray
+    :return: rows and columns shifts
+    :rtype: float, float
+    """
+    # Windowed slopes, against the FFT periodic edges
+    window = np.outer(
+        np.hanning(dem_data.shape[0]), np.hanning(dem_data.shape[1])
+    )
+    dem_image = slope_image(dem_data) * window
+    ref_image = slope_image(ref_data) * window
+
+    # Normalized cross power spectrum: its inverse peaks at the shift
+    cross_power = np.fft.rfft2(ref_image) * np.conj(np.fft.rfft2(dem_image))
+    cross_power /= np.maximum(np.abs(cross_power), np.finfo(np.float64).tiny)
+    correlation = np.fft.irfft2(cross_power, s=dem_image.shape)
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+
+    shifts = []
+    for axis, size in enumerate(correlation.shape):
+        # parabola through the peak and its neighbours along the axis
+        neighbours = []
+        for step in (-1, 0, 1):
+            idx = list(peak)
+            idx[axis] = (idx[axis] + step) % size
+            neighbours.append(correlation[tuple(idx)])
+        curvature = neighbours[0] - 2 * neighbours[1] + neighbours[2]
+        subpixel = 0.0
+        if curvature < 0:
+            subpixel = 0.5 * (neighbours[0] - neighbours[2]) / curvature
+        shift = peak[axis] if peak[axis] <= size // 2 else peak[axis] - size
+        shifts.append(shift + subpixel)
+
+    return shifts[0], shifts[1]
+
+
+def estimate_initial_disparity(
+    dem: xr.Dataset,
+    ref: xr.Dataset,
+    max_size: int = PHASE_CORRELATION_MAX_SIZE,
+) -> Tuple[int, int]:
+    """
+    Estimate the initial disparity (as plani_opts disp_init)
+    by phase correlation of the DEMs downsampled to at most
+    max_size pixels rows and columns, refined by phase correlation
+    of a full resolution max_size window.
+    The coregistration refines it further.
+
+    :param dem: master dem
+    :type dem: xr.Dataset
+    :param ref: slave dem, on the dem grid
+    :type ref: xr.Dataset
+    :param max_size: phase correlated images maximum size
+    :type max_size: int
+    :return: x and y disparities, in dem pixels
+    :rtype: int, int
+    """
+    shape = (
+        min(dem["im"].shape[0], ref["im"].shape[0]),
+        min(dem["im"].shape[1], ref["im"].shape[1]),
+    )
+    dem_data = np.asarray(dem["im"].data[: shape[0], : shape[1]])
+    ref_data = np.asarray(ref["im"].data[: shape[0], : shape[1]])
+
+    # Whole DEMs downsampled phase correlation
+    factor = max(1, int(np.ceil(max(shape) / max_size)))
+    shifts = phase_correlation(
+        block_mean(dem_data, factor) if factor > 1 else dem_data,
+        block_mean(ref_data, factor) if factor > 1 else ref_data,
+    )
+    disparity = [int(round(shift * factor)) for shift in shifts]
+    if factor == 1:
+        return disparity[1], disparity[0]
+
+    # Full resolution refinement, on the central dem window
+    # whose shifted window is inside ref
+    windows = []
+    for axis, size in enumerate(shape):
+        first = max(0, -disparity[axis])
+        last = min(size, size - disparity[axis]) - max_size
+        if last < first:
+            return disparity[1], disparity[0]
+        start = (first + last) // 2
+        windows.append((start, start + max_size))
+    (row_start, row_stop), (col_start, col_stop) = windows
+    residual_shifts = phase_correlation(
+        dem_data[row_start:row_stop, col_start:col_stop],
+        ref_data[
+            row_start + disparity[0] : row_stop + disparity[0],
+            col_start + disparity[1] : col_stop + disparity[1],
+        ],
+    )
+    disparity = [
+        shift + int(round(residual))
+        for shift, residual in zip(disparity, residual_shifts)
+    ]
+
+    return disparity[1], disparity[0]
+
+
+def coregister_with_nuth_and_kaab_pyramid(
+    dem: xr.Dataset,
+    ref: xr.Dataset,
+    init_disp_x: int = 0,
+    init_disp_y: int = 0,
+    tmp_dir: str = ".",
+    nb_iters: int = 6,
+    nb_levels: int = 3,
+    nb_final_iters: int = 2,
+    nb_threads: int = 1,
+    **nuth_kaab_kwargs,
+):
+    """
+    Compute x and y offsets between two DEMs
+    using Nuth and Kaab (2011) algorithm from coarse to fine resolution:
+    the offset is estimated on DEMs downsampled by 2**nb_levels,
+    then refined on each finer level (downsampled by 2**(nb_levels-1),
+    ..., 2), and eventually refined at full resolution
+    by coregister_with_nuth_and_kaab, initialized by the coarse offset.
+
+    Coarse levels too small for the estimation are skipped.
+
+    :param dem: master dem
+    :type dem: demxarray Dataset
+    :param ref: xarray Dataset, slave dem
+    :type ref: demxarray Dataset
+    :param init_disp_x: initial x disparity in pixel
+    :type init_disp_x: int
+    :param init_disp_y: initial y disparity in pixel
+    :type init_disp_y: int
+    :param tmp_dir: directory path to temporary results (as Nuth & Kaab plots)
+    :type tmp_dir: str
+    :param nb_iters: Nuth and Kaab maximum number of iterations
+            on each coarse level (default 6)
+    :type nb_iters: int
+    :param nb_levels: number of coarse levels (default 3)
+    :type nb_levels: int
+    :param nb_final_iters: Nuth and Kaab maximum number of iterations
+            at full resolution (default 2)
+    :type nb_final_iters: int
+    :param nb_threads: Nuth and Kaab iterations threads number
+    :type nb_threads: int
+    :param nuth_kaab_kwargs: convergence, sampling, resampling
+            and plot options
+            of coregister_with_nuth_and_kaab
+    :return: mean shifts (x and y) relative to the initial disparity,
+            coregistered DEMs and number of iterations performed
+    """
+    dem_data = np.asarray(dem["im"].data)
+    ref_data = np.asarray(ref["im"].data)
+
+    # Offset as 'dem + (x,y) = ref', in full resolution pixels
+    # (y north oriented, opposite to the disparity)
+    x_off, y_off = float(init_disp_x), float(-init_disp_y)
+    nb_iters_done = 0
+    with BlockPool(nb_threads) as pool:
+        for level in range(nb_levels, 0, -1):
+            factor = 2**level
+
+            # Crop both DEMs to their overlap at the current integer offset
+            col_off, row_off = int(round(x_off)), int(round(-y_off))
+            row_start = max(0, -row_off)
+            row_stop = min(dem_data.shape[0], ref_data.shape[0] - row_off)
+            col_start = max(0, -col_off)
+            col_stop = min(dem_data.shape[1], ref_data.shape[1] - col_off)
+            dem_window = (
+                slice(row_start, row_stop),
+                slice(col_start, col_stop),
+            )
+            ref_window = (
+                slice(row_start + row_off, row_stop + row_off),
+                slice(col_start + col_off, col_stop + col_off),
+            )
+            coarse_dem = block_mean(dem_data[dem_window], factor)
+            coarse_ref = block_mean(ref_data[ref_window], factor)
+            if min(coarse_dem.shape) < PYRAMID_MIN_SIZE:
+                print(
+                    "Nuth & Kaab pyramid: level 1/{} skipped"
+                    " (too small)".format(factor)
+                )
+                continue
+            print("Nuth & Kaab pyramid: level 1/{}".format(factor))
+
+            # plots directory of the level, only if plots are written
+            level_dir = None
+            if nuth_kaab_kwargs.get("plot", "full") != "none":
+                level_dir = os.path.join(
+                    tmp_dir, "pyramid_level_{}".format(factor)
+                )
+                os.makedirs(level_dir, exist_ok=True)
+            (
+                level_x_off,
+                level_y_off,
+                _,
+                _,
+                _,
+                _,
+                _,
+                level_iters,
+            ) = nuth_kaab_lib(
+                read_img_from_array(
+                    coarse_dem, from_dataset=dem, copy_array=False
+                ),
+                read_img_from_array(
+                    coarse_ref, from_dataset=ref, copy_array=False
+                ),
+                outdir_plot=level_dir,
+                nb_iters=nb_iters,
+                pool=pool,
+                **nuth_kaab_kwargs,
+            )
+            x_off = col_off + level_x_off * factor
+            y_off = -row_off + level_y_off * factor
+            nb_iters_done += level_iters
+
+    # Full resolution refinement from the integer coarse offset
+    disp_x, disp_y = int(round(x_off)), int(round(-y_off))
     (
         x_off,
         y_off,
         z_off,
         coreg_dem,
         coreg_ref,
-        _,
         final_dh,
-    ) = nuth_kaab_lib(dem, ref, outdir_plot=tmp_dir, nb_iters=nb_iters)
+        final_iters,
+    ) = coregister_with_nuth_and_kaab(
+        dem,
+        ref,
+        init_disp_x=disp_x,
+        init_disp_y=disp_y,
+        tmp_dir=tmp_dir,
+        nb_iters=nb_final_iters,
+        nb_threads=nb_threads,
+        **nuth_kaab_kwargs,
+    )
+
+    return (
+        x_off + disp_x - init_disp_x,
+        y_off - disp_y + init_disp_y,
+        z_off,
+        coreg_dem,
+        coreg_ref,
+        final_dh,
+        nb_iters_done + final_iters,
+    )
+
+
+def coregister_with_least_squares(
+    dem: xr.Dataset,
+    ref: xr.Dataset,
+    init_disp_x: int = 0,
+    init_disp_y: int = 0,
+    nb_iters: int = 6,
+    min_shift_increment: float = None,
+    sampling_max_points: int = None,
+    sampling_ratio: float = None,
+    sampling_seed: int = 0,
+    resampling: str = "bilinear",
+    nb_threads: int = 1,
+):
+    """
+    Compute x, y and z offsets between two DEMs by least squares
+    (see least_squares_coregistration), with the outputs
+    of coregister_with_nuth_and_kaab
+
+    :param dem: master dem
+    :type dem: demxarray Dataset
+    :param ref: xarray Dataset, slave dem
+    :type ref: demxarray Dataset
+    :param init_disp_x: initial x disparity in pixel
+    :type init_disp_x: int
+    :param init_disp_y: initial y disparity in pixel
+    :type init_disp_y: int
+    :param nb_iters: maximum number of iterations (default 6)
+    :type nb_iters: int
+    :param min_shift_increment: iterations stop when an iteration
+            shift is below it, in pixels (None to disable)
+    :type min_shift_increment: float or None
+    :param sampling_max_points: maximum number of sampled valid pixels
+    :type sampling_max_points: int or None
+    :param sampling_ratio: maximum ratio of sampled valid pixels
+    :type sampling_ratio: float or None
+    :param sampling_seed: random sample seed
+    :type sampling_seed: int
+    :param resampling: slave DEM resampling, 'bilinear' or 'spline'
+    :type resampling: str
+    :param nb_threads: threads number
+    :type nb_threads: int
+    :return: mean shifts (x and y), coregistered DEMs
+            and number of iterations performed
+    """
+
+    # Resample images to pre-coregistered geometry according to the initial disp
+    if init_disp_x != 0 or init_disp_y != 0:
+
+        dem, ref = translate_to_coregistered_geometry(
+            dem, ref, init_disp_x, init_disp_y
+        )
+
+    with BlockPool(nb_threads) as pool:
+        (
+            x_off,
+            y_off,
+            z_off,
+            coreg_dem,
+            coreg_ref,
+            _,
+            final_dh,
+            nb_iters_done,
+        ) = least_squares_lib(
+            dem,
+            ref,
+            nb_iters=nb_iters,
+            min_shift_increment=min_shift_increment,
+            sampling_max_points=sampling_max_points,
+            sampling_ratio=sampling_ratio,
+            sampling_seed=sampling_seed,
+            resampling=resampling,
+            pool=pool,
+        )
 
-    # Change the georef-origin of nk_a3d_libAPI's coreg DEMs
     # Translate the georef-origin of coreg DEMs based on x_off and y_off values
-    #   -> this makes both dems be on the same intermediate georef origin
-    #
     coreg_dem = translate(coreg_dem, x_off, -y_off)
     coreg_ref = translate(coreg_ref, x_off, -y_off)
     final_dh = translate(final_dh, x_off, -y_off)
 
-    # Eventually we return nuth and kaab results :
     return (
         x_off,
         y_off,
@@ -106,6 +639,129 @@ def coregister_with_nuth_and_kaab(
         coreg_dem,
         coreg_ref,
         final_dh,
+        nb_iters_done,
+    )
+
+
+@coregistration_method("nuth_kaab")
+def nuth_kaab_method(
+    cfg: Dict, dem: xr.Dataset, ref: xr.Dataset, nb_iters: int
+):
+    """
+    nuth_kaab coregistration method, see coregistration_method
+
+    :param cfg: configuration dictionary
+    :type cfg: Dict
+    :param dem: dem raster
+    :type dem: xr.Dataset
+    :param ref: reference dem raster
+    :type ref: xr.Dataset
+    :param nb_iters: maximum number of iterations
+    :type nb_iters: int
+    :return: offsets, coregistered DEMs and number of iterations performed
+    """
+    return coregister_with_nuth_and_kaab(
+        dem,
+        ref,
+        init_disp_x=cfg["plani_opts"]["disp_init"]["x"],
+        init_disp_y=cfg["plani_opts"]["disp_init"]["y"],
+        tmp_dir=os.path.join(
+            cfg["outputDir"], get_out_dir("nuth_kaab_tmp_dir")
+        ),
+        nb_iters=nb_iters,
+        min_shift_increment=cfg["plani_opts"][
+            "coregistration_min_shift_increment"
+        ],
+        min_nmad_gain=cfg["plani_opts"]["coregistration_min_nmad_gain"],
+        sampling_max_points=cfg["plani_opts"][
+            "coregistration_sampling_max_points"
+        ],
+        sampling_ratio=cfg["plani_opts"]["coregistration_sampling_ratio"],
+        sampling_seed=cfg["plani_opts"]["coregistration_sampling_seed"],
+        resampling=cfg["plani_opts"]["coregistration_resampling"],
+        plot=cfg["plani_opts"]["coregistration_plot"],
+        nb_threads=cfg["plani_opts"]["coregistration_threads"],
+    )
+
+
+@coregistration_method("nuth_kaab_pyramid")
+def nuth_kaab_pyramid_method(
+    cfg: Dict, dem: xr.Dataset, ref: xr.Dataset, nb_iters: int
+):
+    """
+    nuth_kaab_pyramid coregistration method, see coregistration_method
+
+    :param cfg: configuration dictionary
+    :type cfg: Dict
+    :param dem: dem raster
+    :type dem: xr.Dataset
+    :param ref: reference dem raster
+    :type ref: xr.Dataset
+    :param nb_iters: maximum number of iterations of each coarse level
+    :type nb_iters: int
+    :return: offsets, coregistered DEMs and number of iterations performed
+    """
+    return coregister_with_nuth_and_kaab_pyramid(
+        dem,
+        ref,
+        init_disp_x=cfg["plani_opts"]["disp_init"]["x"],
+        init_disp_y=cfg["plani_opts"]["disp_init"]["y"],
+        tmp_dir=os.path.join(
+            cfg["outputDir"], get_out_dir("nuth_kaab_tmp_dir")
+        ),
+        nb_iters=nb_iters,
+        nb_levels=cfg["plani_opts"]["coregistration_pyramid_levels"],
+        nb_final_iters=cfg["plani_opts"][
+            "coregistration_pyramid_final_iterations"
+        ],
+        min_shift_increment=cfg["plani_opts"][
+            "coregistration_min_shift_increment"
+        ],
+        min_nmad_gain=cfg["plani_opts"]["coregistration_min_nmad_gain"],
+        sampling_max_points=cfg["plani_opts"][
+            "coregistration_sampling_max_points"
+        ],
+        sampling_ratio=cfg["plani_opts"]["coregistration_sampling_ratio"],
+        sampling_seed=cfg["plani_opts"]["coregistration_sampling_seed"],
+        resampling=cfg["plani_opts"]["coregistration_resampling"],
+        plot=cfg["plani_opts"]["coregistration_plot"],
+        nb_threads=cfg["plani_opts"]["coregistration_threads"],
+    )
+
+
+@coregistration_method("least_squares")
+def least_squares_method(
+    cfg: Dict, dem: xr.Dataset, ref: xr.Dataset, nb_iters: int
+):
+    """
+    least_squares coregistration method, see coregistration_method
+
+    :param cfg: configuration dictionary
+    :type cfg: Dict
+    :param dem: dem raster
+    :type dem: xr.Dataset
+    :param ref: reference dem raster
+    :type ref: xr.Dataset
+    :param nb_iters: maximum number of iterations
+    :type nb_iters: int
+    :return: offsets, coregistered DEMs and number of iterations performed
+    """
+    return coregister_with_least_squares(
+        dem,
+        ref,
+        init_disp_x=cfg["plani_opts"]["disp_init"]["x"],
+        init_disp_y=cfg["plani_opts"]["disp_init"]["y"],
+        nb_iters=nb_iters,
+        min_shift_increment=cfg["plani_opts"][
+            "coregistration_min_shift_increment"
+        ],
+        sampling_max_points=cfg["plani_opts"][
+            "coregistration_sampling_max_points"
+        ],
+        sampling_ratio=cfg["plani_opts"]["coregistration_sampling_ratio"],
+        sampling_seed=cfg["plani_opts"]["coregistration_sampling_seed"],
+        resampling=cfg["plani_opts"]["coregistration_resampling"],
+        nb_threads=cfg["plani_opts"]["coregistration_threads"],
     )
 
 
@@ -139,40 +795,77 @@ def coregister_and_compute_alti_diff(
         # Default to 6 iterations
         nb_iters = 6
 
-    if cfg["plani_opts"]["coregistration_method"] == "nuth_kaab":
+    if cfg["plani_opts"]["coregistration_method"] not in COREGISTRATION_METHODS:
+        raise NameError("coregistration method unsupported")
+
+    # Coregistration results of a previous run on the same inputs
+    cache, cache_key, cached = None, None, None
+    if cfg["plani_opts"]["coregistration_cache_dir"] is not None:
+        cache = CoregistrationCache(
+            cfg["plani_opts"]["coregistration_cache_dir"],
+            max_size=cfg["plani_opts"]["coregistration_cache_max_size"],
+        )
+        cache_key = cache.key(cfg)
+        cached = cache.load(cache_key)
+
+    if cached is not None:
+        print("Coregistration found in cache: {}".format(cache_key))
+        cfg["plani_opts"]["disp_init"] = cached["disp_init"]
+        dx_nuth, dy_nuth = cached["dx"], cached["dy"]
+        nb_iters_done = cached["nb_iterations"]
+        if cached["rasters"] is not None:
+            coreg_dem, coreg_ref, final_dh = (
+                read_intermediate_img(cached["rasters"][name])
+                for name in ("coreg_dem", "coreg_ref", "final_dh")
+            )
+        else:
+            coreg_dem, coreg_ref, final_dh = resample_coregistered(
+                dem,
+                ref,
+                cfg["plani_opts"]["disp_init"]["x"],
+                cfg["plani_opts"]["disp_init"]["y"],
+                dx_nuth,
+                dy_nuth,
+                resampling=cfg["plani_opts"]["coregistration_resampling"],
+            )
+    else:
+        # Estimate the initial disparity if not given
+        if cfg["plani_opts"]["disp_init"] == "auto":
+            disp_x, disp_y = estimate_initial_disparity(dem, ref)
+            print(
+                "Initial disparity estimated by phase correlation:"
+                " x = {}, y = {}".format(disp_x, disp_y)
+            )
+            cfg["plani_opts"]["disp_init"] = {"x": disp_x, "y": disp_y}
+
         (
             dx_nuth,
             dy_nuth,
-            dz_nuth,  # pylint:disable=unused-variable
+            _,
             coreg_dem,
             coreg_ref,
             final_dh,
-        ) = coregister_with_nuth_and_kaab(
-            dem,
-            ref,
-            init_disp_x=cfg["plani_opts"]["disp_init"]["x"],
-            init_disp_y=cfg["plani_opts"]["disp_init"]["y"],
-            tmp_dir=os.path.join(
-                cfg["outputDir"], get_out_dir("nuth_kaab_tmp_dir")
-            ),
-            nb_iters=nb_iters,
+            nb_iters_done,
+        ) = COREGISTRATION_METHODS[cfg["plani_opts"]["coregistration_method"]](
+            cfg, dem, ref, nb_iters
         )
-        z_bias = np.nanmean(final_dh["im"].data)
-    else:
-        raise NameError("coregistration method unsupported")
+    z_bias = np.nanmean(final_dh["im"].data)
 
     # Saves output coreg DEM to file system
-    coreg_dem = save_tif(
+    coreg_dem = save_intermediate_img(
         coreg_dem,
         os.path.join(cfg["outputDir"], get_out_file_path("coreg_DEM.tif")),
+        intermediate_format=cfg["plani_opts"]["intermediate_format"],
     )
-    coreg_ref = save_tif(
+    coreg_ref = save_intermediate_img(
         coreg_ref,
         os.path.join(cfg["outputDir"], get_out_file_path("coreg_REF.tif")),
+        intermediate_format=cfg["plani_opts"]["intermediate_format"],
     )
-    final_dh = save_tif(
+    final_dh = save_intermediate_img(
         final_dh,
         os.path.join(cfg["outputDir"], get_out_file_path("final_dh.tif")),
+        intermediate_format=cfg["plani_opts"]["intermediate_format"],
     )
 
     # Update cfg
@@ -198,6 +891,27 @@ def coregister_and_compute_alti_diff(
         "bias_value": round(dy_bias, 5),
         "unit_bias_value": coreg_dem.attrs["plani_unit"].name,
     }
+    cfg["plani_results"]["nb_iterations"] = nb_iters_done
+
+    if cache is not None and cached is None:
+        cache.store(
+            cache_key,
+            {
+                "disp_init": cfg["plani_opts"]["disp_init"],
+                "dx": dx_nuth,
+                "dy": dy_nuth,
+                "nb_iterations": nb_iters_done,
+            },
+            rasters=(
+                {
+                    "coreg_dem": coreg_dem.attrs["input_img"],
+                    "coreg_ref": coreg_ref.attrs["input_img"],
+                    "final_dh": final_dh.attrs["input_img"],
+                }
+                if cfg["plani_opts"]["coregistration_cache_rasters"]
+                else None
+            ),
+        )
 
     # -> for the coordinate bounds to apply the offsets
     #    to the original DSM with GDAL
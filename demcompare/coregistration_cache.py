@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains the coregistration results cache, shared by runs
+on the same inputs: entries are keyed by the inputs files contents,
+their reading options (roi, nodata, geoid, ...) and the plani_opts
+affecting the coregistration results.
+
+Concurrent runs may share a cache directory: entries are renamed
+in place and out of place atomically, the files digests are kept
+in one file per input file, and the entries used since the current
+run start (see start_run) are never evicted, their rasters being
+possibly read.
+"""
+
+# Standard imports
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List
+
+# DEMcompare imports
+from .output_writer import wait_output
+
+# Cache format version, part of the entries keys
+CACHE_VERSION = 1
+# plani_opts not affecting the coregistration results
+CACHE_IGNORED_PLANI_OPTS = (
+    "coregistration_cache_dir",
+    "coregistration_cache_rasters",
+    "coregistration_cache_max_size",
+    "coregistration_plot",
+    "coregistration_threads",
+    "intermediate_format",
+)
+# Files digests directory, one file per input file path
+DIGESTS_DIR = "digests"
+# Entry results file, written last
+ENTRY_FILE = "coregistration.json"
+# Files digests reading chunk size (bytes)
+DIGEST_CHUNK_SIZE = 4 * 1024 * 1024
+# Entries modification times tolerance (s), the file system clock
+# being coarser than time.time()
+MTIME_TOLERANCE = 1.0
+
+# Start time of the current run, entries used since are never evicted
+CURRENT_RUN = {"start": time.time()}
+
+
+def start_run(run_start: float = None) -> float:
+    """
+    Set the start time of the current run: the entries used since
+    (by this process or by concurrent ones) are never evicted
+
+    :param run_start: run start time (default: now), given to the
+            tiles worker processes of a run
+    :type run_start: float or None
+    :return: run start time
+    :rtype: float
+    """
+    CURRENT_RUN["start"] = time.time() if run_start is None else run_start
+    return CURRENT_RUN["start"]
+
+
+class CoregistrationCache:
+    """
+    Coregistration results cache directory.
+
+    Each entry is a sub directory named by its key, holding
+    the coregistration results (ENTRY_FILE) and optionally
+    the coregistered rasters. Entries are evicted, least recently
+    used first, when the cache size exceeds its maximum size.
+    """
+
+    def __init__(self, cache_dir: str, max_size: float = None):
+        """
+        Initialization of a coregistration cache
+
+        :param cache_dir: cache directory, created if needed
+        :type cache_dir: str
+        :param max_size: maximum cache size in MB (None for no maximum)
+        :type max_size: float or None
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def file_digest(self, path: str) -> str:
+        """
+        Content digest of a file, computed once per file version
+        (digests are kept by path, size and modification time,
+        in one file per path so that concurrent runs never lose
+        each other's digests)
+
+        :param path: file path
+        :type path: str
+        :return: hexadecimal digest
+        :rtype: str
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        digests_dir = os.path.join(self.cache_dir, DIGESTS_DIR)
+        os.makedirs(digests_dir, exist_ok=True)
+        digest_path = os.path.join(
+            digests_dir,
+            hashlib.blake2b(path.encode(), digest_size=20).hexdigest()
+            + ".json",
+        )
+        version = [stat.st_size, stat.st_mtime_ns]
+        if os.path.isfile(digest_path):
+            with open(digest_path, "r", encoding="utf8") as digest_file:
+                stored = json.load(digest_file)
+            if stored["path"] == path and stored["version"] == version:
+                return stored["digest"]
+
+        digest = hashlib.blake2b()
+        with open(path, "rb") as content:
+            for chunk in iter(lambda: content.read(DIGEST_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        self._write_json(
+            digest_path,
+            {"path": path, "version": version, "digest": digest.hexdigest()},
+        )
+        return digest.hexdigest()
+
+    def key(self, cfg: Dict) -> str:
+        """
+        Entry key of a configuration coregistration
+
+        :param cfg: configuration dictionary
+        :type cfg: Dict
+        :return: hexadecimal key
+        :rtype: str
+        """
+        key_items = {
+            "version": CACHE_VERSION,
+            "plani_opts": {
+                name: value
+                for name, value in cfg["plani_opts"].items()
+                if name not in CACHE_IGNORED_PLANI_OPTS
+            },
+        }
+        for input_name in ("inputDSM", "inputRef"):
+            input_items = {
+                name: value
+                for name, value in cfg[input_name].items()
+                if name != "path"
+            }
+            input_items["digest"] = self.file_digest(cfg[input_name]["path"])
+            geoid_path = cfg[input_name].get("geoid_path")
+            if isinstance(geoid_path, str) and os.path.isfile(geoid_path):
+                input_items["geoid_digest"] = self.file_digest(geoid_path)
+            key_items[input_name] = input_items
+        return hashlib.blake2b(
+            json.dumps(key_items, sort_keys=True, default=str).encode(),
+            digest_size=20,
+        ).hexdigest()
+
+    def entry_dir(self, key: str) -> str:
+        """
+        Directory of an entry
+
+        :param key: entry key
+        :type key: str
+        :return: entry directory
+        :rtype: str
+        """
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key: str) -> Dict:
+        """
+        Results of an entry, with its rasters paths
+        (None if the rasters are not cached)
+
+        :param key: entry key
+        :type key: str
+        :return: entry results, None if the entry is not cached
+        :rtype: Dict or None
+        """
+        entry_path = os.path.join(self.entry_dir(key), ENTRY_FILE)
+        try:
+            # the entry is the most recently used, first, so that
+            # concurrent runs do not evict it from now on
+            os.utime(entry_path)
+            with open(entry_path, "r", encoding="utf8") as entry_file:
+                entry = json.load(entry_file)
+        except FileNotFoundError:
+            # not cached, or evicted meanwhile by a concurrent run
+            return None
+        if entry["rasters"] is not None:
+            entry["rasters"] = {
+                name: os.path.join(self.entry_dir(key), filename)
+                for name, filename in entry["rasters"].items()
+            }
+        return entry
+
+    def store(self, key: str, results: Dict, rasters: Dict[str, str] = None):
+        """
+        Store an entry, then evict the least recently used entries
+        beyond the cache maximum size
+
+        :param key: entry key
+        :type key: str
+        :param results: coregistration results (json serializable)
+        :type results: Dict
+        :param rasters: rasters paths by name, copied in the entry
+                (with their .json sidecar files if any)
+        :type rasters: Dict[str, str] or None
+        """
+        # the entry is written in a temporary directory then renamed,
+        # so that concurrent runs never read a partial entry
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir)
+        try:
+            entry = dict(results, rasters=None)
+            if rasters is not None:
+                entry["rasters"] = {}
+                for name, path in rasters.items():
+                    # the raster may be written in the background
+                    wait_output(path)
+                    for copied_path in (
+                        path,
+                        os.path.splitext(path)[0] + ".json",
+                    ):
+                        if os.path.isfile(copied_path):
+                            shutil.copy2(copied_path, tmp_dir)
+                    entry["rasters"][name] = os.path.basename(path)
+            self._write_json(os.path.join(tmp_dir, ENTRY_FILE), entry)
+            entry_path = os.path.join(self.entry_dir(key), ENTRY_FILE)
+            if os.path.isdir(self.entry_dir(key)) and not os.path.isfile(
+                entry_path
+            ):
+                # remaining directory of an incomplete entry
+                self._remove(key)
+            try:
+                os.replace(tmp_dir, self.entry_dir(key))
+            except OSError:
+                # stored meanwhile by a concurrent run on the same inputs
+                # (same results): the existing entry is kept
+                if not os.path.isfile(entry_path):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=[key])
+
+    def evict(self, keep: List[str] = None):
+        """
+        Remove the least recently used entries until the cache size
+        is below its maximum size, except the entries used since
+        the current run start
+
+        :param keep: keys of entries never removed
+        :type keep: List[str] or None
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            # temporary entries being written are skipped
+            if key.startswith("."):
+                continue
+            entry_path = os.path.join(self.entry_dir(key), ENTRY_FILE)
+            if not os.path.isfile(entry_path):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(self.entry_dir(key), filename))
+                    for filename in os.listdir(self.entry_dir(key))
+                )
+                entries.append((os.path.getmtime(entry_path), size, key))
+            except FileNotFoundError:
+                # evicted meanwhile by a concurrent run
+                continue
+        cache_size = sum(size for _, size, _ in entries)
+        for mtime, size, key in sorted(entries):
+            if cache_size <= self.max_size * 1e6:
+                break
+            if keep is not None and key in keep:
+                continue
+            if mtime >= CURRENT_RUN["start"] - MTIME_TOLERANCE:
+                continue
+            self._remove(key)
+            cache_size -= size
+
+    def _remove(self, key: str):
+        """
+        Remove an entry: it is renamed out of place first, so that
+        concurrent runs never load a partially removed entry
+
+        :param key: entry key
+        :type key: str
+        """
+        trash_dir = tempfile.mkdtemp(prefix=".removed_", dir=self.cache_dir)
+        try:
+            os.replace(self.entry_dir(key), os.path.join(trash_dir, key))
+        except OSError:
+            # already removed by a concurrent run
+            pass
+        shutil.rmtree(trash_dir, ignore_errors=True)
+
+    @staticmethod
+    def _write_json(path: str, content: Dict):
+        """
+        Write a json file atomically
+
+        :param path: json file path
+        :type path: str
+        :param content: json content
+        :type content: Dict
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w", encoding="utf8") as json_file:
+            json.dump(content, json_file, indent=2)
+        os.replace(tmp_path, path)
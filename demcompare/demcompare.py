@@ -76,6 +76,13 @@ def get_parser():
         action="store_true",
         help="choose between plot show and plot save. " "default: plot save",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of tiles processed in parallel processes. "
+        'default: configuration "jobs", else 1',
+    )
     parser.add_argument(
         "--version",
         "-v",
@@ -100,7 +107,11 @@ def main():
     argcomplete.autocomplete(parser)
     args = parser.parse_args()
     demcompare.run(
-        args.config, args.step, display=args.display, loglevel=args.loglevel
+        args.config,
+        args.step,
+        display=args.display,
+        loglevel=args.loglevel,
+        jobs=args.jobs,
     )
 
 
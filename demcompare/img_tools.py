@@ -23,9 +23,13 @@ This module contains functions associated to raster images.
 """
 
 # Standard imports
+import collections
 import copy
+import functools
+import json
 import logging
 import os
+import threading
 from typing import Dict, List, Tuple, Union
 
 # Third party imports
@@ -33,7 +37,7 @@ import numpy as np
 import pyproj
 import rasterio
 import rasterio.crs
-import rasterio.mask
+import rasterio.shutil
 import rasterio.warp
 import rasterio.windows
 import xarray as xr
@@ -43,6 +47,138 @@ from rasterio.warp import Resampling, reproject
 from scipy import interpolate
 from scipy.ndimage import filters
 
+# Optional lazy mode dependency
+try:
+    import dask.array as da
+except ImportError:  # pragma: no cover
+    da = None
+
+# DEMcompare imports
+from .output_writer import submit_output, wait_output, writes_in_background
+
+
+@functools.lru_cache(maxsize=None)
+def to_meter_factor(unit: str) -> float:
+    """
+    Get the factor converting values in unit to meters,
+    resolved once per unit string
+
+    :param unit: unit name understood by astropy (m, cm, km, ...)
+    :type unit: str
+    :return: conversion factor to meters
+    :rtype: float
+    """
+    return float(u.Unit(unit).to(u.meter))
+
+
+def convert_to_meter(
+    data: Union[np.ndarray, "da.Array"], unit: str
+) -> Union[np.ndarray, "da.Array"]:
+    """
+    Convert data in unit to meters.
+    Nothing is done if unit is already meters, float numpy
+    arrays are converted in place: callers must pass arrays
+    they own, not views of arrays still in use.
+
+    :param data: data to convert
+    :type data: np.ndarray or dask array
+    :param unit: unit name of data
+    :type unit: str
+    :return: data in meters
+    :rtype: np.ndarray or dask array
+    """
+    factor = to_meter_factor(str(unit))
+    if factor == 1:
+        return data
+    if isinstance(data, np.ndarray) and np.issubdtype(data.dtype, np.floating):
+        data *= factor
+        return data
+    return data * factor
+
+
+class RasterCache:
+    """
+    LRU cache of opened rasters, so that a raster used several times
+    during a run is opened once.
+    Opening a raster only reads its metadata (size, transform, crs, ...),
+    pixels are read on demand.
+    Entries are keyed by path, modification time and size, so that
+    a file rewritten during the run is reopened.
+    """
+
+    def __init__(self, maxsize: int = 16):
+        """
+        Initialization of an opened rasters cache
+
+        :param maxsize: maximum number of rasters kept opened
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+        self._handles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, path: str) -> rasterio.DatasetReader:
+        """
+        Get the opened raster of path, opening it if not cached.
+        The returned raster is owned by the cache and must not be closed.
+
+        :param path: path to the raster
+        :type path: str
+        :return: opened raster
+        :rtype: rasterio.DatasetReader
+        """
+        # the raster may be an output being written in the background
+        wait_output(path)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        else:
+            # GDAL virtual file systems paths
+            key = (path, None, None)
+        with self._lock:
+            if key in self._handles:
+                self._handles.move_to_end(key)
+                return self._handles[key]
+            img_ds = rasterio.open(path)
+            self._handles[key] = img_ds
+            while len(self._handles) > self.maxsize:
+                _, evicted_ds = self._handles.popitem(last=False)
+                evicted_ds.close()
+        return img_ds
+
+    def close(self):
+        """
+        Close all cached rasters
+        """
+        with self._lock:
+            while self._handles:
+                _, img_ds = self._handles.popitem(last=False)
+                img_ds.close()
+
+
+# Rasters opened during a run, see open_raster and close_rasters
+RASTER_CACHE = RasterCache()
+
+
+def open_raster(path: str) -> rasterio.DatasetReader:
+    """
+    Get the opened raster of path from the run rasters cache.
+    The returned raster must not be closed, see close_rasters.
+
+    :param path: path to the raster
+    :type path: str
+    :return: opened raster
+    :rtype: rasterio.DatasetReader
+    """
+    return RASTER_CACHE.open(path)
+
+
+def close_rasters():
+    """
+    Close all the rasters opened with open_raster, at the end of a run
+    """
+    RASTER_CACHE.close()
+
 
 def read_image(path: str, band: int = 1) -> np.ndarray:
     """
@@ -55,7 +191,7 @@ def read_image(path: str, band: int = 1) -> np.ndarray:
     :return: band array
     :rtype: np.ndarray
     """
-    img_ds = rasterio.open(path)
+    img_ds = open_raster(path)
     data = img_ds.read(band)
     return data
 
@@ -107,7 +243,7 @@ def reproject_dataset(
     :type from_dataset: xr.Dataset
     :param interp: interpolation method
     :type interp: str
-    :return: reprojected dataset
+    :return: reprojected dataset (dask backed if from_dataset is)
     :rtype: xr.Dataset
     """
 
@@ -142,12 +278,68 @@ def reproject_dataset(
     )
 
     source_array = dataset["im"].data
-    dest_array = np.zeros_like(from_dataset["im"].data)
-    dest_array[:, :] = -9999
 
     src_crs = rasterio.crs.CRS.from_dict(dataset.attrs["georef"])
     dst_crs = rasterio.crs.CRS.from_dict(from_dataset.attrs["georef"])
 
+    if da is not None and isinstance(from_dataset["im"].data, da.Array):
+        # Lazy mode: each destination chunk is warped from
+        # the source window it covers only
+        def reproject_block(block, block_info=None):
+            """Reproject the source window covering a destination chunk"""
+            (row_start, row_stop), (col_start, col_stop) = block_info[0][
+                "array-location"
+            ]
+            block_transform = dst_transform * Affine.translation(
+                col_start, row_start
+            )
+            dest_block = np.full(block.shape, np.nan, dtype=block.dtype)
+            try:
+                src_window = roi_to_window(
+                    rasterio.warp.transform_bounds(
+                        dst_crs,
+                        src_crs,
+                        *rasterio.transform.array_bounds(
+                            row_stop - row_start,
+                            col_stop - col_start,
+                            block_transform,
+                        ),
+                    ),
+                    src_transform,
+                    source_array.shape[1],
+                    source_array.shape[0],
+                    margin=2,
+                )
+            except NameError:
+                # chunk outside of the source
+                return dest_block
+            dest_block[:, :] = -9999
+            reproject(
+                source=np.asarray(source_array[src_window.toslices()]),
+                destination=dest_block,
+                src_transform=rasterio.windows.transform(
+                    src_window, src_transform
+                ),
+                src_crs=src_crs,
+                dst_transform=block_transform,
+                dst_crs=dst_crs,
+                resampling=interpolation_method,
+                src_nodata=dataset.attrs["no_data"],
+                dst_nodata=-9999,
+            )
+            dest_block[dest_block == -9999] = np.nan
+            return dest_block
+
+        reprojected_dataset["im"].data = from_dataset["im"].data.map_blocks(
+            reproject_block, dtype=from_dataset["im"].dtype
+        )
+        reprojected_dataset.attrs["no_data"] = dataset.attrs["no_data"]
+
+        return reprojected_dataset
+
+    dest_array = np.zeros_like(from_dataset["im"].data)
+    dest_array[:, :] = -9999
+
     # reproject
     reproject(
         source=source_array,
@@ -169,6 +361,192 @@ def reproject_dataset(
     return reprojected_dataset
 
 
+def roi_to_window(
+    roi: Union[dict, Tuple, List],
+    transform: Affine,
+    width: int,
+    height: int,
+    margin: int = 0,
+) -> rasterio.windows.Window:
+    """
+    Convert a ROI to the rasterio Window of the image it covers.
+    The ROI is either given as image coordinates (dict with
+    x, y, w, h keys) or as georeferenced bounds (dict with left,
+    bottom, right, top keys or (left, bottom, right, top) tuple).
+    The window is the outermost pixels touched by the ROI
+    (floor of offsets, ceiling of ends), expanded by margin pixels
+    on each side and intersected with the image.
+
+    :param roi: region of interest
+    :type roi: dict, Tuple or List
+    :param transform: image transform
+    :type transform: Affine
+    :param width: image width
+    :type width: int
+    :param height: image height
+    :type height: int
+    :param margin: number of pixels to add on each side of the window
+    :type margin: int
+    :return: window within the image
+    :rtype: rasterio.windows.Window
+    """
+    if isinstance(roi, dict) and all(
+        key in roi for key in ["x", "y", "w", "h"]
+    ):
+        col_start, row_start = int(roi["x"]), int(roi["y"])
+        col_stop = col_start + int(roi["w"])
+        row_stop = row_start + int(roi["h"])
+    else:
+        if isinstance(roi, dict):
+            if not all(
+                key in roi for key in ["left", "bottom", "right", "top"]
+            ):
+                raise NameError("ERROR: Not the right conventions for ROI")
+            bounds = (roi["left"], roi["bottom"], roi["right"], roi["top"])
+        else:
+            bounds = tuple(roi)
+        # Corners of the ROI in image coordinates
+        cols, rows = zip(
+            *[
+                ~transform * (x, y)
+                for x in (bounds[0], bounds[2])
+                for y in (bounds[1], bounds[3])
+            ]
+        )
+        col_start, col_stop = int(np.floor(min(cols))), int(np.ceil(max(cols)))
+        row_start, row_stop = int(np.floor(min(rows))), int(np.ceil(max(rows)))
+
+    # Add margin and intersect with the image extent
+    col_start = max(col_start - margin, 0)
+    row_start = max(row_start - margin, 0)
+    col_stop = min(col_stop + margin, width)
+    row_stop = min(row_stop + margin, height)
+    if col_stop <= col_start or row_stop <= row_start:
+        raise NameError("ERROR: ROI does not intersect the image")
+
+    return rasterio.windows.Window(
+        col_start, row_start, col_stop - col_start, row_stop - row_start
+    )
+
+
+def mask_outside_bounds(dataset: xr.Dataset, bounds: Dict) -> xr.Dataset:
+    """
+    Copy of a dataset with nan values out of georeferenced bounds.
+    A pixel is kept if its center is within the bounds (left and top
+    bounds included), so that abutting bounds share no pixel.
+    The number of kept pixels is set as the nb_points attribute,
+    the stats percentages refer to.
+
+    :param dataset: dataset
+    :type dataset: xr.Dataset
+    :param bounds: dict with left, bottom, right, top keys
+    :type bounds: Dict
+    :return: masked dataset
+    :rtype: xr.Dataset
+    """
+    transform = Affine.from_gdal(*dataset["trans"].data[:6])
+    nb_rows, nb_cols = dataset["im"].shape
+    # Pixels centers georeferenced coordinates
+    cols_x, _ = transform * (np.arange(nb_cols) + 0.5, np.full(nb_cols, 0.5))
+    _, rows_y = transform * (np.full(nb_rows, 0.5), np.arange(nb_rows) + 0.5)
+    inside_cols = (cols_x >= bounds["left"]) & (cols_x < bounds["right"])
+    inside_rows = (rows_y <= bounds["top"]) & (rows_y > bounds["bottom"])
+    masked = np.where(
+        inside_rows[:, np.newaxis] & inside_cols[np.newaxis, :],
+        dataset["im"].data,
+        np.nan,
+    )
+    masked_dataset = read_img_from_array(
+        masked,
+        from_dataset=dataset,
+        no_data=dataset.attrs["no_data"],
+        copy_array=False,
+    )
+    masked_dataset.attrs["nb_points"] = int(
+        np.count_nonzero(inside_rows) * np.count_nonzero(inside_cols)
+    )
+    return masked_dataset
+
+
+class LazyBandReader:
+    """
+    Array-like access to a raster band which only reads, at each slicing,
+    the corresponding window of the raster.
+    Used to build dask arrays chunked on the raster internal blocks.
+    """
+
+    ndim = 2
+
+    def __init__(self, img: str, band: int = 1):
+        """
+        Initialization of a lazy band reader
+
+        :param img: path to the image
+        :type img: str
+        :param band: numero of band to read
+        :type band: int
+        """
+        self.img = img
+        self.band = band
+        img_ds = open_raster(img)
+        self.shape = (img_ds.height, img_ds.width)
+        self.dtype = np.dtype(img_ds.dtypes[band - 1])
+        self.block_shape = img_ds.block_shapes[band - 1]
+
+    def __getitem__(self, key: Tuple[slice, slice]) -> np.ndarray:
+        """
+        Read the window of the band given by a (row, col) slices tuple
+
+        :param key: row and col slices
+        :type key: Tuple[slice, slice]
+        :return: window data
+        :rtype: np.ndarray
+        """
+        (row_start, row_stop, _), (col_start, col_stop, _) = [
+            key_slice.indices(size) for key_slice, size in zip(key, self.shape)
+        ]
+        if row_stop <= row_start or col_stop <= col_start:
+            return np.empty(
+                (max(row_stop - row_start, 0), max(col_stop - col_start, 0)),
+                dtype=self.dtype,
+            )
+        # own raster handle: blocks may be read from dask worker threads
+        # and an opened raster must not be shared between threads
+        with rasterio.open(self.img) as img_ds:
+            return img_ds.read(
+                self.band,
+                window=rasterio.windows.Window(
+                    col_start,
+                    row_start,
+                    col_stop - col_start,
+                    row_stop - row_start,
+                ),
+            )
+
+    def to_dask(self, min_chunk_size: int = 512):
+        """
+        Return the band as a dask array, chunked by groups of
+        the raster internal blocks of at least min_chunk_size
+        pixels in each dimension (striped rasters have one row blocks)
+
+        :param min_chunk_size: minimum chunk size in pixels
+        :type min_chunk_size: int
+        :return: lazy band array
+        :rtype: dask.array.Array
+        """
+        if da is None:
+            raise NameError(
+                "ERROR: lazy mode requires dask (pip install dask[array])"
+            )
+        chunks = tuple(
+            min(size, block * int(np.ceil(min_chunk_size / block)))
+            for size, block in zip(self.shape, self.block_shape)
+        )
+        return da.from_array(
+            self, chunks=chunks, meta=np.array((), dtype=self.dtype)
+        )
+
+
 def read_img(
     img: str,
     no_data: float = None,
@@ -176,10 +554,19 @@ def read_img(
     geoid_path: Union[str, None] = None,
     zunit: str = "m",
     load_data: bool = False,
+    roi: Union[dict, Tuple, None] = None,
+    lazy: bool = False,
 ) -> xr.Dataset:
     """
     Read image and transform and return the corresponding xarray.DataSet
 
+    If a roi is given, only the window of the image covered by the roi
+    is read, and the dataset transform is shifted accordingly.
+
+    If lazy is True, the image is not read: the dataset is backed by
+    a dask array chunked on the raster internal blocks, and the nodata,
+    unit and geoid processing are lazy block operations.
+
     :param img: Path to the image
     :type img: str
     :param no_data: no_data value in the image
@@ -192,14 +579,28 @@ def read_img(
     :type zunit: str
     :param load_data: load as dem
     :type load_data: bool
+    :param roi: optional region of interest to read (see roi_to_window)
+    :type roi: dict, Tuple or None
+    :param lazy: dask backed dataset if True (requires dask)
+    :type lazy: bool
     :return: dataset containing the variables :
             - im : 2D (row, col) xarray.DataArray float32
             - trans 1D xarray.DataArray float32
     :rtype: xr.Dataset
     """
-    img_ds = rasterio.open(img)
-    data = img_ds.read(1)
-    transform = img_ds.transform
+    img_ds = open_raster(img)
+    window = rasterio.windows.Window(0, 0, img_ds.width, img_ds.height)
+    if roi is not None:
+        window = roi_to_window(
+            roi, img_ds.transform, img_ds.width, img_ds.height
+        )
+    transform = img_ds.window_transform(window)
+    if lazy:
+        data = LazyBandReader(img).to_dask()[window.toslices()]
+    elif roi is None:
+        data = img_ds.read(1)
+    else:
+        data = img_ds.read(1, window=window)
 
     dataset = create_dataset(
         data,
@@ -210,6 +611,8 @@ def read_img(
         geoid_path=geoid_path,
         zunit=zunit,
         load_data=load_data,
+        img_ds=img_ds,
+        copy=False,
     )
 
     return dataset
@@ -224,6 +627,8 @@ def create_dataset(
     geoid_path: Union[str, None] = None,
     zunit: str = "m",
     load_data: bool = False,
+    img_ds: rasterio.DatasetReader = None,
+    copy: bool = True,
 ) -> xr.Dataset:
     """
     Create dataset from array and transform,
@@ -245,12 +650,20 @@ def create_dataset(
     :type zunit: str
     :param load_data: load as dem
     :type load_data: bool
+    :param img_ds: optional already opened image, to avoid reopening img
+    :type img_ds: rasterio.DatasetReader or None
+    :param copy: copy data if True, else data is used by the dataset
+        (and modified in place) if already float32, which is meant
+        for arrays owned by the caller
+    :type copy: bool
     :return: xarray.DataSet containing the variables :
             - im : 2D (row, col) xarray.DataArray float32
+            (dask backed if data is a dask array)
     :type data: xr.Dataset
     """
 
-    img_ds = rasterio.open(img)
+    if img_ds is None:
+        img_ds = open_raster(img)
 
     # Manage nodata
     if no_data is None:
@@ -267,15 +680,21 @@ def create_dataset(
             data = data[0, :, :]
         if dim_single == 2:
             data = data[:, :, 0]
-    data = data.astype(np.float32)
-    data[data == no_data] = np.nan
+    # without copy, float32 data is modified in place
+    data = data.astype(np.float32, copy=copy)
+    lazy = da is not None and isinstance(data, da.Array)
+    if lazy:
+        # lazy block operation
+        data = da.where(data == no_data, np.nan, data)
+    else:
+        data[data == no_data] = np.nan
 
-    # convert to meter
-    data = ((data * u.Unit(zunit)).to(u.meter)).value
+    # convert to meter (in place if not lazy)
+    data = convert_to_meter(data, zunit)
     new_zunit = u.meter
 
     dataset = xr.Dataset(
-        {"im": (["row", "col"], data.astype(np.float32))},
+        {"im": (["row", "col"], data)},
         coords={
             "row": np.arange(data.shape[0]),
             "col": np.arange(data.shape[1]),
@@ -313,8 +732,11 @@ def create_dataset(
         # If the georef is geoid, add geoid offset
         if georef_grid == "geoid":
             # transform to ellipsoid
-            geoid_offset = get_geoid_offset(dataset, geoid_path)
-            dataset["im"].data += geoid_offset
+            if lazy:
+                dataset["im"].data = add_lazy_geoid_offset(dataset, geoid_path)
+            else:
+                geoid_offset = get_geoid_offset(dataset, geoid_path)
+                dataset["im"].data += geoid_offset
 
     return dataset
 
@@ -323,23 +745,32 @@ def read_img_from_array(
     img_array: np.ndarray,
     from_dataset: xr.Dataset = None,
     no_data: float = None,
+    copy_array: bool = True,
 ) -> xr.Dataset:
     """
     Read image, and return the corresponding xarray.DataSet.
     If from_dataset is None defaults attributes are set.
 
+    img_array is cast to float32 with at most one allocation.
+    If copy_array is False and img_array is already float32, no
+    allocation is done at all: img_array is used (and its nodata
+    values set to nan) in place, which is meant for temporary arrays
+    owned by the caller.
+
     :param img_array: array
     :type img_array: np.ndarray
     :param from_dataset: dataset to copy
     :type from_dataset: xr.Dataset or None
     :param no_data: no_data value in the image
     :type no_data: float or None
+    :param copy_array: copy img_array if True, else use it in place
+    :type copy_array: bool
     :return: xarray.DataSet containing the variables :
             - im : 2D (row, col) xarray.DataArray float32
     :rtype: xr.Dataset
     """
 
-    data = np.copy(img_array)
+    data = img_array.astype(np.float32, copy=copy_array)
 
     # Manage nodata
     if no_data is None:
@@ -349,7 +780,7 @@ def read_img_from_array(
 
     if from_dataset is None:
         dataset = xr.Dataset(
-            {"im": (["row", "col"], data.astype(np.float32))},
+            {"im": (["row", "col"], data)},
             coords={
                 "row": np.arange(data.shape[0]),
                 "col": np.arange(data.shape[1]),
@@ -363,13 +794,13 @@ def read_img_from_array(
         # add nodata
         dataset.attrs["no_data"] = no_data
     else:
-        dataset = copy.deepcopy(from_dataset)
-        dataset["im"] = None
+        # only the small variables and attributes are deep copied,
+        # from_dataset image is not copied
+        dataset = from_dataset.drop_vars(["im", "row", "col"]).copy(deep=True)
+        dataset.attrs = copy.deepcopy(from_dataset.attrs)
         dataset.coords["row"] = np.arange(data.shape[0])
         dataset.coords["col"] = np.arange(data.shape[1])
-        dataset["im"] = xr.DataArray(
-            data=data.astype(np.float32), dims=["row", "col"]
-        )
+        dataset["im"] = xr.DataArray(data=data, dims=["row", "col"])
 
     return dataset
 
@@ -386,10 +817,17 @@ def load_dems(
     ref_zunit: str = "m",
     dem_zunit: str = "m",
     load_data: Union[bool, dict, Tuple] = True,
+    lazy: bool = False,
 ) -> Tuple[xr.Dataset, xr.Dataset]:
     """
     Loads both DEMs
 
+    If lazy is True, both datasets are dask backed (see read_img):
+    the dem window and the ref reprojection are lazy block operations,
+    computed by chunks in bounded memory. Only the reading and the
+    reprojection are chunked: demcompare run loads the datasets for
+    the coregistration, the differences and the stats.
+
     :param ref_path: path to ref dem
     :type ref_path: str
     :param dem_path: path to sec dem
@@ -415,12 +853,14 @@ def load_dems(
     :param load_data: True if dem are to be fully loaded,
             other options are False or a dict roi
     :type load_data: bool, dict or Tuple
+    :param lazy: dask backed datasets if True (requires dask)
+    :type lazy: bool
     :return: ref and dem datasets
     :rtype: xr.Dataset, xr.Dataset
     """
 
     # Get roi of dem
-    src_dem = rasterio.open(dem_path)
+    src_dem = open_raster(dem_path)
     dem_crs = src_dem.crs
 
     dem_trans = src_dem.transform
@@ -477,7 +917,7 @@ def load_dems(
 
     # Get roi of ref
 
-    src_ref = rasterio.open(ref_path)
+    src_ref = open_raster(ref_path)
     ref_crs = src_ref.crs
 
     bounds_ref = src_ref.bounds
@@ -504,19 +944,17 @@ def load_dems(
         min(transformed_dem_bounds[3], transformed_ref_bounds[3]),
     )
 
-    # get  crop
-    polygon_roi = bounding_box_to_polygon(
-        intersection_roi[0],
-        intersection_roi[1],
-        intersection_roi[2],
-        intersection_roi[3],
-    )
-    geom_like_polygon = {"type": "Polygon", "coordinates": [polygon_roi]}
-
-    # crop dem
-    new_cropped_dem, new_cropped_dem_transform = rasterio.mask.mask(
-        src_dem, [geom_like_polygon], all_touched=True, crop=True
+    # crop dem: read the window of the dem covering the intersection
+    dem_window = roi_to_window(
+        intersection_roi, dem_trans, src_dem.width, src_dem.height
     )
+    if lazy:
+        new_cropped_dem = LazyBandReader(dem_path).to_dask()[
+            dem_window.toslices()
+        ]
+    else:
+        new_cropped_dem = src_dem.read(1, window=dem_window)
+    new_cropped_dem_transform = src_dem.window_transform(dem_window)
 
     # create datasets
 
@@ -529,25 +967,52 @@ def load_dems(
         geoid_path=dem_geoid_path,
         zunit=dem_zunit,
         load_data=load_data,
+        img_ds=src_dem,
+        copy=False,
     )
 
-    # full_ref represent a dataset with the full image
-    full_ref = create_dataset(
-        src_ref.read(1),
+    # Only the ref window covering the dem footprint is read,
+    # with a margin so that resampling at the footprint borders
+    # still gets its neighbouring source pixels
+    dem_footprint = rasterio.transform.array_bounds(
+        dem["im"].data.shape[0],
+        dem["im"].data.shape[1],
+        new_cropped_dem_transform,
+    )
+    ref_footprint = rasterio.warp.transform_bounds(
+        dem_crs, ref_crs, *dem_footprint
+    )
+    ref_window = roi_to_window(
+        ref_footprint,
         src_ref.transform,
+        src_ref.width,
+        src_ref.height,
+        margin=2,
+    )
+
+    # cropped_ref represent a dataset with the ref window
+    if lazy:
+        ref_data = LazyBandReader(ref_path).to_dask()[ref_window.toslices()]
+    else:
+        ref_data = src_ref.read(1, window=ref_window)
+    cropped_ref = create_dataset(
+        ref_data,
+        src_ref.window_transform(ref_window),
         ref_path,
         no_data=ref_nodata,
         georef_grid=ref_georef_grid,
         geoid_path=ref_geoid_path,
         zunit=ref_zunit,
         load_data=load_data,
+        img_ds=src_ref,
+        copy=False,
     )
 
     # Reference DEM is reprojected into the sec DEM's georef-grid
     # Crop and resample are done in the reference DEM
-    ref = reproject_dataset(full_ref, dem, interp="bilinear")
+    ref = reproject_dataset(cropped_ref, dem, interp="bilinear")
     # update dataset input_img with ref old value
-    ref.attrs["input_img"] = full_ref.attrs["input_img"]
+    ref.attrs["input_img"] = cropped_ref.attrs["input_img"]
 
     return ref, dem
 
@@ -596,7 +1061,10 @@ def translate(
     :return: translated dataset
     :rtype: xr.Dataset
     """
+    # the transform is copied: a shallow copy shares it with dataset
+    # (and with the datasets created on the same georef-grid)
     dataset_translated = copy.copy(dataset)
+    dataset_translated["trans"] = dataset["trans"].copy(deep=True)
 
     x_off, y_off = pix_to_coord(dataset["trans"].data, y_offset, x_offset)
     dataset_translated["trans"].data[0] = x_off
@@ -664,7 +1132,7 @@ def translate_to_coregistered_geometry(
         dem["trans"].data[5],
     )
     bounds_dem = rasterio.transform.array_bounds(
-        dem["im"].data.shape[1], dem["im"].data.shape[0], transform_dem
+        dem["im"].data.shape[0], dem["im"].data.shape[1], transform_dem
     )
 
     transform_ref = Affine.from_gdal(
@@ -676,7 +1144,7 @@ def translate_to_coregistered_geometry(
         ref["trans"].data[5],
     )
     bounds_ref = rasterio.transform.array_bounds(
-        ref["im"].data.shape[1], ref["im"].data.shape[0], transform_ref
+        ref["im"].data.shape[0], ref["im"].data.shape[1], transform_ref
     )
 
     intersection_roi = (
@@ -686,37 +1154,23 @@ def translate_to_coregistered_geometry(
         min(bounds_dem[3], bounds_ref[3]),
     )
 
-    # get  crop
-    polygon_roi = bounding_box_to_polygon(
-        intersection_roi[0],
-        intersection_roi[1],
-        intersection_roi[2],
-        intersection_roi[3],
-    )
-    geom_like_polygon = {"type": "Polygon", "coordinates": [polygon_roi]}
-
-    # crop dem
-    srs_dem = rasterio.open(
-        " ",
-        mode="w+",
-        driver="GTiff",
-        width=dem["im"].data.shape[1],
-        height=dem["im"].data.shape[0],
-        count=1,
-        dtype=dem["im"].data.dtype,
-        crs=dem.attrs["georef"],
-        transform=transform_dem,
+    # crop dem: slice the window of dem covering the intersection
+    dem_window = roi_to_window(
+        intersection_roi,
+        transform_dem,
+        dem["im"].data.shape[1],
+        dem["im"].data.shape[0],
     )
-    srs_dem.write(dem["im"].data, 1)
-    new_cropped_dem, new_cropped_dem_transform = rasterio.mask.mask(
-        srs_dem, [geom_like_polygon], all_touched=True, crop=True
+    new_cropped_dem = dem["im"].data[dem_window.toslices()]
+    new_cropped_dem_transform = rasterio.windows.transform(
+        dem_window, transform_dem
     )
 
     # create datasets
     reproj_dem = copy.copy(dem)
     reproj_dem["trans"].data = np.array(new_cropped_dem_transform.to_gdal())
     reproj_dem = read_img_from_array(
-        new_cropped_dem[0, :, :],
+        new_cropped_dem,
         from_dataset=reproj_dem,
         no_data=dem.attrs["no_data"],
     )
@@ -728,19 +1182,257 @@ def translate_to_coregistered_geometry(
     return reproj_dem, reproj_ref
 
 
+# Output GeoTIFF profiles, selected with the output_opts configuration:
+# - default: plain striped uncompressed GTiff
+# - compressed: tiled and compressed GTiff
+# - cog: Cloud Optimized GeoTIFF, tiled, compressed and with overviews
+OUTPUT_PROFILES = {
+    "default": {
+        "tiled": False,
+        "blocksize": 512,
+        "compress": None,
+        "overviews": False,
+        "cog": False,
+        "num_threads": "ALL_CPUS",
+    },
+    "compressed": {
+        "tiled": True,
+        "blocksize": 512,
+        "compress": "DEFLATE",
+        "overviews": False,
+        "cog": False,
+        "num_threads": "ALL_CPUS",
+    },
+    "cog": {
+        "tiled": True,
+        "blocksize": 512,
+        "compress": "DEFLATE",
+        "overviews": True,
+        "cog": True,
+        "num_threads": "ALL_CPUS",
+    },
+}
+
+# Output profile of the run, see set_output_profile
+_OUTPUT_PROFILE = dict(OUTPUT_PROFILES["default"])
+
+
+def get_output_profile(output_opts: Dict) -> Dict:
+    """
+    Get the output profile described by output_opts:
+    the output_opts "profile" entry of OUTPUT_PROFILES,
+    updated with the output_opts entries of the profile
+
+    :param output_opts: output options (see initialization_output_opts)
+    :type output_opts: Dict
+    :return: output profile
+    :rtype: Dict
+    """
+    output_profile = dict(OUTPUT_PROFILES[output_opts["profile"]])
+    output_profile.update(
+        {
+            key: value
+            for key, value in output_opts.items()
+            if key in output_profile and value is not None
+        }
+    )
+    return output_profile
+
+
+def set_output_profile(output_opts: Dict):
+    """
+    Set the output profile used by save_tif for the run
+
+    :param output_opts: output options (see initialization_output_opts)
+    :type output_opts: Dict
+    """
+    _OUTPUT_PROFILE.clear()
+    _OUTPUT_PROFILE.update(get_output_profile(output_opts))
+
+
+def get_creation_options(output_profile: Dict, dtype: np.dtype) -> Dict:
+    """
+    Get the GeoTIFF creation options of an output profile
+
+    :param output_profile: output profile
+    :type output_profile: Dict
+    :param dtype: data type of the raster to write
+    :type dtype: np.dtype
+    :return: rasterio creation options
+    :rtype: Dict
+    """
+    creation_options = {
+        "bigtiff": "IF_SAFER",
+        "num_threads": str(output_profile["num_threads"]),
+    }
+    if output_profile["tiled"] or output_profile["cog"]:
+        creation_options.update(
+            {
+                "tiled": True,
+                "blockxsize": output_profile["blocksize"],
+                "blockysize": output_profile["blocksize"],
+            }
+        )
+    if output_profile["compress"] not in (None, "NONE"):
+        creation_options["compress"] = output_profile["compress"]
+        # floating point predictor for elevations,
+        # horizontal differencing for integer maps
+        creation_options["predictor"] = (
+            3 if np.issubdtype(dtype, np.floating) else 2
+        )
+    return creation_options
+
+
+def overview_factors(row: int, col: int, min_size: int = 256) -> List[int]:
+    """
+    Get the overview decimation factors of a raster,
+    down to an overview smaller than min_size
+
+    :param row: raster number of rows
+    :type row: int
+    :param col: raster number of columns
+    :type col: int
+    :param min_size: minimum size of the last overview
+    :type min_size: int
+    :return: decimation factors
+    :rtype: List[int]
+    """
+    factors = []
+    factor = 2
+    while max(row, col) / (factor / 2) > min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def write_tif(
+    data: np.ndarray,
+    filename: str,
+    crs: rasterio.crs.CRS,
+    transform: Affine,
+    no_data: float,
+    output_profile: Dict,
+):
+    """
+    Write a 2D (row, col) or 3D (row, col, band) array in a tiff file,
+    with the layout of output_profile
+
+    :param data: array to write
+    :type data: np.ndarray
+    :param filename: output filename
+    :type filename: str
+    :param crs: output crs
+    :type crs: rasterio.crs.CRS
+    :param transform: output transform
+    :type transform: Affine
+    :param no_data: value of nodata to use (2D arrays only)
+    :type no_data: float
+    :param output_profile: output profile (see get_output_profile)
+    :type output_profile: Dict
+    """
+    creation_options = get_creation_options(output_profile, data.dtype)
+    # COG layout can not be written directly, a tiled GTiff
+    # is written first and then copied as COG
+    tif_filename = filename
+    if output_profile["cog"]:
+        tif_filename = filename + ".tmp.tif"
+        creation_options.pop("compress", None)
+        creation_options.pop("predictor", None)
+
+    if data.ndim == 2:
+        row, col = data.shape
+        with rasterio.open(
+            tif_filename,
+            mode="w+",
+            driver="GTiff",
+            width=col,
+            height=row,
+            count=1,
+            dtype=data.dtype,
+            crs=crs,
+            transform=transform,
+            **creation_options,
+        ) as source_ds:
+            source_ds.nodata = no_data
+            # write by strips of rows: the writer makes a contiguous
+            # copy of what it is given, keep it to one strip
+            for row_start in range(0, row, 1024):
+                row_stop = min(row_start + 1024, row)
+                source_ds.write(
+                    data[row_start:row_stop, :],
+                    1,
+                    window=rasterio.windows.Window(
+                        0, row_start, col, row_stop - row_start
+                    ),
+                )
+            factors = overview_factors(row, col)
+            if output_profile["overviews"] and not output_profile["cog"]:
+                if factors:
+                    source_ds.build_overviews(factors, Resampling.average)
+
+    else:
+        row, col, depth = data.shape
+        with rasterio.open(
+            tif_filename,
+            mode="w+",
+            driver="GTiff",
+            width=col,
+            height=row,
+            count=depth,
+            dtype=data.dtype,
+            crs=crs,
+            transform=transform,
+            **creation_options,
+        ) as source_ds:
+            for dsp in range(1, depth + 1):
+                source_ds.write(data[:, :, dsp - 1], dsp)
+            factors = overview_factors(row, col)
+            if output_profile["overviews"] and not output_profile["cog"]:
+                if factors:
+                    source_ds.build_overviews(factors, Resampling.average)
+
+    if output_profile["cog"]:
+        rasterio.shutil.copy(
+            tif_filename,
+            filename,
+            driver="COG",
+            compress=output_profile["compress"] or "NONE",
+            predictor="YES" if output_profile["compress"] else "NO",
+            blocksize=output_profile["blocksize"],
+            overviews="AUTO" if output_profile["overviews"] else "NONE",
+            resampling="AVERAGE",
+            bigtiff="IF_SAFER",
+            num_threads=str(output_profile["num_threads"]),
+        )
+        os.remove(tif_filename)
+
+
 def save_tif(
-    dataset: xr.Dataset, filename: str, new_array=None, no_data: float = -32768
+    dataset: xr.Dataset,
+    filename: str,
+    new_array=None,
+    no_data: float = -32768,
+    output_profile: Dict = None,
 ) -> xr.Dataset:
     """
     Write a Dataset in a tiff file.
     If new_array is set, new_array is used as data.
 
+    The GeoTIFF layout (tiling, compression, overviews, COG) is given by
+    output_profile, by default the run one (see set_output_profile).
+    The file may be written in the background (see output_writer):
+    the data is then copied, so that it may be modified in place
+    afterwards.
+
     :param dataset: dataset
     :param filename:  output filename
     :param new_array:  new array to write
     :param no_data:  value of nodata to use
+    :param output_profile: output profile (see get_output_profile)
     :return: dataset
     """
+    if output_profile is None:
+        output_profile = _OUTPUT_PROFILE
 
     # update from dataset
     previous_profile = {}
@@ -760,45 +1452,166 @@ def save_tif(
     if new_array is not None:
         data = new_array
 
-    if len(dataset["im"].shape) == 2:
-        row, col = data.shape
-        with rasterio.open(
-            filename,
-            mode="w+",
-            driver="GTiff",
-            width=col,
-            height=row,
-            count=1,
-            dtype=data.dtype,
-            crs=previous_profile["crs"],
-            transform=previous_profile["transform"],
-        ) as source_ds:
-            source_ds.nodata = no_data
-            source_ds.write(data, 1)
+    # written in the background if the run outputs writer has threads
+    # (see output_writer), readers of filename wait for the writing
+    if writes_in_background():
+        # the data arrays may be shared and modified in place
+        # before the writing (see create_dataset, convert_to_meter)
+        data = np.array(data)
+    submit_output(
+        filename,
+        write_tif,
+        data,
+        filename,
+        previous_profile["crs"],
+        previous_profile["transform"],
+        no_data,
+        dict(output_profile),
+    )
 
-    else:
-        row, col, depth = data.shape
-        with rasterio.open(
-            filename,
-            mode="w+",
-            driver="GTiff",
-            width=col,
-            height=row,
-            count=depth,
-            dtype=data.dtype,
-            crs=previous_profile["crs"],
-            transform=previous_profile["transform"],
-        ) as source_ds:
-            for dsp in range(1, depth + 1):
-                source_ds.write(data[:, :, dsp - 1], dsp)
+    # the data is shared with the input dataset, only the transform
+    # and attributes are copied
+    new_dataset = dataset.copy(deep=False)
+    new_dataset["trans"] = dataset["trans"].copy(deep=True)
+    new_dataset.attrs = copy.deepcopy(dataset.attrs)
+    # update dataset input_img with new filename
+    new_dataset.attrs["input_img"] = filename
+
+    return new_dataset
 
-    new_dataset = copy.deepcopy(dataset)
+
+def save_npy(
+    dataset: xr.Dataset, filename: str, new_array=None, no_data: float = None
+) -> xr.Dataset:
+    """
+    Write a Dataset as a raw .npy array with a .json sidecar file
+    holding its georeferencing, so that it can be read back
+    as a memory map (see read_npy) without any decoding.
+    If new_array is set, new_array is used as data.
+
+    :param dataset: dataset
+    :param filename:  output .npy filename
+    :param new_array:  new array to write
+    :param no_data:  value of nodata to record,
+            default is the dataset one (nodata values are stored as nan)
+    :return: dataset
+    """
+    data = dataset["im"].data
+    if new_array is not None:
+        data = new_array
+    np.save(filename, data)
+
+    sidecar = {
+        "trans": [float(value) for value in dataset["trans"].data],
+        "georef": rasterio.crs.CRS.from_dict(dataset.attrs["georef"]).to_wkt(),
+        "no_data": float(
+            no_data if no_data is not None else dataset.attrs["no_data"]
+        ),
+        "plani_unit": dataset.attrs["plani_unit"].name,
+        "zunit": dataset.attrs["zunit"].name,
+    }
+    with open(
+        os.path.splitext(filename)[0] + ".json", "w", encoding="utf8"
+    ) as sidecar_file:
+        json.dump(sidecar, sidecar_file, indent=2)
+
+    # the data is shared with the input dataset, only the transform
+    # and attributes are copied
+    new_dataset = dataset.copy(deep=False)
+    new_dataset["trans"] = dataset["trans"].copy(deep=True)
+    new_dataset.attrs = copy.deepcopy(dataset.attrs)
     # update dataset input_img with new filename
     new_dataset.attrs["input_img"] = filename
 
     return new_dataset
 
 
+def read_npy(img: str) -> xr.Dataset:
+    """
+    Read a .npy array written by save_npy as a copy-on-write memory map,
+    and return the corresponding xarray.DataSet.
+    Pixels are only loaded from disk when accessed,
+    and changes on the data are never written back to the file.
+
+    :param img: Path to the .npy image
+    :type img: str
+    :return: dataset containing the variables :
+            - im : 2D (row, col) xarray.DataArray float32
+            - trans 1D xarray.DataArray float32
+    :rtype: xr.Dataset
+    """
+    with open(
+        os.path.splitext(img)[0] + ".json", "r", encoding="utf8"
+    ) as sidecar_file:
+        sidecar = json.load(sidecar_file)
+
+    data = np.load(img, mmap_mode="c")
+    transform = np.array(sidecar["trans"])
+
+    dataset = xr.Dataset(
+        {"im": (["row", "col"], data)},
+        coords={
+            "row": np.arange(data.shape[0]),
+            "col": np.arange(data.shape[1]),
+        },
+    )
+    dataset.coords["trans_len"] = np.arange(0, len(transform))
+    dataset["trans"] = xr.DataArray(data=transform, dims=["trans_len"])
+
+    dataset.attrs = {
+        "no_data": sidecar["no_data"],
+        "input_img": img,
+        "georef": rasterio.crs.CRS.from_wkt(sidecar["georef"]),
+        "xres": transform[1],
+        "yres": transform[5],
+        "plani_unit": u.Unit(sidecar["plani_unit"]),
+        "zunit": u.Unit(sidecar["zunit"]),
+    }
+
+    return dataset
+
+
+def save_intermediate_img(
+    dataset: xr.Dataset, filename: str, intermediate_format: str = "GTiff"
+) -> xr.Dataset:
+    """
+    Write an intermediate Dataset (coregistered DEMs, final dh)
+    with the chosen storage format :
+    - GTiff : GeoTIFF file (see save_tif)
+    - npy : memory mappable .npy file, with .npy extension
+      replacing filename's one (see save_npy)
+
+    :param dataset: dataset
+    :type dataset: xr.Dataset
+    :param filename: output filename
+    :type filename: str
+    :param intermediate_format: GTiff or npy
+    :type intermediate_format: str
+    :return: dataset
+    :rtype: xr.Dataset
+    """
+    if intermediate_format == "npy":
+        return save_npy(dataset, os.path.splitext(filename)[0] + ".npy")
+    return save_tif(dataset, filename)
+
+
+def read_intermediate_img(img: str, no_data: float = None) -> xr.Dataset:
+    """
+    Read an intermediate Dataset written by save_intermediate_img,
+    memory mapped if it is a .npy file
+
+    :param img: Path to the image
+    :type img: str
+    :param no_data: no_data value in the image (GeoTIFF only)
+    :type no_data: float or None
+    :return: dataset
+    :rtype: xr.Dataset
+    """
+    if os.path.splitext(img)[1] == ".npy":
+        return read_npy(img)
+    return read_img(img, no_data=no_data)
+
+
 def get_slope(dataset: xr.Dataset, degree: bool = False) -> np.ndarray:
     """
     Compute slope from dataset
@@ -892,7 +1705,7 @@ def interpolate_geoid(
     :return: interpolated position [lon,lat,estimate geoid]
     :rtype: 3D np.array
     """
-    dataset = rasterio.open(geoid_filename)
+    dataset = open_raster(geoid_filename)
 
     transform = dataset.transform
     step_x = transform[0]
@@ -926,7 +1739,9 @@ def interpolate_geoid(
 
 
 def get_geoid_offset(
-    dataset: xr.Dataset, geoid_path: Union[str, None]
+    dataset: xr.Dataset,
+    geoid_path: Union[str, None],
+    window: rasterio.windows.Window = None,
 ) -> np.ndarray:
     """
     Get offset from geoid to ellipsoid
@@ -935,6 +1750,9 @@ def get_geoid_offset(
     :type dataset: xr.Dataset
     :param geoid_path: optional absolut geoid_path, if None egm96 is used
     :type geoid_path: str or None
+    :param window: optional window of the dataset on which
+            to compute the offset (default is the whole dataset)
+    :type window: rasterio.windows.Window or None
     :return: offset as array
     :rtype: np.ndarray
     """
@@ -949,9 +1767,11 @@ def get_geoid_offset(
         # Create full geoid path
         geoid_path = os.path.join(module_path, geoid_path)
 
-    ny, nx = dataset["im"].data.shape
-    xp = np.arange(nx)
-    yp = np.arange(ny)
+    if window is None:
+        ny, nx = dataset["im"].data.shape
+        window = rasterio.windows.Window(0, 0, nx, ny)
+    xp = np.arange(window.col_off, window.col_off + window.width)
+    yp = np.arange(window.row_off, window.row_off + window.height)
 
     # xp in [-180, 180], yp in [-90, 90]
     xp[xp > 180] = xp[xp > 180] - 360
@@ -972,12 +1792,8 @@ def get_geoid_offset(
         )
 
         # transform to list (2xN)
-    lon_1d = np.reshape(
-        lon, (dataset["im"].data.shape[0] * dataset["im"].data.shape[1])
-    )
-    lat_1d = np.reshape(
-        lat, (dataset["im"].data.shape[0] * dataset["im"].data.shape[1])
-    )
+    lon_1d = np.reshape(lon, lon.size)
+    lat_1d = np.reshape(lat, lat.size)
     coords = np.zeros((lon_1d.size, 2))
     coords[:, 0] = lon_1d
     coords[:, 1] = lat_1d
@@ -987,12 +1803,45 @@ def get_geoid_offset(
         geoid_path, coords, interpol_method="linear"
     )
 
-    # transform to array of shape dataset['im'].data.shape
-    arr_offset = np.reshape(interp_geoid, dataset["im"].data.shape)
+    # transform to array of shape window shape
+    arr_offset = np.reshape(
+        interp_geoid, (int(window.height), int(window.width))
+    )
 
     return arr_offset
 
 
+def add_lazy_geoid_offset(dataset: xr.Dataset, geoid_path: Union[str, None]):
+    """
+    Add the offset from geoid to ellipsoid to a dask backed dataset,
+    as a lazy block operation (offset computed on each chunk window)
+
+    :param dataset: dask backed dataset
+    :type dataset: xr.Dataset
+    :param geoid_path: optional absolut geoid_path, if None egm96 is used
+    :type geoid_path: str or None
+    :return: lazy data with geoid offset
+    :rtype: dask.array.Array
+    """
+    # Only georeferencing is needed to compute the offsets
+    georef_dataset = dataset[["trans"]]
+
+    def add_block_geoid_offset(block, block_info=None):
+        """Add geoid offset to a chunk given its location"""
+        (row_start, row_stop), (col_start, col_stop) = block_info[0][
+            "array-location"
+        ]
+        window = rasterio.windows.Window(
+            col_start, row_start, col_stop - col_start, row_stop - row_start
+        )
+        geoid_offset = get_geoid_offset(georef_dataset, geoid_path, window)
+        return (block + geoid_offset).astype(np.float32)
+
+    return dataset["im"].data.map_blocks(
+        add_block_geoid_offset, dtype=np.float32
+    )
+
+
 def compute_offset_bounds(
     y_off: float, x_off: float, cfg: Dict
 ) -> Tuple[float, float, float, float]:
@@ -1013,16 +1862,12 @@ def compute_offset_bounds(
     :return: coordinate bounds to apply the offsets
     :rtype: Tuple[float,float,float,float]
     """
-    # Read original secondary dem
-    dem = read_img(
-        cfg["inputDSM"]["path"],
-        load_data=(
-            cfg["inputDSM"]["roi"] if "roi" in cfg["inputDSM"] else False
-        ),
-    )
-    ysize, xsize = dem["im"].shape
+    # Original secondary dem metadata, no pixel is read
+    dem_ds = open_raster(cfg["inputDSM"]["path"])
+    ysize, xsize = dem_ds.height, dem_ds.width
+    trans = np.array(dem_ds.transform.to_gdal())
     # Compute the coordinates of the new bounds
-    x_0, y_0 = pix_to_coord(dem["trans"].data, y_off, x_off)
-    x_1, y_1 = pix_to_coord(dem["trans"].data, y_off + ysize, x_off + xsize)
+    x_0, y_0 = pix_to_coord(trans, y_off, x_off)
+    x_1, y_1 = pix_to_coord(trans, y_off + ysize, x_off + xsize)
 
     return float(x_0), float(y_0), float(x_1), float(y_1)
@@ -27,6 +27,7 @@ TODO: move all init parts of __init__ here for consistency
 # Standard imports
 import copy
 import errno
+import importlib.util
 import json
 import os
 from typing import Dict, List, Tuple
@@ -34,9 +35,11 @@ from typing import Dict, List, Tuple
 # Third party imports
 import numpy as np
 from astropy import units as u
+from rasterio.windows import Window
 
 # DEMcompare imports
-from .img_tools import read_img
+from .img_tools import OUTPUT_PROFILES, open_raster, roi_to_window
+from .nuth_kaab_universal_coregistration import PLOT_LEVELS
 from .output_tree_design import supported_OTD
 
 
@@ -199,6 +202,19 @@ def check_parameters(cfg: Dict):  # noqa: C901
     # else
     cfg["otd"] = "default_OTD"
 
+    # check lazy (dask backed) inputs mode: the inputs are read and
+    # reprojected by chunks, the next steps run on loaded arrays
+    if "lazy" not in cfg:
+        cfg["lazy"] = False
+    if not isinstance(cfg["lazy"], bool):
+        raise NameError(
+            "ERROR: lazy option ({}) must be a boolean".format(cfg["lazy"])
+        )
+    if cfg["lazy"] and importlib.util.find_spec("dask") is None:
+        raise NameError(
+            "ERROR: lazy option requires dask (pip install demcompare[lazy])"
+        )
+
 
 def initialization_plani_opts(cfg: Dict):
     """
@@ -207,7 +223,8 @@ def initialization_plani_opts(cfg: Dict):
 
     'auto_disp_first_guess' : when set to True,
     PRO_DecMoy is used to guess disp init and disp range
-    'coregistration_method' : 'correlation' or 'nuth_kaab'
+    'coregistration_method' : 'correlation', 'nuth_kaab',
+    'nuth_kaab_pyramid' or 'least_squares'
     if 'correlation' :   'correlator' : 'PRO_Medicis'
     'disp_init' and 'disp_range' define the area
     to explore when 'auto_disp_first_guess' is set to False
@@ -215,6 +232,54 @@ def initialization_plani_opts(cfg: Dict):
     Note that disp_init and disp_range are used
     to define margin when the process is tiled.
 
+    'disp_init' set to 'auto' is estimated by phase correlation
+    of the DEMs slopes before the coregistration
+
+    'coregistration_iterations' is the maximum number of iterations,
+    they stop before when an iteration shift is below
+    'coregistration_min_shift_increment' (pixels) or when an iteration
+    decreases the differences NMAD by less than
+    'coregistration_min_nmad_gain' (percent), if set
+
+    'coregistration_resampling' : 'bilinear' or 'spline',
+    Nuth and Kaab resampling of the shifted DEM at each iteration
+    ('spline' is the former RectBivariateSpline resampling, slower,
+    kept for validation)
+
+    'coregistration_plot' : Nuth and Kaab plots level, 'none' (no figure),
+    'summary' (elevation differences and aspect slices medians)
+    or 'full' (decimated dh/tan(slope) point clouds as well)
+
+    'coregistration_threads' : number of threads running the Nuth and Kaab
+    iterations computations by rows blocks (results do not depend on it)
+
+    'nuth_kaab_pyramid' runs the Nuth and Kaab iterations on DEMs
+    downsampled by 2**'coregistration_pyramid_levels', ..., 4, 2
+    and finishes with 'coregistration_pyramid_final_iterations'
+    full resolution iterations, each level initialized by the previous one
+
+    'least_squares' estimates the x, y and z shifts together
+    by least squares on the master DEM tangent planes,
+    on a sample of 100000 valid pixels by default
+
+    'coregistration_sampling_max_points' and 'coregistration_sampling_ratio'
+    limit the number and the ratio of valid pixels the shifts are
+    estimated on, if set : the pixels are randomly drawn
+    (with 'coregistration_sampling_seed') and the DEM is only resampled
+    at full resolution once, with the final shifts
+
+    'coregistration_cache_dir' : if set, directory of the coregistration
+    results cache, shared by runs (and output directories) on the same
+    inputs files contents, reading options and plani_opts : a cached
+    coregistration is not computed again. The coregistered rasters
+    are cached as well if 'coregistration_cache_rasters', and the least
+    recently used entries are evicted beyond
+    'coregistration_cache_max_size' MB
+
+    'intermediate_format' : 'GTiff' or 'npy', storage format
+    of coregistered DEMs and final dh ('npy' files are memory mapped
+    when reused by a later run without coregistration step)
+
     :param cfg: configuration dictionary
     :type cfg: Dict
     """
@@ -222,7 +287,21 @@ def initialization_plani_opts(cfg: Dict):
     default_plani_opts = {
         "coregistration_method": "nuth_kaab",
         "coregistration_iterations": 6,
+        "coregistration_min_shift_increment": None,
+        "coregistration_min_nmad_gain": None,
+        "coregistration_sampling_max_points": None,
+        "coregistration_sampling_ratio": None,
+        "coregistration_sampling_seed": 0,
+        "coregistration_pyramid_levels": 3,
+        "coregistration_pyramid_final_iterations": 2,
+        "coregistration_resampling": "bilinear",
+        "coregistration_plot": "full",
+        "coregistration_threads": 1,
+        "coregistration_cache_dir": None,
+        "coregistration_cache_rasters": True,
+        "coregistration_cache_max_size": 10000,
         "disp_init": {"x": 0, "y": 0},
+        "intermediate_format": "GTiff",
     }
 
     if "plani_opts" not in cfg:
@@ -233,6 +312,137 @@ def initialization_plani_opts(cfg: Dict):
             list(default_plani_opts.items()) + list(cfg["plani_opts"].items())
         )
 
+    # check initial disparity
+    disp_init = cfg["plani_opts"]["disp_init"]
+    if disp_init != "auto" and (
+        not isinstance(disp_init, dict)
+        or "x" not in disp_init
+        or "y" not in disp_init
+    ):
+        raise NameError(
+            "ERROR: disp_init ({}) must be 'auto'"
+            " or set x and y".format(disp_init)
+        )
+
+    # check coregistration sampling
+    max_points = cfg["plani_opts"]["coregistration_sampling_max_points"]
+    if max_points is not None and (
+        not isinstance(max_points, int) or max_points < 1
+    ):
+        raise NameError(
+            "ERROR: coregistration sampling max points ({}) must be"
+            " a positive integer".format(max_points)
+        )
+    ratio = cfg["plani_opts"]["coregistration_sampling_ratio"]
+    if ratio is not None and not 0 < ratio <= 1:
+        raise NameError(
+            "ERROR: coregistration sampling ratio ({}) must be"
+            " in ]0, 1]".format(ratio)
+        )
+
+    # check coregistration resampling
+    if cfg["plani_opts"]["coregistration_resampling"] not in [
+        "bilinear",
+        "spline",
+    ]:
+        raise NameError(
+            "ERROR: coregistration resampling ({}) not supported"
+            " (available options are bilinear and spline)".format(
+                cfg["plani_opts"]["coregistration_resampling"]
+            )
+        )
+
+    # check coregistration plot level
+    if cfg["plani_opts"]["coregistration_plot"] not in PLOT_LEVELS:
+        raise NameError(
+            "ERROR: coregistration plot level ({}) not supported"
+            " (available options are {})".format(
+                cfg["plani_opts"]["coregistration_plot"],
+                ", ".join(PLOT_LEVELS),
+            )
+        )
+
+    # check coregistration threads number
+    nb_threads = cfg["plani_opts"]["coregistration_threads"]
+    if not isinstance(nb_threads, int) or nb_threads < 1:
+        raise NameError(
+            "ERROR: coregistration threads number ({}) must be"
+            " a positive integer".format(nb_threads)
+        )
+
+    # check coregistration cache maximum size
+    cache_max_size = cfg["plani_opts"]["coregistration_cache_max_size"]
+    if cache_max_size is not None and (
+        not isinstance(cache_max_size, (int, float)) or cache_max_size <= 0
+    ):
+        raise NameError(
+            "ERROR: coregistration cache max size ({}) must be"
+            " a positive number of MB".format(cache_max_size)
+        )
+
+    # check intermediate rasters storage format
+    if cfg["plani_opts"]["intermediate_format"] not in ["GTiff", "npy"]:
+        raise NameError(
+            "ERROR: intermediate format ({}) not supported"
+            " (available options are GTiff and npy)".format(
+                cfg["plani_opts"]["intermediate_format"]
+            )
+        )
+
+
+def initialization_output_opts(cfg: Dict):
+    """
+    Init output rasters options from configuration
+
+    'profile' : 'default' (striped uncompressed GTiff),
+    'compressed' (tiled compressed GTiff) or 'cog' (Cloud Optimized GeoTIFF)
+    The other items override the profile ones:
+    'tiled' : tiled GTiff, 'blocksize' : tiles size,
+    'compress' : 'NONE', 'DEFLATE', 'ZSTD' or 'LZW',
+    'overviews' : compute overviews,
+    'num_threads' : GDAL compression threads ('ALL_CPUS' or a number)
+    'writer_threads' : number of threads writing the outputs
+    in the background during computations (0 to write synchronously)
+
+    :param cfg: Input demcompare configuration
+    :type cfg: Dict
+    """
+    default_output_opts = {"profile": "default", "writer_threads": 2}
+
+    if "output_opts" not in cfg:
+        cfg["output_opts"] = default_output_opts
+    else:
+        # we keep users items and add default items he has not set
+        cfg["output_opts"] = dict(
+            list(default_output_opts.items()) + list(cfg["output_opts"].items())
+        )
+
+    if cfg["output_opts"]["profile"] not in OUTPUT_PROFILES:
+        raise NameError(
+            "ERROR: output profile ({}) not supported"
+            " (available options are {})".format(
+                cfg["output_opts"]["profile"], ", ".join(OUTPUT_PROFILES)
+            )
+        )
+    for key in cfg["output_opts"]:
+        if key not in ["profile", "writer_threads"] + list(
+            OUTPUT_PROFILES["default"]
+        ):
+            raise NameError("ERROR: unknown output option ({})".format(key))
+    if cfg["output_opts"].get("compress", None) not in [
+        None,
+        "NONE",
+        "DEFLATE",
+        "ZSTD",
+        "LZW",
+    ]:
+        raise NameError(
+            "ERROR: output compression ({}) not supported"
+            " (available options are NONE, DEFLATE, ZSTD and LZW)".format(
+                cfg["output_opts"]["compress"]
+            )
+        )
+
 
 def initialization_alti_opts(cfg: Dict):
     """
@@ -424,11 +634,30 @@ def compute_tiles_coordinates(
         height = min(tile_height, roi["y"] + roi["h"] - row)
         for col in np.arange(roi["x"], roi["x"] + roi["w"], tile_width):
             width = min(tile_width, roi["x"] + roi["w"] - col)
-            out.append((col, row, width, height))
+            # python integers, for the tiles json configurations
+            out.append((int(col), int(row), int(width), int(height)))
 
     return out
 
 
+def check_jobs(jobs: int, display: bool = False):
+    """
+    Check the number of tiles processed in parallel
+
+    :param jobs: number of tiles processed in parallel
+    :type jobs: int
+    :param display: plots are shown instead of saved
+    :type display: bool
+    :return: None
+    """
+    if not isinstance(jobs, int) or jobs < 1:
+        raise NameError(
+            "ERROR: jobs number ({}) must be a positive integer".format(jobs)
+        )
+    if display and jobs > 1:
+        raise NameError("ERROR: plots display requires a single job")
+
+
 def divide_images(cfg: dict):
     """
     List the tiles to process and prepare their output directories structures.
@@ -440,20 +669,34 @@ def divide_images(cfg: dict):
     :rtype: List[dict]
     """
 
-    # compute biggest roi
-    dem = read_img(
-        cfg["inputDSM"]["path"],
-        load_data=(cfg["roi"] if "roi" in cfg else False),
-    )
+    # DSM window covered by the roi (only the DSM metadata is read)
+    dem_ds = open_raster(cfg["inputDSM"]["path"])
+    if "roi" in cfg["inputDSM"]:
+        window = roi_to_window(
+            cfg["inputDSM"]["roi"],
+            dem_ds.transform,
+            dem_ds.width,
+            dem_ds.height,
+        )
+    else:
+        window = Window(0, 0, dem_ds.width, dem_ds.height)
 
-    sizes = {"w": dem["im"].data.shape[1], "h": dem["im"].data.shape[0]}
+    sizes = {"w": int(window.width), "h": int(window.height)}
     roi = {
-        "x": cfg["roi"]["x"] if "roi" in cfg else 0,
-        "y": cfg["roi"]["y"] if "roi" in cfg else 0,
-        "w": dem["im"].data.shape[1],
-        "h": dem["im"].data.shape[0],
+        "x": int(window.col_off),
+        "y": int(window.row_off),
+        "w": sizes["w"],
+        "h": sizes["h"],
     }
 
+    # tiles halo, processed around each tile but out of its stats
+    halo = cfg.get("tile_halo", 0)
+    if not isinstance(halo, int) or halo < 0:
+        raise NameError(
+            "ERROR: tile halo ({}) must be a positive"
+            " or null integer".format(halo)
+        )
+
     # list tiles coordinates
     tile_size_w, tile_size_h = adjust_tile_size(sizes, cfg["tile_size"])
     tiles_coords = compute_tiles_coordinates(roi, tile_size_w, tile_size_h)
@@ -482,7 +725,30 @@ def divide_images(cfg: dict):
         # save a json dump of the tile configuration
         tile_cfg = copy.deepcopy(cfg)
         col, row, width, height = tile["coordinates"]
-        tile_cfg["roi"] = {"x": col, "y": row, "w": width, "h": height}
+        # the tile roi, expanded by the halo within the roi,
+        # in the DSM image coordinates
+        col_start = max(col - halo, roi["x"])
+        row_start = max(row - halo, roi["y"])
+        col_stop = min(col + width + halo, roi["x"] + roi["w"])
+        row_stop = min(row + height + halo, roi["y"] + roi["h"])
+        tile_cfg["inputDSM"]["roi"] = {
+            "x": col_start,
+            "y": row_start,
+            "w": col_stop - col_start,
+            "h": row_stop - row_start,
+        }
+        # the tile core georeferenced bounds, the only region of the
+        # tile counted in its stats
+        core_x, core_y = dem_ds.transform * (
+            np.array([col, col + width]),
+            np.array([row, row + height]),
+        )
+        tile_cfg["tile_core"] = {
+            "left": float(np.min(core_x)),
+            "bottom": float(np.min(core_y)),
+            "right": float(np.max(core_x)),
+            "top": float(np.max(core_y)),
+        }
         tile_cfg["outputDir"] = tile["dir"]
 
         tile_json = os.path.join(tile["dir"], "config.json")
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Least squares 3D shift coregistration.
+
+The x, y and z shifts minimize the elevation differences of a sample of
+the valid pixels, each difference being linearized on the tangent plane
+of the master DEM (point-to-plane), by Gauss-Newton iterations.
+Unlike Nuth and Kaab, the elevation differences are not divided by the
+slope, so that low slope areas weigh little instead of ill-conditioning
+the fit.
+"""
+
+# Standard imports
+from typing import Tuple
+
+# Third party imports
+import numpy as np
+import xarray as xr
+
+# DEMcompare imports
+from .block_processing import BlockPool, block_median, block_subtract
+from .img_tools import read_img_from_array
+from .nuth_kaab_universal_coregistration import (
+    ShiftInterpolator,
+    gradient_at,
+    resample_at_shift,
+    resample_to_shift,
+    sample_valid_pixels,
+)
+from .robust_stats import RobustStats
+
+# Default number of sampled pixels
+LEAST_SQUARES_MAX_POINTS = 100000
+# Residuals further than this number of NMAD from their median
+# are rejected from the fit
+LEAST_SQUARES_OUTLIERS_NMAD = 3
+
+
+def least_squares_step(
+    design: np.ndarray,
+    residuals: np.ndarray,
+    robust_stats: RobustStats = None,
+) -> np.ndarray:
+    """
+    Gauss-Newton step of the x, y and z shifts, without the residuals
+    outliers (beyond LEAST_SQUARES_OUTLIERS_NMAD NMAD)
+
+    :param design: residuals derivatives with respect to the shifts (N, 3)
+    :type design: np.ndarray
+    :param residuals: residuals (N), nan where unknown
+    :type residuals: np.ndarray
+    :param robust_stats: median and nmad scratch buffer
+    :type robust_stats: RobustStats or None
+    :return: x, y and z shifts increments (nan if too few residuals)
+    :rtype: np.ndarray
+    """
+    if robust_stats is None:
+        robust_stats = RobustStats()
+    used = np.isfinite(residuals) & np.all(np.isfinite(design), axis=1)
+    median, nmad = robust_stats.median_nmad(residuals, valid=used)
+    if nmad > 0:
+        used &= np.abs(residuals - median) <= LEAST_SQUARES_OUTLIERS_NMAD * nmad
+    if np.count_nonzero(used) < design.shape[1]:
+        return np.full(design.shape[1], np.nan)
+    # minimum norm solution: a shift the terrain does not constrain
+    # (flat area, single slope direction) is not moved
+    step, _, _, _ = np.linalg.lstsq(design[used], -residuals[used], rcond=None)
+    return step
+
+
+def least_squares_lib(
+    dsm_dataset: xr.Dataset,
+    ref_dataset: xr.Dataset,
+    nb_iters: int = 6,
+    min_shift_increment: float = None,
+    sampling_max_points: int = None,
+    sampling_ratio: float = None,
+    sampling_seed: int = 0,
+    resampling: str = "bilinear",
+    pool: BlockPool = None,
+) -> Tuple[
+    float, float, float, xr.Dataset, xr.Dataset, xr.Dataset, xr.Dataset, int
+]:
+    """
+    Least squares 3D shift coregistration, with the same outputs
+    as nuth_kaab_lib
+
+    :param dsm_dataset: dsm dataset
+    :type dsm_dataset: xarray Dataset
+    :param ref_dataset: ref dataset
+    :type ref_dataset: xarray Dataset
+    :param nb_iters: maximum iterations number
+    :type nb_iters: int
+    :param min_shift_increment: iterations stop when an iteration
+            shift is below it, in pixels (None to disable)
+    :type min_shift_increment: float or None
+    :param sampling_max_points: maximum number of sampled valid pixels
+            (LEAST_SQUARES_MAX_POINTS if sampling_ratio is not set either)
+    :type sampling_max_points: int or None
+    :param sampling_ratio: maximum ratio of sampled valid pixels
+    :type sampling_ratio: float or None
+    :param sampling_seed: random sample seed
+    :type sampling_seed: int
+    :param resampling: slave DEM resampling, 'bilinear' or 'spline'
+    :type resampling: str
+    :param pool: row blocks pool (None for a single thread)
+    :type pool: BlockPool or None
+    :return: x, y and z shifts (as 'dsm_dataset + (x,y,z) = ref_dataset'),
+            coregistered DEMs, initial and final differences
+            and the number of iterations performed
+    """
+    if pool is None:
+        pool = BlockPool()
+    if sampling_max_points is None and sampling_ratio is None:
+        sampling_max_points = LEAST_SQUARES_MAX_POINTS
+    dsm = dsm_dataset["im"].data
+    initial_dh = block_subtract(ref_dataset["im"].data, dsm, pool)
+
+    # Sampled pixels and their master DEM tangent planes
+    rows, cols = sample_valid_pixels(
+        np.isfinite(initial_dh),
+        max_points=sampling_max_points,
+        ratio=sampling_ratio,
+        seed=sampling_seed,
+    )
+    print("Least squares sample: {} pixels".format(rows.size))
+    grad_rows, grad_cols = gradient_at(dsm, rows, cols)
+    sample_dsm = dsm[rows, cols].astype(np.float64)
+    # residual = ref(row - y, col + x) - z - dsm(row, col)
+    # (y north oriented), derivatives taken on the master DEM
+    design = np.column_stack(
+        (grad_cols, -grad_rows, -np.ones(rows.size))
+    ).astype(np.float64)
+
+    interpolator = ShiftInterpolator(
+        ref_dataset["im"].data, resampling=resampling, pool=pool
+    )
+    robust_stats = RobustStats()
+    xoff, yoff = 0.0, 0.0
+    zoff = float(block_median(initial_dh, pool))
+
+    print("Least squares iterations: {}".format(nb_iters))
+    nb_iters_done = 0
+    for i in range(nb_iters):
+        residuals = (
+            resample_at_shift(interpolator, dsm.shape, rows, cols, xoff, yoff)
+            - zoff
+            - sample_dsm
+        )
+        east, north, z = least_squares_step(design, residuals, robust_stats)
+        if not np.all(np.isfinite((east, north, z))):
+            print("Least squares: not enough valid pixels, iterations stop")
+            break
+        xoff += east
+        yoff += north
+        zoff += z
+        nb_iters_done = i + 1
+        print(
+            "# {} - Offset in pixels : "
+            "({:.2f},{:.2f}), -bias : ({:.2f})".format(i + 1, east, north, z)
+        )
+
+        # stop when converged
+        if (
+            min_shift_increment is not None
+            and np.hypot(east, north) < min_shift_increment
+        ):
+            print(
+                "Least squares converged: shift increment"
+                " below {} pixels".format(min_shift_increment)
+            )
+            break
+
+    print(
+        "Least squares Final Offset in pixels (east, north):"
+        "({:.2f},{:.2f})\n".format(xoff, yoff)
+    )
+
+    coreg_ref, coreg_dsm = resample_to_shift(interpolator, dsm, xoff, yoff)
+
+    # Generate datasets, use the georef-grid from the dsm
+    coreg_dsm_dataset = read_img_from_array(
+        coreg_dsm, from_dataset=dsm_dataset, no_data=-32768
+    )
+    coreg_ref_dataset = read_img_from_array(
+        coreg_ref, from_dataset=dsm_dataset, no_data=-32768
+    )
+    initial_dh_dataset = read_img_from_array(
+        initial_dh, from_dataset=dsm_dataset, no_data=-32768, copy_array=False
+    )
+    final_dh_dataset = read_img_from_array(
+        block_subtract(coreg_ref, coreg_dsm, pool),
+        from_dataset=dsm_dataset,
+        no_data=-32768,
+        copy_array=False,
+    )
+
+    return (
+        xoff,
+        yoff,
+        zoff,
+        coreg_dsm_dataset,
+        coreg_ref_dataset,
+        initial_dh_dataset,
+        final_dh_dataset,
+        nb_iters_done,
+    )
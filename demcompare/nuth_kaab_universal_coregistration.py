@@ -39,10 +39,28 @@ import matplotlib.pyplot as pl
 import numpy as np
 import xarray as xr
 from scipy.interpolate import RectBivariateSpline
-from scipy.optimize import leastsq
 
 # DEMcompare imports
+from .block_processing import (
+    BlockPool,
+    block_median_nmad,
+    block_subtract,
+    concatenate_blocks,
+)
 from .img_tools import load_dems, read_img_from_array, save_tif
+from .output_writer import save_figure
+from .robust_stats import RobustStats
+
+# Plot levels: 'none' for no figure at all,
+# 'summary' for the elevation differences and the aspect slices medians,
+# 'full' for the dh/tan(slope) targets point cloud as well
+PLOT_LEVELS = ("none", "summary", "full")
+# Maximum number of targets drawn in 'full' point clouds
+PLOT_MAX_POINTS = 100000
+# Maximum rows and columns of the drawn elevation differences
+PLOT_MAX_SIZE = 1500
+# Aspect slices with fewer filtered targets are left out of the fit
+MIN_SLICE_COUNT = 10
 
 
 def grad2d(dem: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
@@ -62,11 +80,256 @@ def grad2d(dem: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     return slope, aspect
 
 
+def gradient_at(
+    dem: np.ndarray, rows: np.ndarray, cols: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    np.gradient of dem, only computed at the given pixels
+
+    :param dem: input dem
+    :type dem: np.ndarray
+    :param rows: pixels rows
+    :type rows: np.ndarray
+    :param cols: pixels columns
+    :type cols: np.ndarray
+    :return: rows and columns gradients at the pixels
+    :rtype: np.ndarray, np.ndarray
+    """
+    # np.gradient differences: centered inside, one-sided on the edges
+    rows_prev = np.maximum(rows - 1, 0)
+    rows_next = np.minimum(rows + 1, dem.shape[0] - 1)
+    cols_prev = np.maximum(cols - 1, 0)
+    cols_next = np.minimum(cols + 1, dem.shape[1] - 1)
+    grad_rows = (dem[rows_next, cols] - dem[rows_prev, cols]) / (
+        rows_next - rows_prev
+    ).astype(dem.dtype)
+    grad_cols = (dem[rows, cols_next] - dem[rows, cols_prev]) / (
+        cols_next - cols_prev
+    ).astype(dem.dtype)
+    return grad_rows, grad_cols
+
+
+def grad2d_at(
+    dem: np.ndarray, rows: np.ndarray, cols: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Slope and aspect of grad2d, only computed at the given pixels
+
+    :param dem: input dem
+    :type dem: np.ndarray
+    :param rows: pixels rows
+    :type rows: np.ndarray
+    :param cols: pixels columns
+    :type cols: np.ndarray
+    :return: slope (fast forward style) and aspect at the pixels
+    :rtype: np.ndarray, np.ndarray
+    """
+    grad2, grad1 = gradient_at(dem, rows, cols)
+
+    slope = np.sqrt(grad1**2 + grad2**2)
+    aspect = np.arctan2(-grad1, grad2)  # aspect=0 when slope facing north
+    aspect = aspect + np.pi
+
+    return slope, aspect
+
+
+def sample_valid_pixels(
+    valid: np.ndarray,
+    max_points: int = None,
+    ratio: float = None,
+    seed: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Draw a random sample of the valid pixels, of at most max_points
+    pixels and at most ratio of the valid pixels
+
+    :param valid: valid pixels mask
+    :type valid: np.ndarray
+    :param max_points: maximum number of pixels (None for no maximum)
+    :type max_points: int or None
+    :param ratio: maximum ratio of the valid pixels (None for no maximum)
+    :type ratio: float or None
+    :param seed: random generator seed
+    :type seed: int
+    :return: rows and columns of the sampled pixels, in raster order
+    :rtype: np.ndarray, np.ndarray
+    """
+    valid_idxes = np.flatnonzero(valid)
+    nb_points = valid_idxes.size
+    if ratio is not None:
+        nb_points = min(nb_points, int(np.ceil(ratio * valid_idxes.size)))
+    if max_points is not None:
+        nb_points = min(nb_points, max_points)
+    rng = np.random.default_rng(seed)
+    sample_idxes = np.sort(
+        rng.choice(valid_idxes, size=nb_points, replace=False)
+    )
+    return np.unravel_index(sample_idxes, valid.shape)
+
+
+def slice_by_aspect(
+    aspect: np.ndarray,
+    aspect_bounds: np.ndarray,
+    aspect_step: float,
+    pool: BlockPool = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sort values indexes by aspect slice, a slice k being the open interval
+    ]aspect_bounds[k], aspect_bounds[k] + aspect_step[
+    (values on bounds are in no slice, and a value in the rounding
+    overlap of two consecutive slices is in both of them)
+
+    The indexes of slice k are target_idxes[slice_starts[k]:slice_stops[k]],
+    in ascending order.
+
+    :param aspect: aspect values
+    :type aspect: np.ndarray
+    :param aspect_bounds: ascending slices lower bounds
+    :type aspect_bounds: np.ndarray
+    :param aspect_step: slices width
+    :type aspect_step: float
+    :param pool: blocks pool, blocks being sorted in parallel then merged
+        (None for a single block)
+    :type pool: BlockPool or None
+    :return: target_idxes, slice_starts, slice_stops
+    :rtype: np.ndarray, np.ndarray, np.ndarray
+    """
+    nb_slices = len(aspect_bounds)
+    # Bounds are compared in the precision numpy uses to compare
+    # an aspect_bounds scalar with aspect
+    dtype = np.result_type(aspect, aspect_bounds[0])
+    lower_bounds = aspect_bounds.astype(dtype)
+    next_lower_bounds = np.append(aspect_bounds[1:], np.inf).astype(dtype)
+    # Upper bounds of slices k - 1 and k are at k + 1 and k + 2
+    # (-inf for the slices before the first one)
+    upper_bounds = np.concatenate(
+        ([-np.inf, -np.inf], aspect_bounds + aspect_step)
+    ).astype(dtype)
+
+    def sort_block(block: slice) -> Tuple[np.ndarray, np.ndarray]:
+        """block indexes sorted by slice, and slices counts"""
+        block_aspect = aspect[block]
+        # Last slice with a lower bound below the value: first guessed
+        # by division, then corrected by one slice where rounding matters
+        # (fmax and fmin give nan values the first slice, they are then
+        # rejected by the bounds comparisons)
+        slice_ids = np.fmin(
+            np.fmax(block_aspect / dtype.type(aspect_step), 0), nb_slices - 1
+        ).astype(np.intp)
+        slice_ids += next_lower_bounds[slice_ids] < block_aspect
+        slice_ids -= lower_bounds[slice_ids] >= block_aspect
+        in_slice = block_aspect < upper_bounds[slice_ids + 2]
+        # Values also below the upper bound of the previous slice
+        in_previous = block_aspect < upper_bounds[slice_ids + 1]
+
+        # small integers stable sort is a radix sort
+        slice_ids = slice_ids.astype(np.int8 if nb_slices < 128 else np.int16)
+        if np.any(in_previous):
+            slice_ids = np.concatenate(
+                (slice_ids[in_slice], slice_ids[in_previous] - 1)
+            )
+            target_idxes = np.concatenate(
+                (np.flatnonzero(in_slice), np.flatnonzero(in_previous))
+            )
+            # Sort by slice, then by index
+            target_idxes = target_idxes[np.lexsort((target_idxes, slice_ids))]
+        else:
+            target_idxes = np.flatnonzero(in_slice)
+            slice_ids = slice_ids[target_idxes]
+            target_idxes = target_idxes[np.argsort(slice_ids, kind="stable")]
+
+        return target_idxes, np.bincount(slice_ids, minlength=nb_slices)
+
+    if pool is None:
+        pool = BlockPool()
+    blocks = pool.row_blocks(aspect.shape[0])
+    sorted_blocks = pool.map(sort_block, blocks)
+    blocks_counts = np.array([counts for _, counts in sorted_blocks])
+    slice_stops = np.cumsum(blocks_counts.sum(axis=0))
+    slice_starts = np.concatenate(([0], slice_stops[:-1]))
+    if len(blocks) == 1:
+        return sorted_blocks[0][0], slice_starts, slice_stops
+
+    # Merge of the sorted blocks: each block slice is placed after
+    # the same slice of the previous blocks (in ascending indexes)
+    blocks_starts = slice_starts + np.concatenate(
+        (
+            np.zeros((1, nb_slices), dtype=blocks_counts.dtype),
+            np.cumsum(blocks_counts[:-1], axis=0),
+        )
+    )
+    target_idxes = np.empty(slice_stops[-1], dtype=np.intp)
+
+    def place_block(block_id: int):
+        """copy a sorted block indexes at its slices places"""
+        block_idxes = sorted_blocks[block_id][0]
+        block_offset = blocks[block_id].start
+        block_pos = 0
+        for slice_start, count in zip(
+            blocks_starts[block_id], blocks_counts[block_id]
+        ):
+            target_idxes[slice_start : slice_start + count] = (
+                block_idxes[block_pos : block_pos + count] + block_offset
+            )
+            block_pos += count
+
+    pool.map(place_block, range(len(blocks)))
+
+    return target_idxes, slice_starts, slice_stops
+
+
+def fit_aspect_model(
+    aspect_bounds: np.ndarray,
+    slice_medians: np.ndarray,
+    slice_counts: np.ndarray,
+    min_count: int = MIN_SLICE_COUNT,
+) -> Tuple[float, float, float]:
+    """
+    Fit the model a.cos(b-aspect)+c to the aspect slices medians,
+    each slice weighted by its number of filtered targets.
+    The model is linear in (a.cos(b), a.sin(b), c), it is solved
+    by weighted linear least squares, without iterations.
+
+    :param aspect_bounds: aspect slices lower bounds (radians)
+    :type aspect_bounds: np.ndarray
+    :param slice_medians: aspect slices medians (nan if empty)
+    :type slice_medians: np.ndarray
+    :param slice_counts: aspect slices filtered targets numbers
+    :type slice_counts: np.ndarray
+    :param min_count: slices with fewer targets are left out of the fit
+    :type min_count: int
+    :return: north (a.cos(b)), east (a.sin(b)) and c
+            (0 for the shifts the fitted slices do not constrain)
+    :rtype: float, float, float
+    """
+    slice_medians = np.asarray(slice_medians, dtype=np.float64)
+    slice_counts = np.asarray(slice_counts)
+    fitted = np.isfinite(slice_medians) & (slice_counts >= min_count)
+    # the median of n targets has a variance proportional to 1/n
+    weights = np.sqrt(slice_counts[fitted].astype(np.float64))
+    design = np.column_stack(
+        (
+            np.cos(aspect_bounds[fitted]),
+            np.sin(aspect_bounds[fitted]),
+            np.ones(np.count_nonzero(fitted)),
+        )
+    )
+    # minimum norm solution when the slices do not constrain the model
+    (north, east, c), _, _, _ = np.linalg.lstsq(
+        design * weights[:, np.newaxis],
+        slice_medians[fitted] * weights,
+        rcond=None,
+    )
+    return north, east, c
+
+
 def nuth_kaab_single_iter(
     dh: np.ndarray,
     slope: np.ndarray,
     aspect: np.ndarray,
     plot_file: Union[str, bool] = None,
+    plot: str = "full",
+    pool: BlockPool = None,
 ) -> Tuple[float, float, float]:
     """
     Compute the horizontal shift between 2 DEMs
@@ -81,6 +344,12 @@ def nuth_kaab_single_iter(
     :param plot_file: file to where store plot. Set to None if
         plot is to be printed. Set to False for no plot at all.
     :type plot_file: str or bool
+    :param plot: plot level, 'none', 'summary' (aspect slices medians)
+        or 'full' (targets point cloud as well, decimated to
+        PLOT_MAX_POINTS)
+    :type plot: str
+    :param pool: row blocks pool (None for a single block)
+    :type pool: BlockPool or None
     :return: east, north, c
     :rtype: float, float, float
     """
@@ -94,17 +363,30 @@ def nuth_kaab_single_iter(
     #    - b will be its orientation
     #    - c will be a vertical mean shift
 
-    # To avoid nearly-zero division, filter slope values below 0.001
-    slope[np.where(slope < 0.001)] = np.nan
-
-    # function to be correlated with terrain aspect
-    # NB : target = dh / tan(alpha) (see Fig. 2 of Nuth & Kaab 2011)
-    # Explicitely ignore divide by zero warning,
-    #   as they will be processed as nan later.
-    with np.errstate(divide="ignore", invalid="ignore"):
-        target = dh / slope
-    target = target[np.isfinite(dh)]
-    aspect = aspect[np.isfinite(dh)]
+    if pool is None:
+        pool = BlockPool()
+
+    def block_targets(block: slice) -> Tuple[np.ndarray, np.ndarray]:
+        """targets and aspects of a row block finite dh"""
+        # To avoid nearly-zero division, filter slope values below 0.001
+        # (in a new array, slope being shared with the caller and blocks)
+        block_slope = slope[block]
+        with np.errstate(invalid="ignore"):
+            block_slope = np.where(block_slope < 0.001, np.nan, block_slope)
+
+        # function to be correlated with terrain aspect
+        # NB : target = dh / tan(alpha) (see Fig. 2 of Nuth & Kaab 2011)
+        # Explicitely ignore divide by zero warning,
+        #   as they will be processed as nan later.
+        block_dh = dh[block]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            block_target = block_dh / block_slope
+        valid = np.isfinite(block_dh)
+        return block_target[valid], aspect[block][valid]
+
+    blocks_targets = pool.map_blocks(block_targets, dh.shape[0])
+    target = concatenate_blocks([targets for targets, _ in blocks_targets])
+    aspect = concatenate_blocks([aspects for _, aspects in blocks_targets])
     # Define sigma to filter each target slice outliers
     # and improve Nuth et kaab fit.
     # All target values slice outside
@@ -112,24 +394,27 @@ def nuth_kaab_single_iter(
     # are considered outliers and will be set to NaN
     sigma_filter = 3
     # Compute bounds for different aspect slices
-    aspect_bounds = np.arange(0, 2 * np.pi, np.pi / 36)
-    # Initialize filtered target
-    target_filt = np.full(target.shape, np.nan)
-    # Initialize slice filtered median
-    slice_filt_median = []
-    for bounds in aspect_bounds:
-        # Slice indexes within aspect
-        slice_idxes = np.where(
-            (bounds < aspect) & (aspect < bounds + np.pi / 36)
-        )
+    aspect_step = np.pi / 36
+    aspect_bounds = np.arange(0, 2 * np.pi, aspect_step)
+    # Sort target values by aspect slice, in a single pass
+    target_idxes, slice_starts, slice_stops = slice_by_aspect(
+        aspect, aspect_bounds, aspect_step, pool=pool
+    )
+    sorted_target = target[target_idxes]
+
+    def filter_slice(slice_bounds: Tuple[int, int]) -> Tuple[float, int]:
+        """
+        filter a slice sorted targets in place,
+        return their median and number
+        """
+        slice_start, slice_stop = slice_bounds
         # If no aspect values are within the slice,
         # fill mean with Nan and continue
-        if len(slice_idxes[0]) == 0:
+        if slice_stop == slice_start:
             # Set slice filtered median for Nuth et kaab as NaN
-            slice_filt_median.append(np.nan)
-            continue
+            return np.nan, 0
         # Obtain target values in the slice
-        target_slice = target[slice_idxes]
+        target_slice = sorted_target[slice_start:slice_stop]
         # Obtain target slice's mean and std before filtering
         slice_mean = np.nanmean(target_slice)
         # numpy's std cannot handle nan
@@ -143,57 +428,53 @@ def nuth_kaab_single_iter(
         )
         # Filter target_slice
         target_slice[inv_idx] = np.nan
-        target_slice[inv_idx] = np.nan
-        # Filter target
-        target_filt[slice_idxes] = target_slice
         # Compute slice filtered median for Nuth et kaab
-        slice_filt_median.append(np.nanmedian(target_slice))
-
-    # function to fit according to Nuth & Kaab
-    x = aspect.ravel()
-    y = target_filt.ravel()
-    # remove non-finite values
-    yf = y[(np.isfinite(x)) & (np.isfinite(y))]
-
-    # set the first guess
-    p0 = (3 * np.std(yf) / (2**0.5), 0, np.mean(yf))
-
-    # least square fit
-    def peval(x, p):
-        """peval defines the model chosen"""
-        return p[0] * np.cos(p[1] - x) + p[2]
-
-    def residuals(p, y, x):
-        """residuals function based on peval"""
-        err = peval(x, p) - y
-        return err
-
-    # we run the least square fit
-    # by minimizing the "distance" between y and peval (see residuals())
-    plsq = leastsq(
-        residuals, p0, args=(slice_filt_median, aspect_bounds), full_output=1
+        slice_count = np.count_nonzero(np.isfinite(target_slice))
+        if slice_count == 0:
+            return np.nan, 0
+        return np.nanmedian(target_slice), slice_count
+
+    # Slice filtered median and filtered targets number
+    slices_stats = pool.map(filter_slice, zip(slice_starts, slice_stops))
+    slice_filt_median = np.array([median for median, _ in slices_stats])
+    slice_counts = np.array([count for _, count in slices_stats])
+    # Filter target, in the slices order
+    # (a target in two slices keeps the last slice filtering)
+    target_filt = np.full(target.shape, np.nan)
+    for slice_start, slice_stop in zip(slice_starts, slice_stops):
+        target_filt[target_idxes[slice_start:slice_stop]] = sorted_target[
+            slice_start:slice_stop
+        ]
+
+    # Fit the model a.cos(b-aspect)+c to the slices medians,
+    # weighted by their filtered targets numbers
+    north, east, c = fit_aspect_model(
+        aspect_bounds, slice_filt_median, slice_counts
     )
-    yfit = peval(aspect_bounds, plsq[0])
+    yfit = north * np.cos(aspect_bounds) + east * np.sin(aspect_bounds) + c
 
     # plotting results
-    if plot_file is not False:
+    if plot_file is not False and plot != "none":
 
         pl.figure(1, figsize=(7.0, 8.0))
-        pl.plot(
-            aspect * 180 / np.pi,
-            target,
-            ".",
-            color="silver",
-            markersize=3,
-            label="target",
-        )
-        pl.plot(
-            aspect * 180 / np.pi,
-            target_filt,
-            "c.",
-            markersize=3,
-            label="target filtered",
-        )
+        if plot == "full":
+            # regular decimation of the targets point cloud
+            step = int(np.ceil(target.size / PLOT_MAX_POINTS))
+            pl.plot(
+                aspect[::step] * 180 / np.pi,
+                target[::step],
+                ".",
+                color="silver",
+                markersize=3,
+                label="target",
+            )
+            pl.plot(
+                aspect[::step] * 180 / np.pi,
+                target_filt[::step],
+                "c.",
+                markersize=3,
+                label="target filtered",
+            )
         pl.plot(
             aspect_bounds * 180 / np.pi, slice_filt_median, "k.", label="median"
         )
@@ -208,24 +489,373 @@ def nuth_kaab_single_iter(
         axes.set_ylim([ax_min, ax_max])
         pl.legend(loc="upper left")
         if plot_file:
-            pl.savefig(plot_file, dpi=100, bbox_inches="tight")
+            save_figure(pl.gcf(), plot_file, dpi=100, bbox_inches="tight")
         else:
             pl.show()
-        pl.close()
-
-    a, b, c = plsq[0]
-    east = a * np.sin(b)  # with b=0 when north (origin=y-axis)
-    north = a * np.cos(b)
+            pl.close()
 
     return east, north, c
 
 
+def interpolate_axis(
+    data: np.ndarray, positions: np.ndarray, axis: int
+) -> np.ndarray:
+    """
+    Linear interpolation of data along one axis at the given positions,
+    clamped to the axis bounds (as the spline evaluation does).
+    A value is nan if a neighbour with a non zero weight is nan.
+
+    :param data: 2D data to interpolate
+    :type data: np.ndarray
+    :param positions: increasing positions along the axis
+    :type positions: np.ndarray
+    :param axis: interpolated axis
+    :type axis: int
+    :return: interpolated data (float64)
+    :rtype: np.ndarray
+    """
+    size = data.shape[axis]
+    positions = np.clip(positions, 0, size - 1)
+    idxes_0 = np.floor(positions).astype(np.intp)
+    weights = positions - idxes_0
+    # the next neighbour is only used with a non zero weight
+    idxes_1 = np.where(weights > 0, np.minimum(idxes_0 + 1, size - 1), idxes_0)
+    weights_shape = [1, 1]
+    weights_shape[axis] = -1
+    weights = weights.reshape(weights_shape)
+
+    interpolated = np.take(data, idxes_0, axis=axis).astype(np.float64)
+    interpolated *= 1 - weights
+    interpolated += np.take(data, idxes_1, axis=axis) * weights
+    return interpolated
+
+
+def interpolate_points(
+    data: np.ndarray, rows_pos: np.ndarray, cols_pos: np.ndarray
+) -> np.ndarray:
+    """
+    Bilinear interpolation of data at the given points,
+    clamped to the data bounds (as the spline evaluation does).
+    A value is nan if a neighbour with a non zero weight is nan.
+
+    :param data: 2D data to interpolate
+    :type data: np.ndarray
+    :param rows_pos: points rows positions
+    :type rows_pos: np.ndarray
+    :param cols_pos: points columns positions
+    :type cols_pos: np.ndarray
+    :return: interpolated values (float64)
+    :rtype: np.ndarray
+    """
+    rows_pos = np.clip(rows_pos, 0, data.shape[0] - 1)
+    cols_pos = np.clip(cols_pos, 0, data.shape[1] - 1)
+    rows_0 = np.floor(rows_pos).astype(np.intp)
+    cols_0 = np.floor(cols_pos).astype(np.intp)
+    rows_weights = rows_pos - rows_0
+    cols_weights = cols_pos - cols_0
+    rows_1 = np.where(
+        rows_weights > 0, np.minimum(rows_0 + 1, data.shape[0] - 1), rows_0
+    )
+    cols_1 = np.where(
+        cols_weights > 0, np.minimum(cols_0 + 1, data.shape[1] - 1), cols_0
+    )
+
+    return (1 - rows_weights) * (
+        (1 - cols_weights) * data[rows_0, cols_0]
+        + cols_weights * data[rows_0, cols_1]
+    ) + rows_weights * (
+        (1 - cols_weights) * data[rows_1, cols_0]
+        + cols_weights * data[rows_1, cols_1]
+    )
+
+
+class ShiftInterpolator:
+    """
+    Interpolation of the slave DEM at shifted positions,
+    with nan where an interpolation neighbour is nodata.
+
+    - bilinear: direct separable bilinear interpolation of the DEM
+    - spline: degree 1 RectBivariateSpline interpolations
+      of the nodata filled DEM and of its nodata mask
+    """
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        resampling: str = "bilinear",
+        pool: BlockPool = None,
+    ):
+        """
+        Initialization of the slave DEM interpolation
+
+        :param data: slave DEM, nan for nodata (not copied by bilinear)
+        :type data: np.ndarray
+        :param resampling: 'bilinear' or 'spline'
+        :type resampling: str
+        :param pool: row blocks pool (None for a single block)
+        :type pool: BlockPool or None
+        """
+        self.resampling = resampling
+        self.pool = BlockPool() if pool is None else pool
+        if resampling == "bilinear":
+            self.data = data
+        elif resampling == "spline":
+            xgrid = np.arange(data.shape[1])
+            ygrid = np.arange(data.shape[0])
+            # Since later interpolations will consider nodata values
+            # as normal values, we need to keep track of nodata values
+            # to get rid of them when the time comes
+            nan_maskval = np.isnan(data)
+            dsm_from_filled = np.where(nan_maskval, -9999, data)
+            self.spline_1 = RectBivariateSpline(
+                ygrid, xgrid, dsm_from_filled, kx=1, ky=1
+            )
+            self.spline_2 = RectBivariateSpline(
+                ygrid, xgrid, nan_maskval, kx=1, ky=1
+            )
+        else:
+            raise NameError(
+                "ERROR: Nuth & Kaab resampling ({}) not supported"
+                " (available options are bilinear and spline)".format(
+                    resampling
+                )
+            )
+
+    def grid(self, rows_pos: np.ndarray, cols_pos: np.ndarray) -> np.ndarray:
+        """
+        Interpolate the slave DEM on the rows_pos x cols_pos grid
+
+        :param rows_pos: increasing rows positions
+        :type rows_pos: np.ndarray
+        :param cols_pos: increasing columns positions
+        :type cols_pos: np.ndarray
+        :return: interpolated DEM
+        :rtype: np.ndarray
+        """
+        if self.resampling == "bilinear":
+            # columns interpolation by slave DEM rows blocks,
+            # then rows interpolation by output rows blocks
+            cols_interpolated = concatenate_blocks(
+                self.pool.map_blocks(
+                    lambda block: interpolate_axis(
+                        self.data[block], cols_pos, axis=1
+                    ),
+                    self.data.shape[0],
+                )
+            )
+            return concatenate_blocks(
+                self.pool.map_blocks(
+                    lambda block: interpolate_axis(
+                        cols_interpolated, rows_pos[block], axis=0
+                    ),
+                    rows_pos.shape[0],
+                )
+            )
+
+        def spline_block(block: slice) -> np.ndarray:
+            """interpolation of an output rows block"""
+            znew = self.spline_1(rows_pos[block], cols_pos)
+            nanval_new = self.spline_2(rows_pos[block], cols_pos)
+            # we created nan_maskval so that non nan values are set to 0.
+            # interpolation "creates" values
+            # and the one not affected by nan are the one still equal to 0.
+            # hence, all other values must be considered invalid ones
+            znew[nanval_new != 0] = np.nan
+            return znew
+
+        return concatenate_blocks(
+            self.pool.map_blocks(spline_block, rows_pos.shape[0])
+        )
+
+    def points(self, rows_pos: np.ndarray, cols_pos: np.ndarray) -> np.ndarray:
+        """
+        Interpolate the slave DEM at the given points
+
+        :param rows_pos: points rows positions
+        :type rows_pos: np.ndarray
+        :param cols_pos: points columns positions
+        :type cols_pos: np.ndarray
+        :return: interpolated values
+        :rtype: np.ndarray
+        """
+
+        def points_block(block: slice) -> np.ndarray:
+            """interpolation of a points block"""
+            if self.resampling == "bilinear":
+                return interpolate_points(
+                    self.data, rows_pos[block], cols_pos[block]
+                )
+            znew = self.spline_1.ev(rows_pos[block], cols_pos[block])
+            znew[self.spline_2.ev(rows_pos[block], cols_pos[block]) != 0] = (
+                np.nan
+            )
+            return znew
+
+        return concatenate_blocks(
+            self.pool.map_blocks(points_block, rows_pos.shape[0])
+        )
+
+
+def shift_crop(
+    shape: Tuple[int, int], xoff: float, yoff: float
+) -> Tuple[slice, slice]:
+    """
+    Rows and columns of the dsm grid covered by the slave DEM
+    shifted by (xoff, yoff)
+
+    :param shape: dsm grid shape
+    :type shape: Tuple[int, int]
+    :param xoff: x shift in pixels
+    :type xoff: float
+    :param yoff: y shift in pixels (north oriented)
+    :type yoff: float
+    :return: rows and columns slices
+    :rtype: slice, slice
+    """
+    if xoff >= 0:
+        cols = slice(0, shape[1] - int(np.ceil(xoff)))
+    else:
+        cols = slice(int(np.floor(-xoff)), shape[1])
+    if -yoff >= 0:
+        rows = slice(0, shape[0] - int(np.ceil(-yoff)))
+    else:
+        rows = slice(int(np.floor(yoff)), shape[0])
+    return rows, cols
+
+
+def crop_slope_aspect(
+    dsm: np.ndarray,
+    dsm_slope: np.ndarray,
+    dsm_aspect: np.ndarray,
+    crop: Tuple[slice, slice],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    grad2d slope and aspect of the cropped dsm, from the ones of the dsm:
+    only the crop edges, where np.gradient differences become one-sided,
+    are computed again
+
+    :param dsm: master dsm
+    :type dsm: np.ndarray
+    :param dsm_slope: grad2d slope of the dsm
+    :type dsm_slope: np.ndarray
+    :param dsm_aspect: grad2d aspect of the dsm
+    :type dsm_aspect: np.ndarray
+    :param crop: rows and columns slices of the crop
+    :type crop: Tuple[slice, slice]
+    :return: slope and aspect of the cropped dsm
+    :rtype: np.ndarray, np.ndarray
+    """
+    slope = dsm_slope[crop]
+    aspect = dsm_aspect[crop]
+    if slope.shape == dsm_slope.shape:
+        return slope, aspect
+    slope = slope.copy()
+    aspect = aspect.copy()
+    cropped_dsm = dsm[crop]
+    # np.gradient of two rows (columns) is the one-sided difference
+    for edge, strip, strip_edge in (
+        ((0, slice(None)), (slice(0, 2), slice(None)), (0, slice(None))),
+        ((-1, slice(None)), (slice(-2, None), slice(None)), (1, slice(None))),
+        ((slice(None), 0), (slice(None), slice(0, 2)), (slice(None), 0)),
+        ((slice(None), -1), (slice(None), slice(-2, None)), (slice(None), 1)),
+    ):
+        strip_slope, strip_aspect = grad2d(cropped_dsm[strip])
+        slope[edge] = strip_slope[strip_edge]
+        aspect[edge] = strip_aspect[strip_edge]
+    return slope, aspect
+
+
+def resample_to_shift(
+    interpolator: ShiftInterpolator,
+    dsm: np.ndarray,
+    xoff: float,
+    yoff: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Resample the slave DEM shifted by (xoff, yoff) on the dsm grid,
+    and crop both to the part of the grid the shifted slave DEM covers
+
+    :param interpolator: slave DEM interpolation
+    :type interpolator: ShiftInterpolator
+    :param dsm: master dsm
+    :type dsm: np.ndarray
+    :param xoff: x shift in pixels
+    :type xoff: float
+    :param yoff: y shift in pixels (north oriented)
+    :type yoff: float
+    :return: cropped resampled slave DEM and cropped master dsm
+    :rtype: np.ndarray, np.ndarray
+    """
+    xgrid = np.arange(dsm.shape[1])
+    ygrid = np.arange(dsm.shape[0])
+
+    # resample slave DEM in the new grid
+    # positive y shift moves south
+    znew = interpolator.grid(ygrid - yoff, xgrid + xoff)
+
+    # update DEM
+    crop = shift_crop(dsm.shape, xoff, yoff)
+    coreg_ref = znew[crop]
+    coreg_dsm = dsm[crop]
+
+    return coreg_ref, coreg_dsm
+
+
+def resample_at_shift(
+    interpolator: ShiftInterpolator,
+    shape: Tuple[int, int],
+    rows: np.ndarray,
+    cols: np.ndarray,
+    xoff: float,
+    yoff: float,
+) -> np.ndarray:
+    """
+    Resample the slave DEM shifted by (xoff, yoff) at the given pixels
+    of the dsm grid, pixels the shifted slave DEM does not cover are nan
+
+    :param interpolator: slave DEM interpolation
+    :type interpolator: ShiftInterpolator
+    :param shape: dsm grid shape
+    :type shape: Tuple[int, int]
+    :param rows: pixels rows
+    :type rows: np.ndarray
+    :param cols: pixels columns
+    :type cols: np.ndarray
+    :param xoff: x shift in pixels
+    :type xoff: float
+    :param yoff: y shift in pixels (north oriented)
+    :type yoff: float
+    :return: resampled slave DEM values at the pixels
+    :rtype: np.ndarray
+    """
+    shifted_rows = rows - yoff
+    shifted_cols = cols + xoff
+    znew = interpolator.points(shifted_rows, shifted_cols)
+    znew[
+        (shifted_rows < 0)
+        | (shifted_rows > shape[0] - 1)
+        | (shifted_cols < 0)
+        | (shifted_cols > shape[1] - 1)
+    ] = np.nan
+    return znew
+
+
 def nuth_kaab_lib(
     dsm_dataset: xr.Dataset,
     ref_dataset: xr.Dataset,
     outdir_plot: str = None,
     nb_iters: int = 6,
-) -> Tuple[float, float, float, xr.Dataset, xr.Dataset, xr.Dataset, xr.Dataset]:
+    min_shift_increment: float = None,
+    min_nmad_gain: float = None,
+    sampling_max_points: int = None,
+    sampling_ratio: float = None,
+    sampling_seed: int = 0,
+    resampling: str = "bilinear",
+    plot: str = "full",
+    pool: BlockPool = None,
+) -> Tuple[
+    float, float, float, xr.Dataset, xr.Dataset, xr.Dataset, xr.Dataset, int
+]:
     """
     This is the lib api of nuth and kaab universal coregistration.
     It offers quite the same services as the classic main api
@@ -246,14 +876,42 @@ def nuth_kaab_lib(
     :param outdir_plot: path to output Plot directory
             (plots are printed if set to None)
     :type outdir_plot: str
-    :param nb_iters: Nuth and Kaab method iterations number default: 6
+    :param nb_iters: Nuth and Kaab method maximum iterations number
+            default: 6
     :type nb_iters: int
-    :return: x and y shifts (as 'dsm_dataset + (x,y) = ref_dataset')
+    :param min_shift_increment: iterations stop when an iteration
+            shift is below it, in pixels (None to disable)
+    :type min_shift_increment: float or None
+    :param min_nmad_gain: iterations stop when an iteration decreases
+            the NMAD of the differences by less than it, in percent
+            (None to disable)
+    :type min_nmad_gain: float or None
+    :param sampling_max_points: if set, the shifts are estimated on
+            a random sample of at most this number of valid pixels
+    :type sampling_max_points: int or None
+    :param sampling_ratio: if set, the shifts are estimated on
+            a random sample of at most this ratio of the valid pixels
+    :type sampling_ratio: float or None
+    :param sampling_seed: random sample seed
+    :type sampling_seed: int
+    :param resampling: slave DEM resampling, 'bilinear'
+            or 'spline' (former RectBivariateSpline resampling)
+    :type resampling: str
+    :param plot: plot level, 'none' (no figure, the iterations
+            offsets are still printed), 'summary' (elevation differences
+            and aspect slices medians) or 'full' (decimated targets
+            point clouds as well)
+    :type plot: str
+    :param pool: row blocks pool, running the iterations computations
+            on several threads (None for a single thread)
+    :type pool: BlockPool or None
+    :return: x and y shifts (as 'dsm_dataset + (x,y) = ref_dataset'),
+            and the number of iterations performed
     """
 
-    # Set target dsm grid for interpolation purpose
-    xgrid = np.arange(dsm_dataset["im"].data.shape[1])
-    ygrid = np.arange(dsm_dataset["im"].data.shape[0])
+    sampling = sampling_max_points is not None or sampling_ratio is not None
+    if pool is None:
+        pool = BlockPool()
     # TODO : not used, to clean
     # x_pixels, y_pixels = np.meshgrid(xgrid, ygrid)
     # trans = dsm_dataset["trans"].data
@@ -262,49 +920,90 @@ def nuth_kaab_lib(
     # Ygeo = trans[3] + (x_pixels + 0.5) * trans[4]
     #       + (y_pixels + 0.5) * trans[5]
 
-    initial_dh = ref_dataset["im"].data - dsm_dataset["im"].data
+    initial_dh = block_subtract(
+        ref_dataset["im"].data, dsm_dataset["im"].data, pool
+    )
     coreg_ref = ref_dataset["im"].data
 
     # Display
-    median = np.median(initial_dh[np.isfinite(initial_dh)])
-    nmad_old = 1.4826 * np.median(
-        np.abs(initial_dh[np.isfinite(initial_dh)] - median)
-    )
+    # median and NMAD scratch buffer, reused by the iterations
+    robust_stats = RobustStats()
+    median, nmad_old = block_median_nmad(initial_dh, pool, robust_stats)
     maxval = 3 * nmad_old
-    pl.figure(1, figsize=(7.0, 8.0))
-    pl.imshow(initial_dh, vmin=-maxval, vmax=maxval)
-    color_bar = pl.colorbar()
-    color_bar.set_label("Elevation difference (m)")
-    if outdir_plot:
-        pl.savefig(
-            os.path.join(outdir_plot, "ElevationDiff_BeforeCoreg.png"),
-            dpi=100,
-            bbox_inches="tight",
+    if plot != "none":
+        # draw at most PLOT_MAX_SIZE rows and columns,
+        # more than the figure resolution
+        step = int(np.ceil(max(initial_dh.shape) / PLOT_MAX_SIZE))
+        pl.figure(1, figsize=(7.0, 8.0))
+        pl.imshow(
+            initial_dh[::step, ::step],
+            vmin=-maxval,
+            vmax=maxval,
+            extent=(
+                -0.5,
+                initial_dh.shape[1] - 0.5,
+                initial_dh.shape[0] - 0.5,
+                -0.5,
+            ),
         )
-    else:
-        pl.show()
-    pl.close()
-
-    # Since later interpolations will consider nodata values as normal values,
-    # we need to keep track of nodata values
-    # to get rid of them when the time comes
-    nan_maskval = np.isnan(coreg_ref)
-    dsm_from_filled = np.where(nan_maskval, -9999, coreg_ref)
-
-    # Create spline function for interpolation
-    spline_1 = RectBivariateSpline(ygrid, xgrid, dsm_from_filled, kx=1, ky=1)
-    spline_2 = RectBivariateSpline(ygrid, xgrid, nan_maskval, kx=1, ky=1)
+        color_bar = pl.colorbar()
+        color_bar.set_label("Elevation difference (m)")
+        if outdir_plot:
+            save_figure(
+                pl.gcf(),
+                os.path.join(outdir_plot, "ElevationDiff_BeforeCoreg.png"),
+                dpi=100,
+                bbox_inches="tight",
+            )
+        else:
+            pl.show()
+            pl.close()
+
+    # Slave DEM interpolation at the shifted positions
+    interpolator = ShiftInterpolator(
+        coreg_ref, resampling=resampling, pool=pool
+    )
     xoff, yoff, zoff = 0, 0, 0
 
     print("Nuth & Kaab iterations: {}".format(nb_iters))
     coreg_dsm = dsm_dataset["im"].data
+    if sampling:
+        # The shifts are estimated on a sample of the valid pixels:
+        # the master dsm is not resampled so its slope and aspect
+        # are computed once, the slave DEM is only resampled
+        # at the sample pixels in the iterations
+        rows, cols = sample_valid_pixels(
+            np.isfinite(initial_dh),
+            max_points=sampling_max_points,
+            ratio=sampling_ratio,
+            seed=sampling_seed,
+        )
+        print("Nuth & Kaab sample: {} pixels".format(rows.size))
+        coreg_dsm = coreg_dsm[rows, cols]
+        coreg_ref = coreg_ref[rows, cols]
+        sample_slope, sample_aspect = grad2d_at(
+            dsm_dataset["im"].data, rows, cols
+        )
+    else:
+        # The master dsm is only cropped in the iterations: its slope and
+        # aspect are computed once and cropped in step with it
+        # (see crop_slope_aspect)
+        dsm_slope, dsm_aspect = grad2d(coreg_dsm)
+        crop = (slice(None), slice(None))
+    nb_iters_done = 0
     for i in range(nb_iters):
-        # remove bias
-        coreg_ref -= median
+        # remove bias (not in place: the slave DEM
+        # is the bilinear interpolation source)
+        coreg_ref = block_subtract(coreg_ref, median, pool)
 
         # Elevation difference
-        dh = coreg_dsm - coreg_ref
-        slope, aspect = grad2d(coreg_dsm)
+        dh = block_subtract(coreg_dsm, coreg_ref, pool)
+        if sampling:
+            slope, aspect = sample_slope, sample_aspect
+        else:
+            slope, aspect = crop_slope_aspect(
+                dsm_dataset["im"].data, dsm_slope, dsm_aspect, crop
+            )
 
         # compute offset
         if outdir_plot:
@@ -314,7 +1013,7 @@ def nuth_kaab_lib(
         else:
             plotfile = None
         east, north, z = nuth_kaab_single_iter(
-            dh, slope, aspect, plot_file=plotfile
+            dh, slope, aspect, plot_file=plotfile, plot=plot, pool=pool
         )
         print(
             "# {} - Offset in pixels : "
@@ -325,44 +1024,24 @@ def nuth_kaab_lib(
         yoff += north
         zoff += z
 
-        # resample slave DEM in the new grid
-        # spline 1 : positive y shift moves south
-        znew = spline_1(ygrid - yoff, xgrid + xoff)
-        nanval_new = spline_2(ygrid - yoff, xgrid + xoff)
-
-        # we created nan_maskval so that non nan values are set to 0.
-        # interpolation "creates" values
-        # and the one not affected by nan are the one still equal to 0.
-        # hence, all other values must be considered invalid ones
-        znew[nanval_new != 0] = np.nan
-
-        # update DEM
-        if xoff >= 0:
-            coreg_ref = znew[:, 0 : znew.shape[1] - int(np.ceil(xoff))]
-            coreg_dsm = dsm_dataset["im"].data[
-                :, 0 : dsm_dataset["im"].data.shape[1] - int(np.ceil(xoff))
-            ]
-        else:
-            coreg_ref = znew[:, int(np.floor(-xoff)) : znew.shape[1]]
-            coreg_dsm = dsm_dataset["im"].data[
-                :, int(np.floor(-xoff)) : dsm_dataset["im"].data.shape[1]
-            ]
-        if -yoff >= 0:
-            coreg_ref = coreg_ref[0 : znew.shape[0] - int(np.ceil(-yoff)), :]
-            coreg_dsm = coreg_dsm[
-                0 : dsm_dataset["im"].data.shape[0] - int(np.ceil(-yoff)), :
-            ]
+        if sampling:
+            coreg_ref = resample_at_shift(
+                interpolator,
+                dsm_dataset["im"].data.shape,
+                rows,
+                cols,
+                xoff,
+                yoff,
+            )
         else:
-            coreg_ref = coreg_ref[int(np.floor(yoff)) : znew.shape[0], :]
-            coreg_dsm = coreg_dsm[
-                int(np.floor(yoff)) : dsm_dataset["im"].data.shape[0], :
-            ]
+            coreg_ref, coreg_dsm = resample_to_shift(
+                interpolator, dsm_dataset["im"].data, xoff, yoff
+            )
+            crop = shift_crop(dsm_dataset["im"].data.shape, xoff, yoff)
 
         # print some statistics
-        diff = coreg_ref - coreg_dsm
-        diff = diff[np.isfinite(diff)]
-        nmad_new = 1.4826 * np.median(np.abs(diff - np.median(diff)))
-        median = np.median(diff)
+        diff = block_subtract(coreg_ref, coreg_dsm, pool)
+        median, nmad_new = block_median_nmad(diff, pool, robust_stats)
 
         print(
             (
@@ -371,8 +1050,37 @@ def nuth_kaab_lib(
                 )
             )
         )
+        nb_iters_done = i + 1
+
+        # stop when converged
+        if (
+            min_shift_increment is not None
+            and np.hypot(east, north) < min_shift_increment
+        ):
+            print(
+                "Nuth & Kaab converged: shift increment below {} pixels".format(
+                    min_shift_increment
+                )
+            )
+            break
+        if (
+            min_nmad_gain is not None
+            and (nmad_old - nmad_new) / nmad_old * 100 < min_nmad_gain
+        ):
+            print(
+                "Nuth & Kaab converged: NMAD gain below {} %".format(
+                    min_nmad_gain
+                )
+            )
+            break
         nmad_old = nmad_new
 
+    if sampling:
+        # Full resolution resampling, once with the final shifts
+        coreg_ref, coreg_dsm = resample_to_shift(
+            interpolator, dsm_dataset["im"].data, xoff, yoff
+        )
+
     print(
         "Nuth & Kaab Final Offset in pixels (east, north):"
         "({:.2f},{:.2f})\n".format(xoff, yoff)
@@ -386,10 +1094,13 @@ def nuth_kaab_lib(
         coreg_ref, from_dataset=dsm_dataset, no_data=-32768
     )
     initial_dh_dataset = read_img_from_array(
-        initial_dh, from_dataset=dsm_dataset, no_data=-32768
+        initial_dh, from_dataset=dsm_dataset, no_data=-32768, copy_array=False
     )
     final_dh_dataset = read_img_from_array(
-        coreg_ref - coreg_dsm, from_dataset=dsm_dataset, no_data=-32768
+        coreg_ref - coreg_dsm,
+        from_dataset=dsm_dataset,
+        no_data=-32768,
+        copy_array=False,
     )
 
     return (
@@ -400,6 +1111,7 @@ def nuth_kaab_lib(
         coreg_ref_dataset,
         initial_dh_dataset,
         final_dh_dataset,
+        nb_iters_done,
     )
 
 
@@ -472,6 +1184,7 @@ def run(
         coreg_ref_dataset,
         init_dh_dataset,
         final_dh_dataset,
+        _,
     ) = nuth_kaab_lib(
         reproj_dem, reproj_ref, nb_iters=nb_iters, outdir_plot=outdir_plot
     )
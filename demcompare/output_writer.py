@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains the background writer of demcompare outputs
+(rasters and plots), so that computations go on during disk writes.
+"""
+
+# Standard imports
+import io
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+# Third party imports
+import matplotlib.pyplot as mpl_pyplot
+
+
+class OutputWriter:
+    """
+    Queue of output writing jobs run by a threads pool.
+
+    Jobs are submitted with the path they write, a later job on the
+    same path waits for the previous one, and readers of a path
+    can wait for its pending jobs (see wait).
+    All jobs are waited for by flush, which raises the first job error.
+    With no thread, jobs are run at submission.
+    """
+
+    def __init__(self, nb_threads: int = 0):
+        """
+        Initialization of an output writer
+
+        :param nb_threads: number of writing threads,
+                0 to write synchronously
+        :type nb_threads: int
+        """
+        self.nb_threads = 0
+        self._executor = None
+        self._pending: Dict[str, List[Future]] = {}
+        self._lock = threading.Lock()
+        self.set_threads(nb_threads)
+
+    def set_threads(self, nb_threads: int):
+        """
+        Set the number of writing threads, pending jobs are flushed first
+
+        :param nb_threads: number of writing threads,
+                0 to write synchronously
+        :type nb_threads: int
+        """
+        if nb_threads == self.nb_threads:
+            return
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.nb_threads = nb_threads
+        if nb_threads > 0:
+            self._executor = ThreadPoolExecutor(
+                max_workers=nb_threads, thread_name_prefix="demcompare_writer"
+            )
+
+    def submit(self, path: str, func: Callable, *args, **kwargs):
+        """
+        Submit a job writing path
+
+        :param path: path written by the job
+        :type path: str
+        :param func: job function
+        :type func: Callable
+        :param args: job function arguments
+        :param kwargs: job function keyword arguments
+        """
+        if self._executor is None:
+            func(*args, **kwargs)
+            return
+        # keep the writing order of a same path
+        self.wait(path)
+        future = self._executor.submit(func, *args, **kwargs)
+        with self._lock:
+            self._pending.setdefault(os.path.abspath(path), []).append(future)
+
+    def wait(self, path: str):
+        """
+        Wait for the pending jobs writing path, raising their errors
+
+        :param path: written path
+        :type path: str
+        """
+        with self._lock:
+            futures = self._pending.pop(os.path.abspath(path), [])
+        for future in futures:
+            future.result()
+
+    def flush(self, raise_errors: bool = True):
+        """
+        Wait for all pending jobs
+
+        :param raise_errors: raise the first job error if True,
+                only log the errors otherwise
+        :type raise_errors: bool
+        """
+        with self._lock:
+            futures = [
+                future
+                for path_futures in self._pending.values()
+                for future in path_futures
+            ]
+            self._pending = {}
+        first_error = None
+        for future in futures:
+            error = future.exception()
+            if error is not None:
+                logging.error("Output writing error: {}".format(error))
+                if first_error is None:
+                    first_error = error
+        if first_error is not None and raise_errors:
+            raise first_error
+
+
+# Outputs writer of the run, see set_writer_threads
+OUTPUT_WRITER = OutputWriter()
+
+
+def set_writer_threads(nb_threads: int):
+    """
+    Set the number of threads writing the run outputs,
+    0 to write synchronously
+
+    :param nb_threads: number of writing threads
+    :type nb_threads: int
+    """
+    OUTPUT_WRITER.set_threads(nb_threads)
+
+
+def writes_in_background() -> bool:
+    """
+    Whether the run outputs are written in the background
+
+    :return: True if the run outputs writer has threads
+    :rtype: bool
+    """
+    return OUTPUT_WRITER.nb_threads > 0
+
+
+def submit_output(path: str, func: Callable, *args, **kwargs):
+    """
+    Submit a job writing path to the run outputs writer
+
+    :param path: path written by the job
+    :type path: str
+    :param func: job function
+    :type func: Callable
+    :param args: job function arguments
+    :param kwargs: job function keyword arguments
+    """
+    OUTPUT_WRITER.submit(path, func, *args, **kwargs)
+
+
+def wait_output(path: str):
+    """
+    Wait for the pending writing of path
+
+    :param path: written path
+    :type path: str
+    """
+    OUTPUT_WRITER.wait(path)
+
+
+def flush_outputs(raise_errors: bool = True):
+    """
+    Wait for all the pending outputs writing
+
+    :param raise_errors: raise the first writing error if True,
+            only log the errors otherwise
+    :type raise_errors: bool
+    """
+    OUTPUT_WRITER.flush(raise_errors=raise_errors)
+
+
+def write_bytes(path: str, content: bytes):
+    """
+    Write bytes in a file
+
+    :param path: file path
+    :type path: str
+    :param content: file content
+    :type content: bytes
+    """
+    with open(path, "wb") as output_file:
+        output_file.write(content)
+
+
+def save_figure(fig, plot_file: str, **savefig_kwargs):
+    """
+    Save a matplotlib figure and close it.
+    Matplotlib is not thread safe: the figure is rendered in
+    the calling thread, only the file is written in the background.
+
+    :param fig: figure to save
+    :type fig: matplotlib.figure.Figure
+    :param plot_file: path of the saved plot
+    :type plot_file: str
+    :param savefig_kwargs: matplotlib savefig keyword arguments
+    """
+    mpl_pyplot.close(fig)
+    if "format" not in savefig_kwargs:
+        # format given by the file extension, as savefig does for paths
+        savefig_kwargs["format"] = os.path.splitext(plot_file)[1][1:] or None
+    buffer = io.BytesIO()
+    fig.savefig(buffer, **savefig_kwargs)
+    submit_output(plot_file, write_bytes, plot_file, buffer.getvalue())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains the robust statistics (median and NMAD)
+of demcompare, computed by selection in a scratch buffer
+reused across calls.
+"""
+
+# Standard imports
+from typing import Tuple
+
+# Third party imports
+import numpy as np
+
+# Normalized median absolute deviation factor
+NMAD_FACTOR = 1.4826
+
+
+def select_median(values: np.ndarray):
+    """
+    Median of a 1D array by selection, equal to numpy median.
+    The values are reordered in place.
+
+    :param values: values (without nan)
+    :type values: np.ndarray
+    :return: median (nan if there is no value)
+    :rtype: values dtype scalar
+    """
+    nb_values = values.size
+    if nb_values == 0:
+        return np.float64(np.nan)
+    middle = nb_values // 2
+    if nb_values % 2:
+        values.partition(middle)
+        return values[middle]
+    values.partition([middle - 1, middle])
+    # mean of the two middle values, in the values dtype as numpy median
+    return np.mean(values[middle - 1 : middle + 1])
+
+
+class RobustStats:
+    """
+    Median and NMAD of arrays valid values, selected in a scratch buffer
+    kept between calls instead of numpy median sorting copies.
+    """
+
+    def __init__(self):
+        """
+        Initialization of the robust statistics scratch buffer
+        """
+        self._scratch = None
+
+    def load(self, data: np.ndarray, valid: np.ndarray = None) -> np.ndarray:
+        """
+        Copy the valid values of data in the scratch buffer
+
+        :param data: data
+        :type data: np.ndarray
+        :param valid: valid values mask (default: not nan values)
+        :type valid: np.ndarray or None
+        :return: scratch buffer view on the valid values
+        :rtype: np.ndarray
+        """
+        data = np.asarray(data)
+        if valid is None:
+            valid = ~np.isnan(data)
+        nb_values = np.count_nonzero(valid)
+        if (
+            self._scratch is None
+            or self._scratch.dtype != data.dtype
+            or self._scratch.size < nb_values
+        ):
+            self._scratch = np.empty(nb_values, dtype=data.dtype)
+        values = self._scratch[:nb_values]
+        np.compress(valid.ravel(), data.ravel(), out=values)
+        return values
+
+    def median(
+        self, data: np.ndarray, center: float = None, valid: np.ndarray = None
+    ):
+        """
+        Median of the valid values of data, or of their absolute deviation
+        to center if set, equal to numpy median
+
+        :param data: data
+        :type data: np.ndarray
+        :param center: if set, median of abs(data - center)
+        :type center: float or None
+        :param valid: valid values mask (default: not nan values)
+        :type valid: np.ndarray or None
+        :return: median
+        :rtype: data dtype scalar
+        """
+        values = self.load(data, valid)
+        if center is not None:
+            np.subtract(values, center, out=values)
+            np.abs(values, out=values)
+        return select_median(values)
+
+    def median_nmad(
+        self, data: np.ndarray, valid: np.ndarray = None
+    ) -> Tuple[float, float]:
+        """
+        Median and NMAD (1.4826 * median of the absolute deviations
+        to the median) of the valid values of data,
+        loaded once in the scratch buffer
+
+        :param data: data
+        :type data: np.ndarray
+        :param valid: valid values mask (default: not nan values)
+        :type valid: np.ndarray or None
+        :return: median, nmad
+        :rtype: float, float
+        """
+        values = self.load(data, valid)
+        median = select_median(values)
+        np.subtract(values, median, out=values)
+        np.abs(values, out=values)
+        return median, NMAD_FACTOR * select_median(values)
@@ -40,14 +40,20 @@ import matplotlib.pyplot as mpl_pyplot
 # Third party imports
 import numpy as np
 import xarray as xr
-from astropy import units as u
 from matplotlib import gridspec
 from scipy.optimize import curve_fit
 
 # DEMcompare imports
-from .img_tools import read_image, read_img_from_array, save_tif
+from .img_tools import (
+    read_image,
+    read_img_from_array,
+    save_tif,
+    to_meter_factor,
+)
 from .output_tree_design import get_out_file_path
+from .output_writer import save_figure
 from .partition import FusionPartition, NotEnoughDataToPartitionError, Partition
+from .robust_stats import RobustStats
 
 
 class NoPointsToPlot(Exception):
@@ -117,7 +123,7 @@ def compute_stats_array(
     ref_a3d = read_img_from_array(ref, no_data=ref_nodata)
 
     final_dh = dem_a3d["im"].data - ref_a3d["im"].data
-    final_dh_a3d = read_img_from_array(final_dh)
+    final_dh_a3d = read_img_from_array(final_dh, copy_array=False)
 
     if final_json_file is None:
         final_json_file = cfg["outputDir"] + "/final_stats.json"
@@ -376,7 +382,9 @@ def create_masks(
 
 
 def stats_computation(
-    array: np.ndarray, list_threshold: List[int] = None
+    array: np.ndarray,
+    list_threshold: List[int] = None,
+    robust_stats: RobustStats = None,
 ) -> Dict:
     """
     Compute stats for a specific array
@@ -386,10 +394,16 @@ def stats_computation(
     :param list_threshold: list, defines thresholds
             to be used for pixels above thresholds ratio computation
     :type list_threshold: List[int]
+    :param robust_stats: median and nmad scratch buffer,
+            to be reused across calls
+    :type robust_stats: RobustStats
     :return: dict with stats name and values
     :rtype: Dict
     """
     if array.size:
+        if robust_stats is None:
+            robust_stats = RobustStats()
+        median, nmad = robust_stats.median_nmad(array)
         res = {
             "nbpts": array.size,
             "max": round(float(np.max(array)), 5),
@@ -397,13 +411,8 @@ def stats_computation(
             "mean": round(float(np.mean(array)), 5),
             "std": round(float(np.std(array)), 5),
             "rmse": round(float(np.sqrt(np.mean(array * array)))),
-            "median": round(float(np.nanmedian(array)), 5),
-            "nmad": round(
-                float(
-                    1.4826 * np.nanmedian(np.abs(array - np.nanmedian(array)))
-                ),
-                5,
-            ),
+            "median": round(float(median), 5),
+            "nmad": round(float(nmad), 5),
             "sum_err": round(float(np.sum(array)), 5),
             "sum_err.err": round(float(np.sum(array * array)), 5),
         }
@@ -448,6 +457,7 @@ def get_stats(
     sets_names: List[str] = None,
     list_threshold: List[int] = None,
     outliers_free_mask=None,
+    nb_total_points: int = None,
 ) -> List[Dict]:
     """
     Get Stats for a specific array, considering
@@ -470,6 +480,9 @@ def get_stats(
     :type list_threshold: List[int]
     :param outliers_free_mask:
     :type outliers_free_mask:
+    :param nb_total_points: number of points the percentages refer to
+            (default: dz_values size)
+    :type nb_total_points: int or None
     :return: list of dictionary (set_name, nbpts,
              %(out_of_all_pts), max, min, mean, std, rmse, ...)
     :rtype: List[Dict]
@@ -490,7 +503,9 @@ def get_stats(
 
     # Init
     output_list = []
-    nb_total_points = dz_values.size
+    robust_stats = RobustStats()
+    if nb_total_points is None:
+        nb_total_points = dz_values.size
     # - if a mask is not set,
     # we set it with True values only so that it has no effect
     if to_keep_mask is None:
@@ -508,6 +523,7 @@ def get_stats(
                 )
             ],
             list_threshold,
+            robust_stats,
         )
     )
     # - we add standard information for later use
@@ -531,7 +547,9 @@ def get_stats(
             set_item = sets[set_idx] * to_keep_mask * outliers_free_mask
 
             data = dz_values[np.where(set_item == True)]  # noqa: E712
-            output_list.append(stats_computation(data, list_threshold))
+            output_list.append(
+                stats_computation(data, list_threshold, robust_stats)
+            )
             output_list[set_idx + 1]["set_label"] = sets_labels[set_idx]
             output_list[set_idx + 1]["set_name"] = sets_names[set_idx]
             output_list[set_idx + 1]["%"] = round(
@@ -600,10 +618,10 @@ def dem_diff_plot(
     # Show or Save
     #
     if display is False:
-        mpl_pyplot.savefig(plot_file, dpi=100, bbox_inches="tight")
+        save_figure(fig, plot_file, dpi=100, bbox_inches="tight")
     else:
         mpl_pyplot.show()
-    mpl_pyplot.close()
+        mpl_pyplot.close()
 
 
 def dem_diff_cdf_plot(
@@ -685,10 +703,10 @@ def dem_diff_cdf_plot(
 
     # Show or Save
     if display is False:
-        fig.savefig(plot_file, dpi=100, bbox_inches="tight")
+        save_figure(fig, plot_file, dpi=100, bbox_inches="tight")
     else:
         fig.show()
-    mpl_pyplot.close()
+        mpl_pyplot.close()
 
 
 def dem_diff_pdf_plot(
@@ -776,14 +794,15 @@ def dem_diff_pdf_plot(
 
     if display is False:
         # Save histogram to .png image
-        mpl_pyplot.savefig(
+        save_figure(
+            fig0,
             plot_file,
             dpi=100,
             bbox_inches="tight",
         )
     else:
         mpl_pyplot.show()
-    mpl_pyplot.close(fig0)
+        mpl_pyplot.close(fig0)
 
 
 def plot_histograms(  # noqa: C901
@@ -921,7 +940,8 @@ def plot_histograms(  # noqa: C901
         )
         fig1_ax.legend()
         if display is False:
-            fig1.savefig(
+            save_figure(
+                fig1,
                 os.path.join(
                     outplotdir,
                     "AltiErrors_RealHistrograms_" + save_prefix + ".png",
@@ -933,9 +953,9 @@ def plot_histograms(  # noqa: C901
             mpl_pyplot.figure(1)
             mpl_pyplot.show()
 
-        # Check fig1 to close
-        mpl_pyplot.figure(1)
-        mpl_pyplot.close()
+            # Check fig1 to close
+            mpl_pyplot.figure(1)
+            mpl_pyplot.close()
         # TODO : add in saved_files return ?
 
     # Figure 2 : Two plots fitted by gaussian histograms & classes contributions
@@ -1049,7 +1069,8 @@ def plot_histograms(  # noqa: C901
 
     # Figure 2 Plot save or show
     if display is False:
-        fig2.savefig(
+        save_figure(
+            fig2,
             os.path.join(
                 outplotdir,
                 "AltiErrors-Histograms_FittedWithGaussians_"
@@ -1063,9 +1084,9 @@ def plot_histograms(  # noqa: C901
         mpl_pyplot.figure(2)
         mpl_pyplot.show()
 
-    # Check figure2 to close
-    mpl_pyplot.figure(2)
-    mpl_pyplot.close()
+        # Check figure2 to close
+        mpl_pyplot.figure(2)
+        mpl_pyplot.close()
 
     return saved_files, saved_labels, saved_colors
 
@@ -1393,7 +1414,7 @@ def alti_diff_stats(
             # since all DEMcompare elevation unit is "meter"
             original_unit = cfg["stats_opts"]["elevation_thresholds"]["zunit"]
             list_threshold_m = [
-                ((threshold * u.Unit(original_unit)).to(u.meter)).value
+                threshold * to_meter_factor(original_unit)
                 for threshold in cfg["stats_opts"]["elevation_thresholds"][
                     "list"
                 ]
@@ -1624,6 +1645,8 @@ def get_stats_per_mode(
                 sets_labels=sets_labels,
                 sets_names=sets_names,
                 list_threshold=elevation_thresholds,
+                # points of a tile core only, if data is a tile
+                nb_total_points=data.attrs.get("nb_points"),
             )
         )
 
@@ -1669,6 +1692,6 @@ def wave_detection(cfg: Dict, dh):
         )
 
         georaster = read_img_from_array(
-            res[dim], from_dataset=dh, no_data=-32768
+            res[dim], from_dataset=dh, no_data=-32768, copy_array=False
         )
         save_tif(georaster, cfg["stats_results"]["images"][dim]["path"])
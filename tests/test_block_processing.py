@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains functions to test demcompare
+block_processing module.
+"""
+
+# Third party imports
+import numpy as np
+import pytest
+
+# Demcompare imports
+from demcompare.block_processing import (
+    BlockPool,
+    block_median,
+    block_subtract,
+)
+
+
+@pytest.mark.unit_tests
+def test_block_median():
+    """
+    Test that block_median gives the numpy median of the finite values,
+    and of their absolute deviation to a center, with several threads
+    blocks (odd and even numbers of values, ties, nan values).
+    """
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 10, (101, 37))
+    data[rng.random(data.shape) < 0.1] = np.nan
+    data[::7, ::3] = 1.5
+    with BlockPool(3) as pool:
+        for values in (data, data[:, :-1].astype(np.float32), data[:, 0]):
+            finite = values[np.isfinite(values)]
+            median = np.median(finite)
+            assert block_median(values, pool) == median
+            assert block_median(values, pool, center=median) == np.median(
+                np.abs(finite - median)
+            )
+        assert block_median(np.full((10, 10), 2.0), pool) == 2.0
+        assert block_median(data[:, :1] + 1, pool) == np.median(
+            data[:, :1][np.isfinite(data[:, :1])] + 1
+        )
+
+
+@pytest.mark.unit_tests
+def test_block_subtract():
+    """
+    Test that block_subtract with several threads blocks
+    gives the numpy difference with an array or a scalar.
+    """
+    rng = np.random.default_rng(0)
+    left = rng.normal(0, 10, (50, 20)).astype(np.float32)
+    right = rng.normal(0, 10, (50, 20))
+    with BlockPool(3) as pool:
+        np.testing.assert_array_equal(
+            block_subtract(left, right, pool), left - right
+        )
+        np.testing.assert_array_equal(
+            block_subtract(left, 1.5, pool), left - 1.5
+        )
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains functions to test demcompare coregistration module.
+"""
+
+# Standard imports
+import os
+from tempfile import TemporaryDirectory
+
+# Third party imports
+import numpy as np
+import pytest
+
+# Demcompare imports
+from demcompare.coregistration import (
+    coregister_with_nuth_and_kaab,
+    coregister_with_nuth_and_kaab_pyramid,
+    estimate_initial_disparity,
+)
+from demcompare.img_tools import read_img, read_img_from_array
+
+# Tests helpers
+from .helpers import demcompare_test_data_path, temporary_dir
+
+
+@pytest.mark.unit_tests
+def test_estimate_initial_disparity():
+    """
+    Test that estimate_initial_disparity recovers the disparity
+    of a shifted, biased and noisy DEM, such that
+    ref(row + y, col + x) = dem(row, col), with and without
+    downsampling.
+    """
+    dem = read_img(
+        os.path.join(
+            demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+        ),
+        no_data=-32768,
+    )
+    data = dem["im"].data
+    rng = np.random.default_rng(0)
+    size = 800
+    for row_shift, col_shift in ((37, -21), (-3, 2)):
+        dem_data = data[60 : 60 + size, 60 : 60 + size]
+        ref_data = (
+            data[
+                60 + row_shift : 60 + row_shift + size,
+                60 + col_shift : 60 + col_shift + size,
+            ]
+            + 3
+            + rng.normal(0, 2, (size, size))
+        ).astype(np.float32)
+        ref_data[:100] = np.nan
+        for max_size in (128, 1024):
+            assert estimate_initial_disparity(
+                read_img_from_array(dem_data),
+                read_img_from_array(ref_data),
+                max_size=max_size,
+            ) == (-col_shift, -row_shift)
+
+
+@pytest.mark.unit_tests
+def test_coregister_with_nuth_and_kaab_pyramid():
+    """
+    Test that coregister_with_nuth_and_kaab_pyramid recovers the offset
+    of a shifted, biased and noisy DEM, such that
+    ref(row - y, col + x) - z = dem(row, col), as
+    coregister_with_nuth_and_kaab does with enough iterations.
+    """
+    srtm = read_img(
+        os.path.join(
+            demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+        ),
+        no_data=-32768,
+    )
+    data = srtm["im"].data
+    rng = np.random.default_rng(0)
+    size = 400
+    # x=-17, y=-12, z=3
+    dem = read_img_from_array(
+        data[60 : 60 + size, 60 : 60 + size], from_dataset=srtm
+    )
+    ref = read_img_from_array(
+        (
+            data[48 : 48 + size, 77 : 77 + size]
+            + 3
+            + rng.normal(0, 0.5, (size, size))
+        ).astype(np.float32),
+        from_dataset=srtm,
+    )
+
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+        pyramid_results = coregister_with_nuth_and_kaab_pyramid(
+            dem, ref, tmp_dir=tmp_dir, plot="none"
+        )
+        # no levels plots directories without plots
+        assert not os.listdir(tmp_dir)
+        results = coregister_with_nuth_and_kaab(
+            dem, ref, tmp_dir=tmp_dir, nb_iters=15, plot="none"
+        )
+
+    np.testing.assert_allclose(pyramid_results[:2], (-17, -12), atol=0.01)
+    np.testing.assert_allclose(pyramid_results[:2], results[:2], atol=0.01)
+    # the final differences median is the z bias
+    np.testing.assert_allclose(
+        [
+            np.nanmedian(pyramid_results[5]["im"].data),
+            np.nanmedian(results[5]["im"].data),
+        ],
+        3,
+        atol=0.01,
+    )
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains functions to test demcompare
+coregistration_cache module.
+"""
+
+# Standard imports
+import os
+import time
+from tempfile import TemporaryDirectory
+
+# Third party imports
+import pytest
+
+# Demcompare imports
+from demcompare.coregistration_cache import (
+    DIGESTS_DIR,
+    ENTRY_FILE,
+    CoregistrationCache,
+    start_run,
+)
+
+
+def write_file(path: str, content: bytes):
+    """
+    Write a test file with a given content
+
+    :param path: file path
+    :type path: str
+    :param content: file content
+    :type content: bytes
+    """
+    with open(path, "wb") as test_file:
+        test_file.write(content)
+
+
+@pytest.mark.unit_tests
+def test_coregistration_cache():
+    """
+    Test that the coregistration cache key depends on the inputs contents
+    and the coregistration options only, that stored entries are loaded
+    back with their rasters, and that the least recently used entries
+    are evicted beyond the maximum size, except the ones used since
+    the run start.
+    """
+    with TemporaryDirectory() as tmp_dir:
+        dem_path = os.path.join(tmp_dir, "dem.tif")
+        ref_path = os.path.join(tmp_dir, "ref.tif")
+        write_file(dem_path, b"dem")
+        write_file(ref_path, b"ref")
+        cfg = {
+            "inputDSM": {"path": dem_path, "zunit": "m"},
+            "inputRef": {"path": ref_path, "zunit": "m"},
+            "plani_opts": {
+                "method_name": "nuth_kaab",
+                "coregistration_plot": "full",
+                "coregistration_threads": 1,
+            },
+        }
+        cache = CoregistrationCache(os.path.join(tmp_dir, "cache"), 0.001)
+        key = cache.key(cfg)
+
+        # ignored options and inputs paths do not change the key
+        cfg["plani_opts"]["coregistration_plot"] = "none"
+        cfg["plani_opts"]["coregistration_threads"] = 4
+        other_ref_path = os.path.join(tmp_dir, "other_ref.tif")
+        write_file(other_ref_path, b"ref")
+        cfg["inputRef"]["path"] = other_ref_path
+        assert cache.key(cfg) == key
+        # coregistration options and inputs contents do
+        cfg["plani_opts"]["method_name"] = "least_squares"
+        assert cache.key(cfg) != key
+        cfg["plani_opts"]["method_name"] = "nuth_kaab"
+        write_file(other_ref_path, b"other ref")
+        other_key = cache.key(cfg)
+        assert other_key != key
+
+        assert cache.load(key) is None
+        raster_path = os.path.join(tmp_dir, "final_dh.tif")
+        write_file(raster_path, b"0" * 600)
+        cache.store(key, {"dx": 1.5}, rasters={"final_dh": raster_path})
+        entry = cache.load(key)
+        assert entry["dx"] == 1.5
+        with open(entry["rasters"]["final_dh"], "rb") as raster_file:
+            assert raster_file.read() == b"0" * 600
+
+        # beyond 1000 bytes, the entry used in the current run is kept
+        start_run()
+        assert cache.load(key) is not None
+        cache.store(other_key, {"dx": 2.5}, rasters={"final_dh": raster_path})
+        assert cache.load(key) is not None
+        assert cache.load(other_key)["dx"] == 2.5
+
+        # the least recently used entry is evicted, once used before the run
+        entry_path = os.path.join(cache.entry_dir(key), ENTRY_FILE)
+        os.utime(entry_path, (time.time() - 60, time.time() - 60))
+        start_run()
+        cache.evict(keep=[other_key])
+        assert cache.load(key) is None
+        assert cache.load(other_key)["dx"] == 2.5
+        # no remaining temporary or removed entry
+        assert sorted(os.listdir(cache.cache_dir)) == sorted(
+            [DIGESTS_DIR, other_key]
+        )
+
+
+@pytest.mark.unit_tests
+def test_coregistration_cache_concurrent_runs():
+    """
+    Test that an entry stored by concurrent runs on the same inputs
+    is kept, that an incomplete entry directory is replaced, and that
+    the files digests of concurrent runs are kept per file.
+    """
+    with TemporaryDirectory() as tmp_dir:
+        cache_dir = os.path.join(tmp_dir, "cache")
+        cache = CoregistrationCache(cache_dir)
+        other_cache = CoregistrationCache(cache_dir)
+
+        # the same entry stored by two runs: the first one is kept
+        raster_path = os.path.join(tmp_dir, "final_dh.tif")
+        write_file(raster_path, b"0" * 600)
+        cache.store("key", {"dx": 1.5}, rasters={"final_dh": raster_path})
+        other_cache.store("key", {"dx": 1.5, "run": 2})
+        entry = cache.load("key")
+        assert "run" not in entry
+        assert os.path.isfile(entry["rasters"]["final_dh"])
+
+        # an incomplete entry directory is replaced
+        os.makedirs(cache.entry_dir("other_key"))
+        write_file(os.path.join(cache.entry_dir("other_key"), "a.tif"), b"0")
+        cache.store("other_key", {"dx": 2.5})
+        assert cache.load("other_key")["dx"] == 2.5
+        assert os.listdir(cache.entry_dir("other_key")) == [ENTRY_FILE]
+
+        # digests computed by two runs are both kept
+        dem_path = os.path.join(tmp_dir, "dem.tif")
+        ref_path = os.path.join(tmp_dir, "ref.tif")
+        write_file(dem_path, b"dem")
+        write_file(ref_path, b"ref")
+        dem_digest = cache.file_digest(dem_path)
+        ref_digest = other_cache.file_digest(ref_path)
+        assert len(os.listdir(os.path.join(cache_dir, DIGESTS_DIR))) == 2
+        assert other_cache.file_digest(dem_path) == dem_digest
+        assert cache.file_digest(ref_path) == ref_digest
+        # a modified file digest is computed again
+        write_file(ref_path, b"other ref")
+        assert cache.file_digest(ref_path) != ref_digest
+
+        assert not [
+            name for name in os.listdir(cache_dir) if name.startswith(".")
+        ]
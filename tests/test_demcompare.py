@@ -23,6 +23,7 @@ This module contains functions to test Demcompare.
 """
 
 # Standard imports
+import json
 import os
 from tempfile import TemporaryDirectory
 
@@ -517,3 +518,233 @@ def test_demcompare_with_classification_layer():
         ref_output_data = os.path.join(test_ref_output_path, img)
         output_data = os.path.join(tmp_dir, img)
         assert_same_images(ref_output_data, output_data, atol=TEST_TOL)
+
+
+@pytest.mark.end2end_tests
+def test_demcompare_coregistration_convergence():
+    """
+    Coregistration convergence end2end test.
+    Test that the coregistration of data/standard/input/test_config.json
+    stops once converged, and that final_config.json plani_results
+    reports the number of iterations performed.
+    """
+    # Get "standard" test root data directory absolute path
+    test_data_path = demcompare_test_data_path("standard")
+
+    # Load "standard" demcompare config from input/test_config.json
+    test_cfg_path = os.path.join(test_data_path, "input/test_config.json")
+    test_cfg = read_config_file(test_cfg_path)
+    test_cfg["plani_opts"]["coregistration_plot"] = "none"
+    test_cfg["plani_opts"]["coregistration_iterations"] = 10
+
+    # Create temporary directory for test output
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+        plani_results = {}
+        for min_shift_increment in (0.05, None):
+            out_dir = os.path.join(tmp_dir, str(min_shift_increment))
+            test_cfg["outputDir"] = out_dir
+            test_cfg["plani_opts"][
+                "coregistration_min_shift_increment"
+            ] = min_shift_increment
+            os.makedirs(out_dir)
+            tmp_cfg_file = os.path.join(out_dir, "test_config.json")
+            save_config_file(tmp_cfg_file, test_cfg)
+            demcompare.run(tmp_cfg_file, ["coregistration"])
+            final_cfg = read_config_file(
+                os.path.join(out_dir, get_out_file_path("final_config.json"))
+            )
+            plani_results[min_shift_increment] = final_cfg["plani_results"]
+            # the same iterations without criterion, the second time
+            test_cfg["plani_opts"]["coregistration_iterations"] = final_cfg[
+                "plani_results"
+            ]["nb_iterations"]
+
+        assert 0 < plani_results[0.05]["nb_iterations"] < 10
+        assert plani_results[None] == plani_results[0.05]
+
+
+@pytest.mark.end2end_tests
+def test_demcompare_lazy():
+    """
+    Lazy mode end2end test.
+    Test that the execution of data/standard/input/test_config.json
+    with lazy (dask backed) inputs gives the same outputs as the eager one.
+    """
+    pytest.importorskip("dask")
+    # Get "standard" test root data directory absolute path
+    test_data_path = demcompare_test_data_path("standard")
+
+    # Load "standard" demcompare config from input/test_config.json
+    test_cfg_path = os.path.join(test_data_path, "input/test_config.json")
+    test_cfg = read_config_file(test_cfg_path)
+    test_cfg["plani_opts"]["coregistration_plot"] = "none"
+
+    # Create temporary directory for eager and lazy outputs
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+        final_cfgs = {}
+        for lazy in (False, True):
+            out_dir = os.path.join(tmp_dir, "lazy" if lazy else "eager")
+            test_cfg["outputDir"] = out_dir
+            test_cfg["lazy"] = lazy
+            os.makedirs(out_dir)
+            tmp_cfg_file = os.path.join(out_dir, "test_config.json")
+            save_config_file(tmp_cfg_file, test_cfg)
+            demcompare.run(tmp_cfg_file, ["coregistration", "stats"])
+            final_cfgs[lazy] = read_config_file(
+                os.path.join(out_dir, get_out_file_path("final_config.json"))
+            )
+
+        # Test final_config.json coregistration results
+        assert final_cfgs[True]["plani_results"] == (
+            final_cfgs[False]["plani_results"]
+        )
+        # Test final_dh.tif and stats
+        for output in [
+            "final_dh.tif",
+            "stats/slope/stats_results_standard.csv",
+        ]:
+            with open(os.path.join(tmp_dir, "eager", output), "rb") as eager:
+                with open(os.path.join(tmp_dir, "lazy", output), "rb") as lazy:
+                    assert eager.read() == lazy.read()
+
+
+@pytest.mark.end2end_tests
+def test_demcompare_tiles_jobs():
+    """
+    Tiles end2end test.
+    Test that the tiles of the ROI of data/standard/input/test_config.json
+    are coregistered on their own window, in parallel processes.
+    """
+    # Get "standard" test root data directory absolute path
+    test_data_path = demcompare_test_data_path("standard")
+
+    # Load "standard" demcompare config from input/test_config.json
+    test_cfg_path = os.path.join(test_data_path, "input/test_config.json")
+    test_cfg = read_config_file(test_cfg_path)
+    test_cfg["inputDSM"]["roi"] = {"x": 100, "y": 200, "w": 400, "h": 200}
+    test_cfg["tile_size"] = 200
+    test_cfg["jobs"] = 2
+    test_cfg["plani_opts"]["coregistration_plot"] = "none"
+
+    # Create temporary directory for test output
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+
+        # Modify test's output dir in configuration to tmp test dir
+        test_cfg["outputDir"] = tmp_dir
+
+        # Set a new test_config tmp file path
+        tmp_cfg_file = os.path.join(tmp_dir, "test_config.json")
+
+        # Save the new configuration inside the tmp dir
+        save_config_file(tmp_cfg_file, test_cfg)
+
+        # Run demcompare coregistration on 2 tiles with 2 jobs
+        demcompare.run(tmp_cfg_file, ["coregistration"])
+
+        # Test each tile final_config.json
+        with open(
+            os.path.join(tmp_dir, "tiles.txt"), "r", encoding="utf8"
+        ) as tiles_file:
+            tiles_cfg_files = tiles_file.read().split()
+        assert len(tiles_cfg_files) == 2
+        for tile_cfg_file, tile_x in zip(tiles_cfg_files, [100, 300]):
+            tile_cfg = read_config_file(
+                os.path.join(
+                    os.path.dirname(tile_cfg_file),
+                    get_out_file_path("final_config.json"),
+                )
+            )
+            assert tile_cfg["inputDSM"]["roi"] == {
+                "x": tile_x,
+                "y": 200,
+                "w": 200,
+                "h": 200,
+            }
+            np.testing.assert_allclose(
+                tile_cfg["plani_results"]["dx"]["nuth_offset"], 3, atol=0.05
+            )
+            np.testing.assert_allclose(
+                tile_cfg["plani_results"]["dy"]["nuth_offset"], -5, atol=0.05
+            )
+
+
+@pytest.mark.end2end_tests
+def test_demcompare_tiles_halo():
+    """
+    Tiles halo end2end test.
+    Test that the tiles of the ROI of data/standard/input/test_config.json
+    are processed on their window expanded by the tiles halo within the ROI,
+    their stats being computed on the tiles cores as without halo.
+    """
+    # Get "standard" test root data directory absolute path
+    test_data_path = demcompare_test_data_path("standard")
+
+    # Load "standard" demcompare config from input/test_config.json
+    test_cfg_path = os.path.join(test_data_path, "input/test_config.json")
+    test_cfg = read_config_file(test_cfg_path)
+    test_cfg["inputDSM"]["roi"] = {"x": 100, "y": 200, "w": 400, "h": 200}
+    test_cfg["tile_size"] = 200
+    test_cfg["plani_opts"]["coregistration_plot"] = "none"
+
+    # Create temporary directory for test output
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+
+        # Run demcompare on 2 tiles without and with a halo
+        tiles_stats = {}
+        for halo in (0, 10):
+            out_dir = os.path.join(tmp_dir, "halo_{}".format(halo))
+            test_cfg["outputDir"] = out_dir
+            test_cfg["tile_halo"] = halo
+            os.makedirs(out_dir)
+            tmp_cfg_file = os.path.join(out_dir, "test_config.json")
+            save_config_file(tmp_cfg_file, test_cfg)
+            demcompare.run(tmp_cfg_file, ["coregistration", "stats"])
+
+            with open(
+                os.path.join(out_dir, "tiles.txt"), "r", encoding="utf8"
+            ) as tiles_file:
+                tiles_dirs = [
+                    os.path.dirname(tile_cfg_file)
+                    for tile_cfg_file in tiles_file.read().split()
+                ]
+            assert len(tiles_dirs) == 2
+            tiles_stats[halo] = []
+            for tile_dir in tiles_dirs:
+                with open(
+                    os.path.join(
+                        tile_dir, "stats/slope/stats_results_standard.json"
+                    ),
+                    "r",
+                    encoding="utf8",
+                ) as stats_file:
+                    tiles_stats[halo].append(json.load(stats_file)["0"])
+
+        # Test the tiles windows: the halo is within the ROI
+        for tile_dir, tile_x in zip(tiles_dirs, [100, 290]):
+            tile_cfg = read_config_file(
+                os.path.join(tile_dir, get_out_file_path("final_config.json"))
+            )
+            assert tile_cfg["inputDSM"]["roi"] == {
+                "x": tile_x,
+                "y": 200,
+                "w": 210,
+                "h": 200,
+            }
+
+        # Test the tiles stats, on all classes.
+        # The first tile halo provides the core columns that its
+        # coregistration shift crops without halo, not the second one.
+        first_stats, second_stats = tiles_stats[0]
+        first_halo_stats, second_halo_stats = tiles_stats[10]
+        assert first_halo_stats["nbpts"] >= first_stats["nbpts"]
+        assert second_halo_stats["nbpts"] == second_stats["nbpts"]
+        for stats, halo_stats, atol in [
+            (first_stats, first_halo_stats, 0.01),
+            (second_stats, second_halo_stats, 0.001),
+        ]:
+            np.testing.assert_allclose(
+                halo_stats["mean"], stats["mean"], atol=atol
+            )
+            np.testing.assert_allclose(
+                halo_stats["std"], stats["std"], atol=atol
+            )
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains functions to test demcompare img_tools module.
+"""
+
+# Standard imports
+import os
+import threading
+import tracemalloc
+from tempfile import TemporaryDirectory
+
+# Third party imports
+import numpy as np
+import pytest
+import rasterio
+
+# Demcompare imports
+from demcompare.img_tools import (
+    RasterCache,
+    convert_to_meter,
+    create_dataset,
+    get_output_profile,
+    load_dems,
+    mask_outside_bounds,
+    pix_to_coord,
+    read_img,
+    read_img_from_array,
+    read_npy,
+    save_npy,
+    save_tif,
+    to_meter_factor,
+    translate_to_coregistered_geometry,
+)
+from demcompare.output_writer import (
+    flush_outputs,
+    set_writer_threads,
+    submit_output,
+)
+
+# Tests helpers
+from .helpers import demcompare_test_data_path, temporary_dir
+
+
+@pytest.mark.unit_tests
+def test_read_img_roi():
+    """
+    Test that read_img with a roi only reads the roi window
+    and returns the same data as a full read sliced,
+    with a shifted transform.
+    """
+    img_path = os.path.join(
+        demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+    )
+    full = read_img(img_path)
+
+    # Image coordinates roi
+    roi = {"x": 10, "y": 20, "w": 30, "h": 15}
+    windowed = read_img(img_path, roi=roi)
+    np.testing.assert_array_equal(
+        windowed["im"].data, full["im"].data[20:35, 10:40]
+    )
+    x_0, y_0 = pix_to_coord(full["trans"].data, 20, 10)
+    np.testing.assert_allclose(windowed["trans"].data[0], x_0)
+    np.testing.assert_allclose(windowed["trans"].data[3], y_0)
+
+    # Georeferenced bounds roi touching the same pixels
+    left, top = pix_to_coord(full["trans"].data, 20.5, 10.5)
+    right, bottom = pix_to_coord(full["trans"].data, 34.5, 39.5)
+    bounds_roi = {"left": left, "bottom": bottom, "right": right, "top": top}
+    windowed_bounds = read_img(img_path, roi=bounds_roi)
+    np.testing.assert_array_equal(
+        windowed_bounds["im"].data, windowed["im"].data
+    )
+    np.testing.assert_allclose(
+        windowed_bounds["trans"].data, windowed["trans"].data
+    )
+
+
+@pytest.mark.unit_tests
+def test_load_dems_lazy():
+    """
+    Test that load_dems lazy mode returns dask backed datasets
+    with the same values as the eager mode.
+    """
+    pytest.importorskip("dask")
+    input_path = os.path.join(demcompare_test_data_path("standard"), "input")
+    ref_path = os.path.join(input_path, "srtm_ref.tif")
+    dem_path = os.path.join(input_path, "srtm_blurred_and_shifted.tif")
+
+    ref, dem = load_dems(ref_path, dem_path, dem_nodata=-32768)
+    lazy_ref, lazy_dem = load_dems(
+        ref_path, dem_path, dem_nodata=-32768, lazy=True
+    )
+
+    assert lazy_ref["im"].chunks is not None
+    assert lazy_dem["im"].chunks is not None
+    np.testing.assert_array_equal(lazy_dem["im"].values, dem["im"].data)
+    np.testing.assert_array_equal(lazy_ref["im"].values, ref["im"].data)
+
+
+@pytest.mark.unit_tests
+def test_load_dems_lazy_memory():
+    """
+    Test that load_dems lazy mode reads and reprojects the inputs
+    by chunks: a chunked reduction of the elevation differences
+    allocates a fraction of an input raster size.
+    """
+    dask = pytest.importorskip("dask")
+    size = 3000
+    rows, cols = np.mgrid[0:size, 0:size]
+    data = (np.sin(rows / 50) + np.cos(cols / 70)).astype(np.float32)
+    del rows, cols
+
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+        # dem origin shifted by a third of pixel: ref is resampled
+        paths = []
+        for name, x_origin in (("ref", 500000.0), ("dem", 500000.3)):
+            paths.append(os.path.join(tmp_dir, name + ".tif"))
+            with rasterio.open(
+                paths[-1],
+                "w",
+                driver="GTiff",
+                width=size,
+                height=size,
+                count=1,
+                dtype="float32",
+                crs="EPSG:32631",
+                transform=rasterio.transform.from_origin(
+                    x_origin, 4000000, 1, 1
+                ),
+                tiled=True,
+                blockxsize=256,
+                blockysize=256,
+                nodata=-32768,
+            ) as dst:
+                dst.write(data, 1)
+
+        tracemalloc.start()
+        try:
+            ref, dem = load_dems(paths[0], paths[1], lazy=True)
+            with dask.config.set(scheduler="synchronous"):
+                (ref["im"].data - dem["im"].data).mean().compute()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    assert peak < data.nbytes / 2
+
+
+@pytest.mark.unit_tests
+def test_save_read_npy():
+    """
+    Test that a dataset saved with save_npy is read back by read_npy
+    as a memory map with the same data and georeferencing.
+    """
+    img_path = os.path.join(
+        demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+    )
+    dataset = read_img(img_path, roi={"x": 0, "y": 0, "w": 50, "h": 40})
+
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+        npy_path = os.path.join(tmp_dir, "dataset.npy")
+        save_npy(dataset, npy_path)
+        npy_dataset = read_npy(npy_path)
+
+        # data is a view on the memory map, not a copy
+        assert isinstance(npy_dataset["im"].data.base, np.memmap)
+        np.testing.assert_array_equal(
+            npy_dataset["im"].data, dataset["im"].data
+        )
+        np.testing.assert_allclose(
+            npy_dataset["trans"].data, dataset["trans"].data
+        )
+        assert npy_dataset.attrs["georef"] == dataset.attrs["georef"]
+        assert npy_dataset.attrs["no_data"] == dataset.attrs["no_data"]
+
+
+@pytest.mark.unit_tests
+def test_convert_to_meter():
+    """
+    Test the units factors to meters, and that convert_to_meter leaves
+    meters untouched, converts other units of float arrays in place
+    and returns a new array for other dtypes.
+    """
+    for unit, factor in (("m", 1), ("cm", 0.01), ("mm", 0.001), ("km", 1000)):
+        np.testing.assert_allclose(to_meter_factor(unit), factor)
+
+    data = np.array([[1.0, 2.0], [np.nan, 100.0]], dtype=np.float32)
+    assert convert_to_meter(data, "m") is data
+
+    converted = convert_to_meter(data, "cm")
+    assert converted is data
+    np.testing.assert_allclose(
+        converted, np.array([[0.01, 0.02], [np.nan, 1.0]]), rtol=1e-6
+    )
+
+    int_data = np.array([[1, 2], [3, 100]], dtype=np.int16)
+    converted = convert_to_meter(int_data, "cm")
+    assert not np.shares_memory(converted, int_data)
+    np.testing.assert_array_equal(int_data, [[1, 2], [3, 100]])
+    np.testing.assert_allclose(converted, [[0.01, 0.02], [0.03, 1.0]])
+
+
+@pytest.mark.unit_tests
+def test_create_dataset_aliasing():
+    """
+    Test that create_dataset and read_img_from_array copy the caller
+    arrays by default, and that without copy they use float32 arrays
+    in place, nodata values set to nan and units converted.
+    """
+    img_path = os.path.join(
+        demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+    )
+    transform = rasterio.Affine(1, 0, 0, 0, -1, 0)
+
+    for dtype in (np.float32, np.int16):
+        data = np.array([[100, -32768], [200, 300]], dtype=dtype)
+        dataset = create_dataset(
+            data, transform, img_path, no_data=-32768, zunit="cm"
+        )
+        assert not np.shares_memory(dataset["im"].data, data)
+        np.testing.assert_array_equal(data, [[100, -32768], [200, 300]])
+        np.testing.assert_allclose(dataset["im"].data, [[1, np.nan], [2, 3]])
+
+    data = np.array([[100, -32768], [200, 300]], dtype=np.float32)
+    dataset = create_dataset(
+        data, transform, img_path, no_data=-32768, zunit="cm", copy=False
+    )
+    assert np.shares_memory(dataset["im"].data, data)
+    np.testing.assert_allclose(data, [[1, np.nan], [2, 3]])
+
+    data = np.array([[1, -9999], [2, 3]], dtype=np.float32)
+    dataset = read_img_from_array(data)
+    assert not np.shares_memory(dataset["im"].data, data)
+    np.testing.assert_array_equal(data, [[1, -9999], [2, 3]])
+    dataset = read_img_from_array(data, copy_array=False)
+    assert np.shares_memory(dataset["im"].data, data)
+    np.testing.assert_array_equal(data, [[1, np.nan], [2, 3]])
+
+
+@pytest.mark.unit_tests
+def test_raster_cache():
+    """
+    Test that the rasters cache opens a raster once, reopens it
+    when it is rewritten, and closes evicted rasters.
+    """
+    img_path = os.path.join(
+        demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+    )
+    cache = RasterCache(maxsize=1)
+    img_ds = cache.open(img_path)
+    assert cache.open(img_path) is img_ds
+
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, "img.tif")
+        save_tif(read_img(img_path), tmp_path)
+        tmp_ds = cache.open(tmp_path)
+        # maxsize is 1: the first raster is evicted and closed
+        assert img_ds.closed
+        os.utime(tmp_path, ns=(0, 0))
+        assert cache.open(tmp_path) is not tmp_ds
+
+    cache.close()
+
+
+@pytest.mark.unit_tests
+def test_save_tif_output_profile():
+    """
+    Test that save_tif writes a tiled compressed COG with the cog
+    output profile, with the same data as the default profile.
+    """
+    img_path = os.path.join(
+        demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+    )
+    dataset = read_img(img_path)
+
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+        cog_path = os.path.join(tmp_dir, "cog.tif")
+        save_tif(
+            dataset,
+            cog_path,
+            output_profile=get_output_profile(
+                {"profile": "cog", "compress": "LZW", "blocksize": 256}
+            ),
+        )
+        with rasterio.open(cog_path) as cog_ds:
+            assert cog_ds.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+            assert cog_ds.profile["compress"] == "lzw"
+            assert cog_ds.block_shapes[0] == (256, 256)
+            cog_data = cog_ds.read(1)
+        assert not os.path.exists(cog_path + ".tmp.tif")
+
+        default_path = os.path.join(tmp_dir, "default.tif")
+        save_tif(dataset, default_path)
+        with rasterio.open(default_path) as default_ds:
+            assert "compress" not in default_ds.profile
+            np.testing.assert_array_equal(default_ds.read(1), cog_data)
+
+
+@pytest.mark.unit_tests
+def test_save_tif_background():
+    """
+    Test that save_tif writes the data as it is at the submission
+    when written in the background, even if modified in place before
+    the writing.
+    """
+    img_path = os.path.join(
+        demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+    )
+    dataset = read_img(img_path, roi={"x": 0, "y": 0, "w": 50, "h": 40})
+    expected = dataset["im"].data.copy()
+
+    release = threading.Event()
+    set_writer_threads(1)
+    try:
+        with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+            # the only writer thread is busy until released
+            submit_output("busy", release.wait, 10)
+            tif_path = os.path.join(tmp_dir, "dataset.tif")
+            save_tif(dataset, tif_path)
+            dataset["im"].data[:] = 0
+            release.set()
+            flush_outputs()
+            with rasterio.open(tif_path) as tif_ds:
+                np.testing.assert_array_equal(tif_ds.read(1), expected)
+    finally:
+        release.set()
+        set_writer_threads(0)
+
+
+@pytest.mark.unit_tests
+def test_mask_outside_bounds():
+    """
+    Test that mask_outside_bounds keeps the pixels whose center
+    is within the bounds, abutting bounds sharing no pixel.
+    """
+    img_path = os.path.join(
+        demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+    )
+    img = read_img(img_path, roi={"x": 10, "y": 20, "w": 30, "h": 15})
+
+    # bounds on pixels borders: rows 2 to 9, columns 5 to 14 and 15 to 24
+    left, top = pix_to_coord(img["trans"].data, 2, 5)
+    middle, bottom = pix_to_coord(img["trans"].data, 10, 15)
+    right, _ = pix_to_coord(img["trans"].data, 10, 25)
+    masked = [
+        mask_outside_bounds(
+            img,
+            {"left": x_0, "bottom": bottom, "right": x_1, "top": top},
+        )
+        for x_0, x_1 in ((left, middle), (middle, right))
+    ]
+    for masked_img, cols in zip(masked, (slice(5, 15), slice(15, 25))):
+        assert masked_img.attrs["nb_points"] == 8 * 10
+        expected = np.full(img["im"].shape, np.nan, dtype=np.float32)
+        expected[2:10, cols] = img["im"].data[2:10, cols]
+        np.testing.assert_array_equal(masked_img["im"].data, expected)
+
+
+@pytest.mark.unit_tests
+def test_translate_to_coregistered_geometry():
+    """
+    Test that translate_to_coregistered_geometry crops a non square DEM
+    to its intersection with the reference, without writing any file
+    in the working directory.
+    """
+    img_path = os.path.join(
+        demcompare_test_data_path("standard"), "input/srtm_ref.tif"
+    )
+    # DEM within the reference, wider than high
+    dem = read_img(img_path, roi={"x": 10, "y": 20, "w": 60, "h": 30})
+    ref = read_img(img_path, roi={"x": 0, "y": 0, "w": 100, "h": 80})
+
+    with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+        current_dir = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            coreg_dem, coreg_ref = translate_to_coregistered_geometry(
+                dem, ref, 0, 0
+            )
+        finally:
+            os.chdir(current_dir)
+        assert not os.listdir(tmp_dir)
+
+    # the intersection is the whole DEM, the reference is resampled on it
+    assert coreg_dem["im"].shape == (30, 60)
+    np.testing.assert_array_equal(coreg_dem["im"].data, dem["im"].data)
+    np.testing.assert_allclose(coreg_ref["im"].data, dem["im"].data)
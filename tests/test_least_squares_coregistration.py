@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains functions to test demcompare
+least_squares_coregistration module.
+"""
+
+# Third party imports
+import numpy as np
+import pytest
+
+# Demcompare imports
+from demcompare.coregistration import COREGISTRATION_METHODS
+from demcompare.img_tools import read_img_from_array
+from demcompare.least_squares_coregistration import least_squares_lib
+
+
+@pytest.mark.unit_tests
+def test_least_squares_lib():
+    """
+    Test that least_squares_lib recovers the x, y and z shifts
+    of a shifted synthetic DEM, as nuth_kaab_lib defines them,
+    and that least_squares is a registered coregistration method.
+    """
+    rows, cols = np.mgrid[0:220, 0:220].astype(np.float64)
+    terrain = 2 * (
+        np.sin(cols / 40) + np.cos(rows / 55) + np.sin((rows + cols) / 23)
+    )
+    dem = terrain[10:210, 10:210].astype(np.float32)
+    # ref(row - y, col + x) - z = dem(row, col) with x=-3, y=-2, z=1
+    ref = (terrain[8:208, 13:213] + 1).astype(np.float32)
+    ref[50:60, 50:60] = np.nan
+
+    x_off, y_off, z_off, coreg_dem, coreg_ref, _, final_dh, _ = (
+        least_squares_lib(
+            read_img_from_array(dem), read_img_from_array(ref), nb_iters=8
+        )
+    )
+    np.testing.assert_allclose((x_off, y_off, z_off), (-3, -2, 1), atol=1e-3)
+    assert coreg_dem["im"].shape == coreg_ref["im"].shape
+    np.testing.assert_allclose(np.nanmedian(final_dh["im"].data), 1, atol=1e-2)
+
+    assert "least_squares" in COREGISTRATION_METHODS
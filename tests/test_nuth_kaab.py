@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains functions to test demcompare
+nuth_kaab_universal_coregistration module.
+"""
+
+# Third party imports
+import numpy as np
+import pytest
+
+# Demcompare imports
+from demcompare.block_processing import BlockPool
+from demcompare.img_tools import read_img_from_array
+from demcompare.nuth_kaab_universal_coregistration import (
+    ShiftInterpolator,
+    crop_slope_aspect,
+    fit_aspect_model,
+    grad2d,
+    grad2d_at,
+    nuth_kaab_lib,
+    nuth_kaab_single_iter,
+    sample_valid_pixels,
+    shift_crop,
+    slice_by_aspect,
+)
+
+
+def shifted_synthetic_dems():
+    """
+    Synthetic smooth DEM and reference DEM shifted by x=-3, y=-2, z=1
+    (with noise): ref(row - y, col + x) - z = dem(row, col)
+
+    :return: dem and ref datasets
+    :rtype: xr.Dataset, xr.Dataset
+    """
+    rows, cols = np.mgrid[0:220, 0:220].astype(np.float64)
+    terrain = 2 * (
+        np.sin(cols / 40) + np.cos(rows / 55) + np.sin((rows + cols) / 23)
+    )
+    dem = read_img_from_array(terrain[10:210, 10:210].astype(np.float32))
+    rng = np.random.default_rng(0)
+    ref = read_img_from_array(
+        (terrain[8:208, 13:213] + 1 + rng.normal(0, 0.1, (200, 200))).astype(
+            np.float32
+        )
+    )
+    return dem, ref
+
+
+@pytest.mark.unit_tests
+def test_slice_by_aspect():
+    """
+    Test that slice_by_aspect gives, for each aspect slice,
+    the indexes of the values strictly within the slice bounds,
+    as a comparison of the values with each slice bounds does,
+    with a single block or several threads blocks.
+    """
+    aspect_step = np.pi / 36
+    aspect_bounds = np.arange(0, 2 * np.pi, aspect_step)
+    rng = np.random.default_rng(0)
+    aspect = np.concatenate(
+        (
+            rng.uniform(0, 2 * np.pi, 10000),
+            aspect_bounds,
+            [2 * np.pi, np.nan],
+        )
+    ).astype(np.float32)
+
+    target_idxes, slice_starts, slice_stops = slice_by_aspect(
+        aspect, aspect_bounds, aspect_step
+    )
+
+    for bounds, slice_start, slice_stop in zip(
+        aspect_bounds, slice_starts, slice_stops
+    ):
+        (expected_idxes,) = np.where(
+            (bounds < aspect) & (aspect < bounds + aspect_step)
+        )
+        np.testing.assert_array_equal(
+            target_idxes[slice_start:slice_stop], expected_idxes
+        )
+
+    # Sorted blocks merge gives the same slices
+    with BlockPool(3) as pool:
+        for result, expected in zip(
+            slice_by_aspect(aspect, aspect_bounds, aspect_step, pool=pool),
+            (target_idxes, slice_starts, slice_stops),
+        ):
+            np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.unit_tests
+def test_sample_slope_aspect():
+    """
+    Test that sample_valid_pixels draws valid pixels within its limits
+    and that grad2d_at gives the grad2d slope and aspect at these pixels,
+    edges included.
+    """
+    rng = np.random.default_rng(0)
+    dem = rng.normal(100, 10, (50, 40)).astype(np.float32)
+    valid = rng.random(dem.shape) < 0.8
+    valid[0, :] = valid[:, -1] = True
+
+    rows, cols = sample_valid_pixels(valid, max_points=500, seed=1)
+    assert rows.size == 500
+    assert np.all(valid[rows, cols])
+    rows, cols = sample_valid_pixels(valid, ratio=0.1)
+    assert rows.size == int(np.ceil(0.1 * np.count_nonzero(valid)))
+
+    rows, cols = np.nonzero(valid)
+    slope, aspect = grad2d(dem)
+    sample_slope, sample_aspect = grad2d_at(dem, rows, cols)
+    np.testing.assert_array_equal(sample_slope, slope[rows, cols])
+    np.testing.assert_array_equal(sample_aspect, aspect[rows, cols])
+
+
+@pytest.mark.unit_tests
+def test_shift_interpolator():
+    """
+    Test that the bilinear shift interpolation gives the values
+    and the nodata of the former spline interpolation,
+    on a grid and at points, inside and outside the DEM.
+    """
+    rng = np.random.default_rng(0)
+    dem = rng.normal(100, 10, (60, 50)).astype(np.float32)
+    dem[rng.random(dem.shape) < 0.05] = np.nan
+    bilinear = ShiftInterpolator(dem, resampling="bilinear")
+    spline = ShiftInterpolator(dem, resampling="spline")
+
+    for xoff, yoff in ((2.3, -1.7), (-3.0, 4.0), (0.5, 0.0)):
+        rows_pos = np.arange(dem.shape[0]) - yoff
+        cols_pos = np.arange(dem.shape[1]) + xoff
+        np.testing.assert_allclose(
+            bilinear.grid(rows_pos, cols_pos),
+            spline.grid(rows_pos, cols_pos),
+            rtol=1e-12,
+        )
+
+    rows_pos = rng.uniform(-2, dem.shape[0] + 1, 1000)
+    cols_pos = rng.uniform(-2, dem.shape[1] + 1, 1000)
+    np.testing.assert_allclose(
+        bilinear.points(rows_pos, cols_pos),
+        spline.points(rows_pos, cols_pos),
+        rtol=1e-12,
+    )
+
+
+@pytest.mark.unit_tests
+def test_fit_aspect_model():
+    """
+    Test that fit_aspect_model recovers the a.cos(b-aspect)+c model
+    from the aspect slices medians, without the empty and low count
+    slices, the densest slices weighing most.
+    """
+    aspect_bounds = np.arange(0, 2 * np.pi, np.pi / 36)
+    north, east, c = 1.5, -2.0, 0.3
+    slice_medians = (
+        north * np.cos(aspect_bounds) + east * np.sin(aspect_bounds) + c
+    )
+    slice_counts = np.full(aspect_bounds.size, 100)
+    # empty and low count slices with wrong medians are not fitted
+    slice_medians[:5] = np.nan
+    slice_counts[:5] = 0
+    slice_medians[10:15] = 50.0
+    slice_counts[10:15] = 3
+    np.testing.assert_allclose(
+        fit_aspect_model(aspect_bounds, slice_medians, slice_counts),
+        (north, east, c),
+    )
+
+    # a wrong dense slice moves the fit more than a wrong sparse one
+    sparse_medians = slice_medians.copy()
+    sparse_medians[20] += 5
+    dense_medians = sparse_medians.copy()
+    dense_counts = slice_counts.copy()
+    dense_counts[20] = 10000
+    sparse_fit = fit_aspect_model(aspect_bounds, sparse_medians, slice_counts)
+    dense_fit = fit_aspect_model(aspect_bounds, dense_medians, dense_counts)
+    assert np.abs(dense_fit[2] - c) > np.abs(sparse_fit[2] - c)
+
+
+@pytest.mark.unit_tests
+def test_nuth_kaab_single_iter_keeps_slope():
+    """
+    Test that nuth_kaab_single_iter filters the nearly flat pixels
+    without modifying the caller's slope array, whatever the threads number.
+    """
+    rng = np.random.default_rng(0)
+    dem = rng.normal(100, 10, (60, 50))
+    slope, aspect = grad2d(dem)
+    slope[::7, ::5] = 0.0
+    dh = rng.normal(0, 1, dem.shape)
+    slope_before = slope.copy()
+
+    results = []
+    for nb_threads in (1, 3):
+        with BlockPool(nb_threads) as pool:
+            results.append(
+                nuth_kaab_single_iter(
+                    dh, slope, aspect, plot_file=False, plot="none", pool=pool
+                )
+            )
+        np.testing.assert_array_equal(slope, slope_before)
+    np.testing.assert_array_equal(results[0], results[1])
+
+
+@pytest.mark.unit_tests
+def test_nuth_kaab_lib_convergence():
+    """
+    Test that nuth_kaab_lib stops its iterations on a shifted synthetic
+    DEM once converged, before the maximum number of iterations,
+    and returns the number of iterations performed.
+    """
+    dem, ref = shifted_synthetic_dems()
+
+    # without convergence criteria, all the iterations are performed
+    assert nuth_kaab_lib(dem, ref, nb_iters=20, plot="none")[-1] == 20
+
+    for criterion in ({"min_shift_increment": 0.01}, {"min_nmad_gain": 1}):
+        x_off, y_off, _, _, _, _, _, nb_iters_done = nuth_kaab_lib(
+            dem, ref, nb_iters=20, plot="none", **criterion
+        )
+        assert 0 < nb_iters_done < 20
+        np.testing.assert_allclose((x_off, y_off), (-3, -2), atol=0.05)
+        # as many iterations without criteria give the same offsets,
+        # one iteration less does not
+        same_iters = nuth_kaab_lib(
+            dem, ref, nb_iters=nb_iters_done, plot="none"
+        )
+        np.testing.assert_allclose(same_iters[:2], (x_off, y_off))
+        fewer_iters = nuth_kaab_lib(
+            dem, ref, nb_iters=nb_iters_done - 1, plot="none"
+        )
+        assert not np.allclose(fewer_iters[:2], (x_off, y_off))
+
+
+@pytest.mark.unit_tests
+def test_nuth_kaab_lib_sampling():
+    """
+    Test that nuth_kaab_lib on a sample of the pixels recovers the same
+    integer shift as on all the pixels, on a shifted synthetic DEM.
+    """
+    dem, ref = shifted_synthetic_dems()
+    full = nuth_kaab_lib(dem, ref, plot="none")
+    np.testing.assert_array_equal(np.round(full[:2]), (-3, -2))
+    for sampling in ({"sampling_max_points": 5000}, {"sampling_ratio": 0.2}):
+        sampled = nuth_kaab_lib(dem, ref, plot="none", **sampling)
+        np.testing.assert_array_equal(np.round(sampled[:2]), np.round(full[:2]))
+
+
+@pytest.mark.unit_tests
+def test_nuth_kaab_lib_pool():
+    """
+    Test that nuth_kaab_lib gives the same offsets on several threads
+    as on a single one, on a shifted synthetic DEM.
+    """
+    dem, ref = shifted_synthetic_dems()
+    single = nuth_kaab_lib(dem, ref, plot="none")
+    with BlockPool(4) as pool:
+        threaded = nuth_kaab_lib(dem, ref, plot="none", pool=pool)
+    np.testing.assert_array_equal(threaded[:3], single[:3])
+    assert threaded[-1] == single[-1]
+
+
+@pytest.mark.unit_tests
+def test_crop_slope_aspect():
+    """
+    Test that crop_slope_aspect gives the grad2d slope and aspect
+    of the shift_crop cropped DEM, for integer and sub-pixel shifts.
+    """
+    rng = np.random.default_rng(0)
+    dem = rng.normal(100, 10, (60, 50))
+    slope, aspect = grad2d(dem)
+    for xoff, yoff in ((0, 0), (-3, 2), (2, -1), (1.4, -0.6), (-0.3, 2.7)):
+        crop = shift_crop(dem.shape, xoff, yoff)
+        crop_slope, crop_aspect = crop_slope_aspect(dem, slope, aspect, crop)
+        expected_slope, expected_aspect = grad2d(dem[crop])
+        np.testing.assert_allclose(crop_slope, expected_slope)
+        np.testing.assert_allclose(crop_aspect, expected_aspect)
+    # the dem slope and aspect are not modified
+    np.testing.assert_array_equal((slope, aspect), grad2d(dem))
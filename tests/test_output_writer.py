@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains functions to test demcompare output_writer module.
+"""
+
+# Standard imports
+import os
+import threading
+from tempfile import TemporaryDirectory
+
+# Third party imports
+import matplotlib.pyplot as mpl_pyplot
+import pytest
+
+# Demcompare imports
+from demcompare.output_writer import (
+    OutputWriter,
+    flush_outputs,
+    save_figure,
+    set_writer_threads,
+    submit_output,
+)
+
+# Tests helpers
+from .helpers import temporary_dir
+
+
+@pytest.mark.unit_tests
+def test_output_writer():
+    """
+    Test that the output writer runs the jobs in the background,
+    waits for the jobs of a path and propagates errors at flush.
+    """
+    writer = OutputWriter(nb_threads=2)
+    release = threading.Event()
+    written = []
+
+    def write(path):
+        release.wait(timeout=10)
+        written.append(path)
+
+    def fail():
+        raise IOError("disk full")
+
+    writer.submit("a.tif", write, "a.tif")
+    # the job is pending until released
+    assert not written
+    release.set()
+    writer.wait("a.tif")
+    assert written == ["a.tif"]
+
+    writer.submit("b.tif", fail)
+    with pytest.raises(IOError):
+        writer.flush()
+    # errors are only raised once
+    writer.flush()
+
+    writer.set_threads(0)
+
+
+@pytest.mark.unit_tests
+def test_save_figure():
+    """
+    Test that save_figure renders the figure in the calling thread,
+    only the file being written in the background, as savefig does.
+    """
+    release = threading.Event()
+    set_writer_threads(1)
+    try:
+        with TemporaryDirectory(dir=temporary_dir()) as tmp_dir:
+            # the only writer thread is busy until released
+            submit_output("busy", release.wait, 10)
+
+            fig = mpl_pyplot.figure()
+            mpl_pyplot.plot([0, 1], [1, 0])
+            mpl_pyplot.title(r"$\alpha$")
+            plot_file = os.path.join(tmp_dir, "plot.png")
+            save_figure(fig, plot_file, dpi=50)
+            # the figure is rendered, its file is pending
+            assert not mpl_pyplot.get_fignums()
+            assert not os.path.exists(plot_file)
+
+            release.set()
+            flush_outputs()
+            expected_file = os.path.join(tmp_dir, "expected.png")
+            fig.savefig(expected_file, dpi=50)
+            with open(plot_file, "rb") as plot, open(
+                expected_file, "rb"
+            ) as expected:
+                assert plot.read() == expected.read()
+    finally:
+        release.set()
+        set_writer_threads(0)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf8
+#
+# Copyright (c) 2021 Centre National d'Etudes Spatiales (CNES).
+#
+# This file is part of demcompare
+# (see https://github.com/CNES/demcompare).
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module contains functions to test demcompare
+robust_stats module.
+"""
+
+# Third party imports
+import numpy as np
+import pytest
+
+# Demcompare imports
+from demcompare.robust_stats import NMAD_FACTOR, RobustStats
+
+
+@pytest.mark.unit_tests
+def test_median_nmad():
+    """
+    Test that RobustStats gives the numpy median and NMAD of the not nan
+    values, or of a valid mask values, with odd and even numbers
+    of values, reusing its scratch buffer across arrays and dtypes.
+    """
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 10, (101, 37))
+    data[rng.random(data.shape) < 0.1] = np.nan
+    data[::7, ::3] = 1.5
+    robust_stats = RobustStats()
+    for values in (data, data[:, :-1].astype(np.float32), data[:50, 0]):
+        median = np.nanmedian(values)
+        nmad = NMAD_FACTOR * np.nanmedian(np.abs(values - median))
+        assert robust_stats.median_nmad(values) == (median, nmad)
+        assert robust_stats.median(values) == median
+        assert robust_stats.median(values, center=median) * NMAD_FACTOR == nmad
+    valid = data > 0
+    assert robust_stats.median(data, valid=valid) == np.median(data[valid])
+    # input data is not modified
+    np.testing.assert_array_equal(data[::7, ::3], 1.5)